@@ -0,0 +1,272 @@
+import asyncio
+import struct
+import math
+import zlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Chart rendering for graph-generating modules.
+#
+# Charts are described by plain dictionaries (so they can be sent to a worker
+# process), and rendered to PNG files by one of the renderers:
+#    plotly     - Rendered by plot.ly's image server. Needs network access
+#                 and a plotly account.
+#    matplotlib - Rendered locally with matplotlib's Agg backend.
+#    builtin    - Rendered locally with no dependencies, but without any text.
+#
+# A chart dictionary has these keys:
+#    type         - "line" or "bar".
+#    title        - Chart title.
+#    x_vals       - List of x values.
+#    y_vals       - List of y values.
+#    x_axis_title - x axis title.
+#    y_axis_title - y axis title.
+#    x_log        - (Optional) True for a logarithmic x axis.
+#    y_log        - (Optional) True for a logarithmic y axis.
+
+RENDERERS = ["plotly", "matplotlib", "builtin"]
+
+class ChartRenderer:
+   """
+   Renders charts in a worker process, using the renderer chosen from the
+   config.ini chart_renderer setting.
+   """
+
+   # PARAMETER: renderer_name - One of RENDERERS, or "auto" to use matplotlib
+   #                            if it's installed, then plotly if there are
+   #                            credentials, and builtin otherwise.
+   # PARAMETER: plotly_credentials - Tuple (username, api key), or None.
+   def __init__(self, renderer_name, plotly_credentials=None):
+      if renderer_name == "auto":
+         if _matplotlib_available():
+            renderer_name = "matplotlib"
+         elif not plotly_credentials is None:
+            renderer_name = "plotly"
+         else:
+            renderer_name = "builtin"
+      elif not renderer_name in RENDERERS:
+         raise ValueError("Unknown chart renderer: " + renderer_name)
+      self.renderer_name = renderer_name
+      self._plotly_credentials = plotly_credentials
+      self._process_pool = None # Created when first needed.
+      self._process_pool_unavailable = False
+      return
+
+   # Only the builtin renderer leaves the text out, so callers should send it
+   # along with the image instead.
+   def draws_text(self):
+      return self.renderer_name != "builtin"
+
+   # Renders a chart to a PNG file.
+   # PARAMETER: filepath - File path without the extension.
+   # RETURNS: File path of the PNG file.
+   async def render(self, chart, filepath):
+      loop = asyncio.get_event_loop()
+      fn_args = [self.renderer_name, chart, filepath, self._plotly_credentials]
+      if self._process_pool_unavailable:
+         return await loop.run_in_executor(None, render, *fn_args)
+      try:
+         if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=1)
+         # Worker processes are started here, when the job is submitted.
+         future = loop.run_in_executor(self._process_pool, render, *fn_args)
+      except BrokenProcessPool:
+         return await self._render_after_broken_pool(fn_args)
+      except (RuntimeError, OSError, NotImplementedError):
+         # Usually because worker processes can't be made here.
+         print(traceback.format_exc())
+         print("ChartRenderer process pool unavailable. Rendering in threads instead.")
+         self.shutdown()
+         self._process_pool_unavailable = True
+         return await loop.run_in_executor(None, render, *fn_args)
+      try:
+         return await future
+      except BrokenProcessPool:
+         # Errors raised by the renderer itself are left to the caller.
+         return await self._render_after_broken_pool(fn_args)
+
+   # The worker process died (e.g. it was killed), so the pool is replaced
+   # when the next chart is rendered.
+   async def _render_after_broken_pool(self, fn_args):
+      print(traceback.format_exc())
+      print("ChartRenderer worker process died. Rendering this chart in a thread instead.")
+      self.shutdown()
+      loop = asyncio.get_event_loop()
+      return await loop.run_in_executor(None, render, *fn_args)
+
+   def shutdown(self):
+      if not self._process_pool is None:
+         self._process_pool.shutdown(wait=False)
+         self._process_pool = None
+      return
+
+# Renders a chart in this process. (See ChartRenderer.render().)
+def render(renderer_name, chart, filepath, plotly_credentials=None):
+   if renderer_name == "plotly":
+      return _render_plotly(chart, filepath, plotly_credentials)
+   elif renderer_name == "matplotlib":
+      return _render_matplotlib(chart, filepath)
+   else:
+      return _render_builtin(chart, filepath)
+
+def _matplotlib_available():
+   try:
+      import matplotlib
+   except ImportError:
+      return False
+   return True
+
+#################################################################################
+# PLOTLY ########################################################################
+#################################################################################
+
+_plotly_signed_in = False
+
+def _render_plotly(chart, filepath, plotly_credentials):
+   global _plotly_signed_in
+   import plotly.plotly as py
+   import plotly.graph_objs as go
+   if not _plotly_signed_in:
+      py.sign_in(*plotly_credentials)
+      _plotly_signed_in = True
+   if chart["type"] == "bar":
+      plotly_data = [go.Bar(x=chart["x_vals"], y=chart["y_vals"])]
+   else:
+      plotly_data = [go.Scatter(x=chart["x_vals"], y=chart["y_vals"])]
+   xaxis = dict(title=chart["x_axis_title"])
+   if chart.get("x_log", False):
+      xaxis["type"] = "log"
+   yaxis = dict(title=chart["y_axis_title"])
+   if chart.get("y_log", False):
+      yaxis["type"] = "log"
+   plotly_layout = go.Layout(title=chart["title"], xaxis=xaxis, yaxis=yaxis)
+   py.image.save_as({'data':plotly_data, 'layout':plotly_layout}, filepath, format='png')
+   return filepath + ".png"
+
+#################################################################################
+# MATPLOTLIB ####################################################################
+#################################################################################
+
+_figures = {}
+# Maps chart type -> (figure, axes). Figures are reused by later charts of
+# the same type rather than being set up again every time.
+
+def _render_matplotlib(chart, filepath):
+   from matplotlib.figure import Figure
+   from matplotlib.backends.backend_agg import FigureCanvasAgg
+   try:
+      (fig, ax) = _figures[chart["type"]]
+      ax.clear()
+   except KeyError:
+      fig = Figure(figsize=(10, 6), dpi=100)
+      FigureCanvasAgg(fig)
+      ax = fig.add_subplot(1, 1, 1)
+      _figures[chart["type"]] = (fig, ax)
+   if chart["type"] == "bar":
+      ax.bar(chart["x_vals"], chart["y_vals"])
+   else:
+      ax.plot(chart["x_vals"], chart["y_vals"])
+   if chart.get("x_log", False):
+      ax.set_xscale("log")
+   if chart.get("y_log", False):
+      ax.set_yscale("log")
+   ax.set_title(chart["title"])
+   ax.set_xlabel(chart["x_axis_title"])
+   ax.set_ylabel(chart["y_axis_title"])
+   fig.savefig(filepath + ".png", format="png")
+   return filepath + ".png"
+
+#################################################################################
+# BUILTIN #######################################################################
+#################################################################################
+
+_WIDTH = 800
+_HEIGHT = 500
+_MARGIN = 40
+
+_BACKGROUND = (255, 255, 255)
+_AXES = (0, 0, 0)
+_PLOT = (31, 119, 180)
+
+class _Canvas:
+   def __init__(self, width, height):
+      self.width = width
+      self.height = height
+      self.pixels = bytearray(bytes(_BACKGROUND) * (width * height))
+      return
+
+   def fill_rect(self, x0, y0, x1, y1, colour):
+      (x0, x1) = (max(min(x0, x1), 0), min(max(x0, x1), self.width - 1))
+      (y0, y1) = (max(min(y0, y1), 0), min(max(y0, y1), self.height - 1))
+      row = bytes(colour) * (x1 - x0 + 1)
+      for y in range(y0, y1 + 1):
+         start = ((y * self.width) + x0) * 3
+         self.pixels[start:start + len(row)] = row
+      return
+
+   def line(self, x0, y0, x1, y1, colour):
+      steps = max(abs(x1 - x0), abs(y1 - y0), 1)
+      for i in range(steps + 1):
+         x = x0 + round((x1 - x0) * i / steps)
+         y = y0 + round((y1 - y0) * i / steps)
+         self.fill_rect(x, y, x, y, colour)
+      return
+
+   def to_png(self):
+      stride = self.width * 3
+      raw = bytearray()
+      for y in range(self.height):
+         raw.append(0) # Filter type: None
+         raw.extend(self.pixels[y * stride:(y + 1) * stride])
+      def chunk(chunk_type, data):
+         body = chunk_type + data
+         return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+      ihdr = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+      return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(bytes(raw))) + chunk(b"IEND", b"")
+
+# RETURNS: A function mapping values to pixel coordinates along an axis, or
+#          None for values that can't be plotted.
+def _make_scale(values, log, pixel_from, pixel_to):
+   if log:
+      values = [math.log10(x) for x in values if x > 0]
+   if len(values) == 0:
+      return lambda x: None
+   (low, high) = (min(values), max(values))
+   if (not log) and (low > 0):
+      low = 0 # Linear axes start from zero where they can.
+   if high == low:
+      high = low + 1
+   def scale(x):
+      if log:
+         if x <= 0:
+            return None
+         x = math.log10(x)
+      return round(pixel_from + (pixel_to - pixel_from) * (x - low) / (high - low))
+   return scale
+
+def _render_builtin(chart, filepath):
+   canvas = _Canvas(_WIDTH, _HEIGHT)
+   (left, right) = (_MARGIN, _WIDTH - _MARGIN)
+   (top, bottom) = (_MARGIN, _HEIGHT - _MARGIN)
+   x_scale = _make_scale(chart["x_vals"], chart.get("x_log", False), left, right)
+   y_scale = _make_scale(chart["y_vals"], chart.get("y_log", False), bottom, top)
+
+   points = []
+   for (x, y) in zip(chart["x_vals"], chart["y_vals"]):
+      (px, py) = (x_scale(x), y_scale(y))
+      if (not px is None) and (not py is None):
+         points.append((px, py))
+   if chart["type"] == "bar":
+      bar_width = max(((right - left) // max(len(points), 1)) - 1, 1)
+      for (px, py) in points:
+         canvas.fill_rect(px - (bar_width // 2), py, px + ((bar_width - 1) // 2), bottom, _PLOT)
+   else:
+      for ((x0, y0), (x1, y1)) in zip(points, points[1:]):
+         canvas.line(x0, y0, x1, y1, _PLOT)
+
+   canvas.line(left, bottom, right, bottom, _AXES)
+   canvas.line(left, bottom, left, top, _AXES)
+   with open(filepath + ".png", "wb") as f:
+      f.write(canvas.to_png())
+   return filepath + ".png"
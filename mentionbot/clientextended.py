@@ -119,25 +119,40 @@ class ClientExtended(discord.Client):
    # Send a message to a channel specified by a Channel, PrivateChannel, Server, or Message object.
    # TODO: Consider renaming this. It's kinda awkward to have both send_msg() and send_message().
    # TODO: self.send_message has other optional parameters. Pls include them somehow...
+   # RETURNS: The Message object of the sent message, or None if it failed to send.
    async def send_msg(self, destination, text):
-      text = "\a" + str(text)
-      text = text.replace("@everyone", "@\aeveryone")
-      text = text.replace("@here", "@\ahere")
-      if len(text) > 2000:
-         text_to_append = "\nSorry m8, can't send more than " + str(self._MESSAGE_MAX_LEN) + " characters."
-         content_len = self._MESSAGE_MAX_LEN - len(text_to_append)
-         text = text[:content_len] + text_to_append
+      text = self._prepare_msg_text(text)
 
       if destination.__class__.__name__ is "Message":
          destination = destination.channel
 
       print("SENDING MESSAGE...")
+      ret = None
       try:
-         await self.send_message(destination, text)
+         ret = await self.send_message(destination, text)
       except:
          print("MESSAGE FAILED TO SEND!!!")
+      return ret
+
+   # Replaces the text of a message sent by send_msg().
+   async def edit_msg(self, message, text):
+      text = self._prepare_msg_text(text)
+      try:
+         await self.edit_message(message, text)
+      except:
+         print("MESSAGE FAILED TO EDIT!!!")
       return
 
+   def _prepare_msg_text(self, text):
+      text = "\a" + str(text)
+      text = text.replace("@everyone", "@\aeveryone")
+      text = text.replace("@here", "@\ahere")
+      if len(text) > 2000:
+         text_to_append = "\nSorry m8, can't send more than " + str(self._MESSAGE_MAX_LEN) + " characters."
+         content_len = self._MESSAGE_MAX_LEN - len(text_to_append)
+         text = text[:content_len] + text_to_append
+      return text
+
    # This method also handles permission issues.
    async def perm_send_file(self, destination, fp, filename=None):
       try:
@@ -0,0 +1,101 @@
+import re
+import collections
+
+# Compiled command dispatch for a server.
+#
+# Each server has a table mapping every top-level command name to whatever
+# handles it: a core command, an installed module (by any of its aliases or
+# top-level shortcuts), and/or a custom command. Custom commands don't shadow
+# core or module commands. If both exist, both are carried out.
+#
+# The table and the regular expressions used to pick the command name out of
+# a message are built once, and only rebuilt when the command prefix,
+# installed modules or custom commands change. Handling a message is then a
+# single regex match and a single dict lookup, rather than splitting and
+# searching the message once per layer.
+#
+# Module subcommands (e.g. "choice" in "/random choice A;B;C") are still
+# resolved by the module, since modules are free to parse them however they
+# like.
+
+# core - A core command function, or None.
+# module - A ServerModuleWrapper, or None.
+# custom - A CustomCommand, or None.
+DispatchEntry = collections.namedtuple("DispatchEntry", ["core", "module", "custom"])
+
+# module - The ServerModuleWrapper of the module that registered the command.
+# handler - Coroutine function, called as handler(substr, msg, cmd_name).
+# help_handler - Coroutine function, called as help_handler(msg, cmd_name)
+#                when someone asks for help on the command.
+CustomCommand = collections.namedtuple("CustomCommand", ["module", "handler", "help_handler"])
+
+class CommandDispatchTable:
+   """
+   A server's compiled table of top-level commands.
+
+   Instances are never modified. To change anything, build a new table.
+   """
+
+   # PARAMETER: cmd_prefix - The server's command prefix.
+   # PARAMETER: bot_user_id - The bot's user ID. Messages beginning with a
+   #                          mention of the bot are also commands.
+   # PARAMETER: core_cmdd - Maps command names to core command functions.
+   # PARAMETER: modules_cmd_dict - Maps command names to module wrappers.
+   # PARAMETER: custom_cmd_dict - Maps command names to CustomCommand objects.
+   def __init__(self, cmd_prefix, bot_user_id, core_cmdd, modules_cmd_dict, custom_cmd_dict):
+      bot_mention = "<@!?" + re.escape(str(bot_user_id)) + ">"
+      # Original content, before it gets passed through module preprocessors.
+      # Custom commands can only be invoked with the prefix.
+      self._re_custom = re.compile(r"\s*" + re.escape(cmd_prefix.strip()) + r"\s*(\S+)\s*(.*?)\s*\Z", re.DOTALL)
+      # Preprocessed content.
+      self._re_command = re.compile("(?:(" + re.escape(cmd_prefix) + ")|" + bot_mention + r")\s*(\S*)\s*(.*?)\s*\Z", re.DOTALL)
+
+      self._table = {}
+      for cmd_name in set(core_cmdd) | set(modules_cmd_dict) | set(custom_cmd_dict):
+         self._table[cmd_name] = DispatchEntry(
+            core=core_cmdd.get(cmd_name),
+            module=modules_cmd_dict.get(cmd_name),
+            custom=custom_cmd_dict.get(cmd_name),
+         )
+      return
+
+   # RETURNS: The DispatchEntry for a top-level command name, or None if
+   #          nothing handles it.
+   def get(self, cmd_name):
+      return self._table.get(cmd_name)
+
+   # Picks a command out of (preprocessed) message content.
+   # Content beginning with a mention of the bot is always a command, which
+   # is useful when multiple bots share the same command prefix. A mention of
+   # the bot on its own is treated as the help command.
+   # RETURNS: A tuple (cmd_name, substr), where substr is everything after
+   #          the command name, or None if the content isn't a command.
+   def parse(self, content):
+      match = self._re_command.match(content)
+      if not match:
+         return None
+      (prefix, cmd_name, substr) = match.groups()
+      if (prefix is None) and (len(cmd_name) == 0):
+         cmd_name = "help"
+      return (cmd_name, substr)
+
+   # Picks a custom command out of a message's original content.
+   # RETURNS: A tuple (custom_cmd, cmd_name, substr, is_help), or None if the
+   #          content isn't a custom command. If is_help is True, the content
+   #          asks for help on the custom command.
+   def parse_custom(self, content):
+      match = self._re_custom.match(content)
+      if not match:
+         return None
+      (cmd_name, substr) = match.groups()
+      is_help = False
+      if cmd_name == "help":
+         is_help = True
+         words = substr.split(maxsplit=1)
+         if len(words) == 0:
+            return None
+         cmd_name = words[0]
+      entry = self._table.get(cmd_name)
+      if (entry is None) or (entry.custom is None):
+         return None
+      return (entry.custom, cmd_name, substr, is_help)
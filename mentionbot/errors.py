@@ -60,6 +60,11 @@ class OperationAborted(CommandHandlingSignal):
    def __init__(self):
       return
 
+# Raised inside an analytics job once it has been cancelled.
+class JobCancelled(OperationAborted):
+   def __init__(self):
+      return
+
 ##################################
 ### General-purpose exceptions ###
 ##################################
@@ -0,0 +1,80 @@
+import asyncio
+import collections
+
+# Ordered event handling, one queue per key (e.g. per server).
+#
+# Events with the same key are handled one at a time, in the order they
+# arrived. Events with different keys are handled independently by their
+# own worker tasks, so a slow handler (e.g. a long-running command) only
+# holds up events with the same key.
+#
+# Workers only exist while their queue has events in it, so idle servers
+# don't keep a task around.
+
+class EventQueues:
+   """
+   Queues event handlers by key, with at most max_concurrent handlers
+   running at once across every key.
+
+   Nothing is handled until set_ready() is called, so events that arrive
+   during initialization are handled (in order) once it's done.
+   """
+
+   # PARAMETER: on_error - Coroutine function called as
+   #                       on_error(event_name, *args) if a handler raises
+   #                       an exception.
+   def __init__(self, max_concurrent, on_error):
+      assert max_concurrent > 0
+      self._semaphore = asyncio.Semaphore(max_concurrent)
+      self._on_error = on_error
+      self._ready = asyncio.Event()
+      self._queues = {} # Maps key -> deque of (event_name, handler, args)
+      self._workers = {} # Maps key -> worker task
+      return
+
+   def set_ready(self):
+      self._ready.set()
+      return
+
+   # Stops handling events (e.g. while the bot is shutting down). Events
+   # are still queued.
+   def clear_ready(self):
+      self._ready.clear()
+      return
+
+   # Queues an event handler, to be called as handler(*args).
+   def put(self, key, event_name, handler, *args):
+      try:
+         queue = self._queues[key]
+      except KeyError:
+         queue = collections.deque()
+         self._queues[key] = queue
+      queue.append((event_name, handler, args))
+      if not key in self._workers:
+         loop = asyncio.get_event_loop()
+         self._workers[key] = loop.create_task(self._worker(key))
+      return
+
+   # RETURNS: Total number of events waiting to be handled.
+   def get_backlog(self):
+      return sum(len(x) for x in self._queues.values())
+
+   async def _worker(self, key):
+      queue = self._queues[key]
+      try:
+         while len(queue) > 0:
+            await self._ready.wait()
+            (event_name, handler, args) = queue.popleft()
+            async with self._semaphore:
+               try:
+                  await handler(*args)
+               except Exception:
+                  await self._on_error(event_name, *args)
+      finally:
+         # Nothing else runs between the queue being found empty and the
+         # worker being removed, so put() either sees the worker or
+         # starts a new one.
+         del self._workers[key]
+         if len(queue) == 0:
+            del self._queues[key]
+      return
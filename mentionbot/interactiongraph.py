@@ -0,0 +1,175 @@
+import collections
+
+try:
+   import numpy as np
+except ImportError:
+   np = None # Falls back to plain Python lists.
+
+from . import utils
+
+# Interaction graph for the convstats command.
+#
+# Users interact when they post in the same channel within a certain
+# timeframe of each other, or when one mentions the other. Each interaction
+# is rated by the length of the message (plus a flat amount for attachments),
+# with mentions multiplied.
+#
+# Interactions are symmetric, so they're accumulated per unordered pair of
+# users (a dict mapping (uid1, uid2) -> rating, where uid1 < uid2), and only
+# made into a matrix at the end.
+
+def _add_pair(pairs, uid1, uid2, interaction_rating):
+   if uid2 < uid1:
+      (uid1, uid2) = (uid2, uid1)
+   key = (uid1, uid2)
+   pairs[key] = pairs.get(key, 0) + interaction_rating
+   return
+
+# Rates interactions between users in a channel.
+# The window holds the users that posted within the timeframe, in order of
+# their last post, so expired users are always at the front.
+# PARAMETER: messages - A channel's messages, in order.
+# RETURNS: A tuple (pairs, warnings), where warnings is a list of strings.
+def channel_interactions(ch_id, messages, timeframe, mention_multiplier, attachments_flat):
+   pairs = {}
+   warnings_buf = []
+   window = collections.OrderedDict() # Maps uid -> last post timestamp
+   prev_timestamp = None # This exists entirely for ensuring correctness.
+   for msg_dict in messages:
+      author_id = msg_dict["a"]
+      content = msg_dict["c"]
+      timestamp = msg_dict["t"]
+
+      if (not prev_timestamp is None) and (prev_timestamp > timestamp):
+         warnings_buf.append("WARNING: prev_timestamp > timestamp.\n")
+         warnings_buf.append("timestamp - prev_timestamp = " + utils.timedelta_to_string(timestamp - prev_timestamp) + "\n")
+         warnings_buf.append("channel " + ch_id + "\n")
+         warnings_buf.append("author " + author_id + "\n")
+         warnings_buf.append("content " + content + "\n")
+      prev_timestamp = timestamp
+
+      interaction_rating = len(content)
+      if (len(msg_dict["h"]) + len(msg_dict["e"])) > 0:
+         interaction_rating += attachments_flat
+      mentions = set(utils.get_all_mentions(content))
+      mentions.discard(author_id)
+
+      # Users that just left the window don't get mention credit either.
+      expired = []
+      while (len(window) > 0) and (timestamp - next(iter(window.values())) > timeframe):
+         expired.append(window.popitem(last=False)[0])
+
+      for (last_uid, last_time) in window.items():
+         if last_uid == author_id:
+            continue
+         multiplier = 1
+         if last_uid in mentions:
+            multiplier = mention_multiplier
+         _add_pair(pairs, author_id, last_uid, interaction_rating * multiplier)
+      # Anyone else who was mentioned now gets interaction rating added as well.
+      for uid in mentions:
+         if (not uid in window) and (not uid in expired):
+            _add_pair(pairs, author_id, uid, interaction_rating * mention_multiplier)
+
+      # Now we add the current message back in.
+      window.pop(author_id, None)
+      window[author_id] = timestamp
+   return (pairs, warnings_buf)
+
+# Merges one dict of pairs into another.
+# RETURNS: The merged dict.
+def merge_pairs(totals, partial):
+   for (key, interaction_rating) in partial.items():
+      totals[key] = totals.get(key, 0) + interaction_rating
+   return totals
+
+class InteractionMatrix:
+   """
+   Symmetric sparse matrix of interactions, in CSR form.
+
+   self.uids[i] is the user of row/column i. Row i's entries are
+   self.indices[self.indptr[i]:self.indptr[i + 1]] (column numbers) and
+   self.data[self.indptr[i]:self.indptr[i + 1]] (values). These are numpy
+   arrays if numpy is available, and lists otherwise.
+   """
+
+   def __init__(self, uids, indptr, indices, data):
+      self.uids = uids
+      self.indptr = indptr
+      self.indices = indices
+      self.data = data
+      return
+
+   @classmethod
+   def from_pairs(cls, pairs):
+      uids = sorted(set(uid for pair in pairs for uid in pair))
+      uid_index = {uid: i for (i, uid) in enumerate(uids)}
+      # COO form first, with both halves of the symmetric matrix.
+      rows = []
+      cols = []
+      data = []
+      for ((uid1, uid2), interaction_rating) in pairs.items():
+         (i, j) = (uid_index[uid1], uid_index[uid2])
+         rows.extend([i, j])
+         cols.extend([j, i])
+         data.extend([interaction_rating, interaction_rating])
+      return cls.from_coo(uids, rows, cols, data)
+
+   @classmethod
+   def from_coo(cls, uids, rows, cols, data):
+      if not np is None:
+         rows = np.array(rows, dtype=np.int64)
+         order = np.lexsort((np.array(cols, dtype=np.int64), rows))
+         indptr = np.zeros(len(uids) + 1, dtype=np.int64)
+         np.cumsum(np.bincount(rows, minlength=len(uids)), out=indptr[1:])
+         indices = np.array(cols, dtype=np.int64)[order]
+         data = np.array(data, dtype=np.float64)[order]
+         return cls(uids, indptr, indices, data)
+      order = sorted(range(len(rows)), key=lambda x: (rows[x], cols[x]))
+      indptr = [0] * (len(uids) + 1)
+      for i in rows:
+         indptr[i + 1] += 1
+      for i in range(len(uids)):
+         indptr[i + 1] += indptr[i]
+      indices = [cols[x] for x in order]
+      data = [data[x] for x in order]
+      return cls(uids, indptr, indices, data)
+
+   # Generator yields (i, j, value) for every entry.
+   def entries(self):
+      for i in range(len(self.uids)):
+         for k in range(self.indptr[i], self.indptr[i + 1]):
+            yield (i, int(self.indices[k]), self.data[k])
+      return
+
+   # Each entry becomes the average of the portions (as a percentage) of
+   # both users' total interactions spent on each other.
+   # RETURNS: A new InteractionMatrix.
+   def portion_averages(self):
+      n = len(self.uids)
+      if not np is None:
+         rows = np.repeat(np.arange(n), np.diff(self.indptr))
+         row_sums = np.bincount(rows, weights=self.data, minlength=n)
+         inverse = np.zeros(n)
+         np.divide(100.0, row_sums, out=inverse, where=(row_sums != 0))
+         data = self.data * (inverse[rows] + inverse[self.indices]) / 2
+         return InteractionMatrix(self.uids, self.indptr, self.indices, data)
+      inverse = []
+      for i in range(n):
+         row_sum = sum(self.data[self.indptr[i]:self.indptr[i + 1]])
+         inverse.append(100.0 / row_sum if row_sum != 0 else 0.0)
+      data = list(self.data)
+      for i in range(n):
+         for k in range(self.indptr[i], self.indptr[i + 1]):
+            data[k] = data[k] * (inverse[i] + inverse[self.indices[k]]) / 2
+      return InteractionMatrix(self.uids, self.indptr, self.indices, data)
+
+   # RETURNS: List of (uid, [(other uid, value), ...]) with up to k of each
+   #          user's highest entries, from the highest.
+   def top_k(self, k):
+      ret = []
+      for i in range(len(self.uids)):
+         (start, end) = (self.indptr[i], self.indptr[i + 1])
+         row = sorted(zip(self.data[start:end], self.indices[start:end]), key=lambda x: -x[0])[:k]
+         ret.append((self.uids[i], [(self.uids[int(j)], value) for (value, j) in row]))
+      return ret
@@ -0,0 +1,252 @@
+import asyncio
+import time
+import datetime
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from . import utils, errors
+
+# Scheduler for heavy analytics commands (e.g. server activity statistics).
+#
+# Jobs are started in the order they were submitted, with at most max_running
+# jobs running at once across the whole bot. Their blocking work runs in the
+# scheduler's own thread pool (of the same size) rather than the event loop's
+# default executor, so analytics can't tie up every thread.
+#
+# Each job posts a single status message, which is edited with the job's
+# progress rather than posting a new message for every update.
+#
+# Jobs are cancelled cooperatively. cancel() only sets a flag, and the job
+# raises errors.JobCancelled the next time it reports its progress.
+
+class Job:
+   """
+   A queued, running or finished job.
+
+   Job functions report their progress through it, which also checks whether
+   the job has been cancelled. Progress can be reported from executor
+   threads.
+   """
+
+   QUEUED = "queued"
+   RUNNING = "running"
+   FINISHED = "finished"
+   CANCELLED = "cancelled"
+   ABORTED = "aborted"
+   FAILED = "failed"
+
+   def __init__(self, scheduler, job_id, key, description, server_id, channel, fn):
+      self.id = job_id
+      self.key = key
+      self.description = description
+      self.server_id = server_id
+      self.channel = channel
+      self.state = self.QUEUED
+
+      self.phase = None # Text describing what the job is currently doing.
+      self.scanned = 0 # Messages (or rollup rows) read so far.
+      self.done = 0 # Out of self.total. Used to work out the ETA.
+      self.total = None
+
+      self.started = None # time.monotonic() values.
+      self.finished = None
+
+      self._scheduler = scheduler
+      self._fn = fn
+      self._cancelled = False
+      self._status_msg = None
+      return
+
+   def is_cancelled(self):
+      return self._cancelled
+
+   # Raises errors.JobCancelled if the job has been cancelled.
+   def check_cancelled(self):
+      if self._cancelled:
+         raise errors.JobCancelled
+      return
+
+   def set_phase(self, text):
+      self.phase = text
+      self.check_cancelled()
+      return
+
+   # PARAMETER: scanned - Number of messages read since the last call.
+   def add_scanned(self, scanned):
+      self.scanned += scanned
+      self.check_cancelled()
+      return
+
+   # PARAMETER: done - How much of the job is done, out of total, in any
+   #                   unit (e.g. messages or channels).
+   def set_progress(self, done, total):
+      self.done = done
+      self.total = total
+      self.check_cancelled()
+      return
+
+   # Same as set_progress(), but counted in messages, which also count as
+   # scanned. Can be passed to MessageCache.map_reduce() as its progress
+   # callback.
+   def set_messages_progress(self, done, total):
+      self.scanned = done
+      self.set_progress(done, total)
+      return
+
+   # Runs a blocking function in the scheduler's thread pool.
+   async def run_in_executor(self, fn, *args):
+      loop = asyncio.get_event_loop()
+      return await loop.run_in_executor(self._scheduler.executor, fn, *args)
+
+   def get_status_str(self):
+      buf = "**Job #{}** (`{}`) - {}".format(str(self.id), self.description, self.state)
+      if self.state == self.QUEUED:
+         position = self._scheduler.get_queue_position(self)
+         if not position is None:
+            buf += " (position {} in queue)".format(str(position + 1))
+         return buf
+      now = time.monotonic()
+      if not self.finished is None:
+         now = self.finished
+      elapsed = now - self.started
+      if self.state == self.RUNNING:
+         if not self.phase is None:
+            buf += ": " + self.phase
+      else:
+         buf += " after " + utils.timedelta_to_string(datetime.timedelta(seconds=int(elapsed)))
+      if self.scanned > 0:
+         buf += "\n{:,} messages scanned".format(self.scanned)
+         if elapsed > 0:
+            buf += " ({:,}/s)".format(int(self.scanned / elapsed))
+      if (self.state == self.RUNNING) and (not self.total is None):
+         buf += "\n{:,}/{:,} done".format(self.done, self.total)
+         if (self.done > 0) and (elapsed > 0):
+            remaining = elapsed * (self.total - self.done) / self.done
+            buf += ", ETA " + utils.timedelta_to_string(datetime.timedelta(seconds=int(remaining)))
+      return buf
+
+class JobScheduler:
+   _STATUS_INTERVAL = 5 # Seconds between edits of a job's status message.
+   _FINISHED_JOBS_KEPT = 20 # Number of finished jobs still listed by get_jobs().
+
+   def __init__(self, client, max_running):
+      assert max_running > 0
+      self._client = client
+      self._max_running = max_running
+      self.executor = ThreadPoolExecutor(max_workers=max_running)
+
+      self._next_id = 1
+      self._queued = collections.deque() # Jobs waiting to start, in order.
+      self._running = collections.OrderedDict() # Maps job ID -> running job
+      self._finished = collections.deque(maxlen=self._FINISHED_JOBS_KEPT)
+      return
+
+   # Queues a job, and posts its status message.
+   # PARAMETER: key - If not None, a hashable value identifying what the job
+   #                  does. If a job with an equal key (and from the same
+   #                  server) is still queued or running, that job is used
+   #                  instead of queueing a new one.
+   # PARAMETER: description - Short description of the job, e.g. the command.
+   # PARAMETER: channel - Channel to post the status message in.
+   # PARAMETER: fn - Coroutine function doing the job, called as fn(job).
+   # RETURNS: A tuple (job, is_new). If is_new is False, the job is an
+   #          identical job that was already queued or running.
+   async def submit(self, key, description, server_id, channel, fn):
+      if not key is None:
+         for job in self._iter_unfinished():
+            if (job.server_id == server_id) and (job.key == key):
+               buf = "An identical job (#{}) is already {}. Its results will be posted in <#{}>."
+               await self._client.send_msg(channel, buf.format(str(job.id), job.state, job.channel.id))
+               return (job, False)
+      job = Job(self, self._next_id, key, description, server_id, channel, fn)
+      self._next_id += 1
+      self._queued.append(job)
+      job._status_msg = await self._client.send_msg(channel, job.get_status_str())
+      self._start_queued()
+      return (job, True)
+
+   # Cancels a queued or running job.
+   # PARAMETER: server_id - If not None, only jobs from this server can be
+   #                        cancelled.
+   # RETURNS: True if the job was found.
+   def cancel(self, job_id, server_id=None):
+      for job in self._iter_unfinished():
+         if (job.id != job_id) or ((not server_id is None) and (job.server_id != server_id)):
+            continue
+         if job.state == Job.QUEUED:
+            self._queued.remove(job)
+            job.state = Job.CANCELLED
+            job.started = job.finished = time.monotonic()
+            self._finished.append(job)
+            asyncio.get_event_loop().create_task(self._update_status(job))
+         else:
+            job._cancelled = True
+         return True
+      return False
+
+   # RETURNS: List of running, queued, then recently finished jobs.
+   # PARAMETER: server_id - If not None, only jobs from this server are listed.
+   def get_jobs(self, server_id=None):
+      jobs = list(self._iter_unfinished()) + list(reversed(self._finished))
+      if not server_id is None:
+         jobs = [x for x in jobs if x.server_id == server_id]
+      return jobs
+
+   # RETURNS: Number of jobs ahead of a job in the queue, or None if it's not
+   #          queued.
+   def get_queue_position(self, job):
+      try:
+         return self._queued.index(job)
+      except ValueError:
+         return None
+
+   def _iter_unfinished(self):
+      yield from self._running.values()
+      yield from self._queued
+      return
+
+   def _start_queued(self):
+      loop = asyncio.get_event_loop()
+      while (len(self._running) < self._max_running) and (len(self._queued) > 0):
+         job = self._queued.popleft()
+         job.state = Job.RUNNING
+         job.started = time.monotonic()
+         self._running[job.id] = job
+         loop.create_task(self._run(job))
+      return
+
+   async def _run(self, job):
+      loop = asyncio.get_event_loop()
+      status_task = loop.create_task(self._status_loop(job))
+      try:
+         await job._fn(job)
+         job.state = Job.FINISHED
+      except errors.JobCancelled:
+         job.state = Job.CANCELLED
+      except errors.OperationAborted:
+         job.state = Job.ABORTED
+      except Exception as e:
+         job.state = Job.FAILED
+         await self._client.report_exception(e, handled_by="JobScheduler._run().")
+      finally:
+         status_task.cancel()
+         job.finished = time.monotonic()
+         del self._running[job.id]
+         self._finished.append(job)
+         self._start_queued()
+      await self._update_status(job)
+      # Queued jobs have moved up.
+      for queued_job in list(self._queued):
+         await self._update_status(queued_job)
+      return
+
+   async def _status_loop(self, job):
+      while True:
+         await self._update_status(job)
+         await asyncio.sleep(self._STATUS_INTERVAL)
+      return
+
+   async def _update_status(self, job):
+      if not job._status_msg is None:
+         await self._client.edit_msg(job._status_msg, job.get_status_str())
+      return
@@ -14,10 +14,12 @@ from concurrent.futures import ThreadPoolExecutor
 import discord # pip install git+https://github.com/Rapptz/discord.py@async
 # pip install git+https://github.com/Julian/jsonschema
 
-from . import utils, errors, clientextended
+from . import utils, errors, clientextended, messageexport
 
 from .serverbotinstance import ServerBotInstance
 from .messagecache import MessageCache
+from .jobscheduler import JobScheduler
+from .eventqueues import EventQueues
 
 discord_logger = logging.getLogger("discord")
 discord_logger.setLevel(logging.CRITICAL)
@@ -33,16 +35,16 @@ class MentionBot(clientextended.ClientExtended):
 
       super(MentionBot, self).__init__(**kwargs)
 
-      self.on_message_lock = asyncio.Lock()
-      self.on_member_join_lock = asyncio.Lock()
-      self.on_member_remove_lock = asyncio.Lock()
-      self.on_member_ban_lock = asyncio.Lock()
-      self.on_member_unban_lock = asyncio.Lock()
-      self.on_member_update_lock = asyncio.Lock()
-
       self._conf = kwargs["config_dict"]
       assert isinstance(self._conf, dict)
 
+      # Events are handled in order for each server (or each channel, for
+      # messages), rather than in order across the whole bot. Nothing is
+      # handled until initialization is done.
+      self._per_channel_events = (self._conf["misc"]["event_serialization"] == "channel")
+      max_handlers = self._conf["misc"]["max_concurrent_event_handlers"]
+      self._event_queues = EventQueues(max_handlers, self.on_error)
+
       # This MUST end with a forward-slash. e.g. "cache/"
       self._cache_dirname = self._conf["filenames"]["cache_folder"] + "/"
       assert utils.is_safe_directory_name(self._cache_dirname[:-1])
@@ -59,11 +61,13 @@ class MentionBot(clientextended.ClientExtended):
       self._bot_owner_obj = None
 
       self._bot_instances = None
+      self.message_cache = None
+      self.job_scheduler = JobScheduler(self, self._conf["misc"]["max_analytics_jobs"])
       return
 
    async def on_ready(self):
       if not self._allow_on_ready:
-         await self.acquire_all_locks()
+         self._event_queues.clear_ready()
          await self.send_owner_msg("Attempted to re-initialize. Killing the process.")
          sys.exit(1)
 
@@ -104,7 +108,7 @@ class MentionBot(clientextended.ClientExtended):
          print("Bot name: " + self.user.name)
          print("")
 
-         self.release_all_locks()
+         self._event_queues.set_ready()
 
          if self._message_bot_owner_on_init:
             try:
@@ -146,17 +150,38 @@ class MentionBot(clientextended.ClientExtended):
          logging.critical(buf)
       sys.exit(1)
 
+   # Messages are cached as soon as they arrive (once the cache exists),
+   # rather than waiting for their server's queue.
    async def on_message(self, msg):
-      await self.on_message_lock.acquire()
-      try:
-         await self._on_message(msg)
-      finally:
-         self.on_message_lock.release()
+      recorded = False
+      if not self.message_cache is None:
+         await self.message_cache.record_message(msg)
+         recorded = True
+      key = None # Private messages
+      if isinstance(msg.channel, discord.Channel):
+         key = msg.server.id
+         if self._per_channel_events:
+            key = (msg.server.id, msg.channel.id)
+      self._event_queues.put(key, "on_message", self._on_message, msg, recorded)
       return
 
-   # TODO: Ensure this method actually lets in messages in a queued fashion...
-   async def _on_message(self, msg):
-      await self.message_cache.record_message(msg)
+   async def on_message_edit(self, before, after):
+      if self.message_cache is None:
+         return # Not initialized yet.
+      await self.message_cache.record_edit(after)
+      return
+
+   async def on_message_delete(self, msg):
+      if self.message_cache is None:
+         return # Not initialized yet.
+      await self.message_cache.record_delete(msg)
+      return
+
+   # PARAMETER: recorded - False if the message arrived before the message
+   #                       cache existed, and still needs to be recorded.
+   async def _on_message(self, msg, recorded):
+      if not recorded:
+         await self.message_cache.record_message(msg)
       if msg.author == self.user:
          return # Should no longer process own messages.
 
@@ -216,11 +241,7 @@ class MentionBot(clientextended.ClientExtended):
 
 
    async def on_member_join(self, member):
-      await self.on_member_join_lock.acquire()
-      try:
-         await self._on_member_join(member)
-      finally:
-         self.on_member_join_lock.release()
+      self._event_queues.put(member.server.id, "on_member_join", self._on_member_join, member)
       return
    async def _on_member_join(self, member):
       await self._bot_instances[member.server].on_member_join(member)
@@ -228,11 +249,7 @@ class MentionBot(clientextended.ClientExtended):
 
 
    async def on_member_remove(self, member):
-      await self.on_member_remove_lock.acquire()
-      try:
-         await self._on_member_remove(member)
-      finally:
-         self.on_member_remove_lock.release()
+      self._event_queues.put(member.server.id, "on_member_remove", self._on_member_remove, member)
       return
    async def _on_member_remove(self, member):
       await self._bot_instances[member.server].on_member_remove(member)
@@ -240,11 +257,7 @@ class MentionBot(clientextended.ClientExtended):
 
 
    async def on_member_ban(self, member):
-      await self.on_member_ban_lock.acquire()
-      try:
-         await self._on_member_ban(member)
-      finally:
-         self.on_member_ban_lock.release()
+      self._event_queues.put(member.server.id, "on_member_ban", self._on_member_ban, member)
       return
    async def _on_member_ban(self, member):
       await self._bot_instances[member.server].on_member_ban(member)
@@ -252,11 +265,7 @@ class MentionBot(clientextended.ClientExtended):
 
 
    async def on_member_unban(self, server, user):
-      await self.on_member_unban_lock.acquire()
-      try:
-         await self._on_member_unban(server, user)
-      finally:
-         self.on_member_unban_lock.release()
+      self._event_queues.put(server.id, "on_member_unban", self._on_member_unban, server, user)
       return
    async def _on_member_unban(self, server, user):
       await self._bot_instances[server].on_member_unban(user)
@@ -264,11 +273,7 @@ class MentionBot(clientextended.ClientExtended):
 
 
    async def on_member_update(self, before, after):
-      await self.on_member_update_lock.acquire()
-      try:
-         await self._on_member_update(before, after)
-      finally:
-         self.on_member_update_lock.release()
+      self._event_queues.put(before.server.id, "on_member_update", self._on_member_update, before, after)
       return
    async def _on_member_update(self, before, after):
       server = before.server
@@ -415,33 +420,37 @@ class MentionBot(clientextended.ClientExtended):
          sys.exit(1)
       return buf
 
-   def message_cache_read(self, server_id, ch_id):
-      return self.message_cache.read_messages(server_id, ch_id)
+   def message_cache_read(self, server_id, ch_id, since=None, until=None, authors=None):
+      return self.message_cache.read_messages(server_id, ch_id, since=since, until=until, authors=authors)
+
+   async def message_cache_map_reduce(self, server_id, channel_ids, mapper, reducer, **kwargs):
+      return await self.message_cache.map_reduce(server_id, channel_ids, mapper, reducer, **kwargs)
+
+   def message_cache_read_rollup(self, server_id, ch_id):
+      return self.message_cache.read_rollup(server_id, ch_id)
+
+   def message_cache_read_rollup_columns(self, server_id, ch_id):
+      return self.message_cache.read_rollup_columns(server_id, ch_id)
+
+   def message_cache_get_watermark(self, server_id, ch_id):
+      return self.message_cache.get_watermark(server_id, ch_id)
+
+   # Exports cached messages or rollups to a file. (See messageexport.export().)
+   # This blocks, so it should be run in an executor.
+   def message_cache_export(self, filepath, server_id, **kwargs):
+      return messageexport.export(self.message_cache, filepath, server_id, **kwargs)
 
    def message_cache_debug_str(self):
       return self.message_cache.get_debugging_info()
 
-   async def acquire_all_locks(self):
-      await self.on_message_lock.acquire()
-      await self.on_member_join_lock.acquire()
-      await self.on_member_remove_lock.acquire()
-      await self.on_member_ban_lock.acquire()
-      await self.on_member_unban_lock.acquire()
-      await self.on_member_update_lock.acquire()
-      return
+   def message_cache_compaction_str(self):
+      return self.message_cache.get_compaction_info()
 
-   def release_all_locks(self):
-      self.on_message_lock.release()
-      self.on_member_join_lock.release()
-      self.on_member_remove_lock.release()
-      self.on_member_ban_lock.release()
-      self.on_member_unban_lock.release()
-      self.on_member_update_lock.release()
+   def message_cache_request_compaction(self):
+      self.message_cache.request_compaction()
       return
 
 async def _client_login(client, token):
-   await client.acquire_all_locks()
-   # TODO: Acquire the lock elsewhere. It's a little out-of-place here...
    await client.login(token)
    await client.connect()
    return
@@ -462,6 +471,11 @@ def run(config_dict):
       print("Error launching client!")
       print(traceback.format_exc(), file=sys.stderr)
    finally:
+      try:
+         if not client.message_cache is None:
+            loop.run_until_complete(client.message_cache.shutdown_flush())
+      except:
+         print(traceback.format_exc(), file=sys.stderr)
       try:
          loop.close()
       except:
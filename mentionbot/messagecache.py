@@ -1,222 +1,954 @@
 import asyncio
 import re
+import bisect
 import datetime
 import os
+import sys
 import copy
+import json
+import itertools
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import discord
 import dateutil.parser
 
-from . import utils
-
-ARBITRARILY_LARGE_NUMBER = 10000000000000
+from . import utils, messagesegment, messagerollup
 
 class MessageCache:
    _SECRET_TOKEN = utils.SecretToken()
 
    _CH_JSON_FILENAME = "channel.json"
+   _FORMAT_JSON_FILENAME = "format.json"
+   _WAL_FILENAME = "wal.log"
+   _DELTAS_FILENAME = "deltas.log"
+   _ROLLUP_FILENAME = "rollup.json"
+
+   _BACKFILL_CONCURRENCY = 4 # Maximum number of channels backfilled at once.
+   _BACKFILL_PAGE_SIZE = 100 # Maximum allowed by the Discord API.
+   _BACKFILL_RETRIES = 3 # Times a channel's backfill is resumed after an HTTP error.
+   _BACKFILL_RETRY_DELAY = 30 # Seconds, multiplied by the number of the retry.
+
+   _FLUSH_MESSAGES = 200 # Buffered messages per segment file.
+   _FLUSH_MAX_AGE = 30 * 60 # Seconds a message may stay buffered before being flushed anyway.
+   _FLUSH_CHECK_INTERVAL = 60 # Seconds
+   _SHUTDOWN_FLUSH_TIMEOUT = 30 # Seconds
+
+   _COMPACT_TARGET_MESSAGES = 20000 # Maximum messages per compacted segment.
+   _COMPACT_INTERVAL = 6 * 60 * 60 # Seconds between compactor runs.
+   _COMPACT_GRACE = 10 * 60 # Seconds before replaced segment files are deleted.
+
+   _ROLLUP_SAVE_INTERVAL = 10 * 60 # Seconds between saving changed rollups.
 
    @classmethod
    async def get_instance(cls, client, cache_directory):
       self = cls(cls._SECRET_TOKEN)
       self._client = client
+      self._read_only = False # See get_offline_instance().
       self._data_dir = cache_directory + "messagecache/"
       self._messages_before_initialization = []
+
+      self._migrate_legacy_json()
       
       self._data = {}
       # A tree of dictionaries in this arrangement:
       # server_id -> channel_id -> list of messages stored in tuples
       # Each message entry is a tuple.
 
-      print("Caching messages...")
-      print("This will take a while if a lot of messages are being read.")
-      await self._fill_buffers()
+      # Segment files are written by a single background thread, so the hot
+      # message path never waits on the disk.
+      self._writer = ThreadPoolExecutor(max_workers=1)
+      self._write_tasks = set() # Tasks waiting for the writer thread.
+      self._flush_event = asyncio.Event() # Set to wake up the flusher early.
+
+      self._manifests = {}
+      # Maps (server_id, channel_id) -> manifest dict. (See _get_manifest().)
+      self._manifests_dirty = set() # Keys of manifests with an unsaved edit generation.
+      self._in_flight = {}
+      # Maps (server_id, channel_id) -> list of (file number, message dicts)
+      # tuples that have been split off the buffers but not yet written.
+      self._buffer_times = {}
+      # Maps (server_id, channel_id) -> time.monotonic() of when the oldest
+      # message in that channel's buffer was buffered.
+      self._ch_locks = {}
+      # Maps (server_id, channel_id) -> threading.Lock, guarding the manifest
+      # and in-flight list since they're also updated from the writer thread.
+      self._rollups = {}
+      # Maps (server_id, channel_id) -> messagerollup.ChannelRollup of the
+      # channel's segment files. (See _get_rollup().)
+      self._rollups_dirty = set() # Keys of rollups changed since they were last saved.
+
+      self._wal_files = {}
+      # Maps (server_id, channel_id) -> file object of the channel's write-ahead
+      # log, opened for appending. (See _wal_append().)
+      self._deltas = {}
+      # Maps (server_id, channel_id) -> dict of edits and deletions not yet
+      # merged into segment files. (See _get_deltas().)
+      self._delta_files = {}
+      # Maps (server_id, channel_id) -> file object of the channel's delta log,
+      # opened for appending.
+
+      self._backfill_pending = {}
+      # Maps (server_id, channel_id) -> list of message dicts received live
+      # while that channel is still being backfilled.
+      self._backfill_gaps = set()
+      # Set of (server_id, channel_id) whose backfill failed. Live messages
+      # in these channels are dropped, since they'd be cached after the
+      # messages that couldn't be fetched. (See _drop_backfill_pending().)
+      for server in self._client.servers:
+         for ch in server.channels:
+            if ch.type is discord.ChannelType.voice:
+               continue
+            self._backfill_pending[(server.id, ch.id)] = []
+            self._get_manifest(server.id, ch.id)
+            self._replay_wal(server.id, ch.id)
+
+      print("Caching messages in the background...")
+      loop = asyncio.get_event_loop()
+      self._backfill_task = loop.create_task(self._fill_buffers())
+      self._flush_task = loop.create_task(self._flush_loop())
+
+      self._compact_event = asyncio.Event() # Set to run the compactor early.
+      self._compacting = False
+      self._compact_stats = None # Results of the last compactor run.
+      self._compact_task = loop.create_task(self._compact_loop())
+      self._rollup_task = loop.create_task(self._rollup_loop())
+
+      self._process_pool = None # Created when first needed by map_reduce().
+      self._process_pool_unavailable = False
+      self._active_readers = 0 # Number of readers holding a snapshot.
+      self._readers_lock = threading.Lock()
       
       # print(self.get_debugging_info())
       return self
 
+   # Opens a message cache for reading only, with the bot offline (e.g. for
+   # exporting messages from the command line). Nothing is backfilled,
+   # flushed or compacted, and write-ahead logs are read without being
+   # replayed, so messages that were still buffered are read as well.
+   # Nothing on disk is changed either. (Manifests of channels cached by an
+   # older version are only built in memory, and replaced segment files
+   # aren't deleted.)
+   # The bot must not be running.
+   @classmethod
+   def get_offline_instance(cls, cache_directory):
+      self = cls(cls._SECRET_TOKEN)
+      self._client = None
+      self._read_only = True
+      self._data_dir = cache_directory + "messagecache/"
+      self._data = {}
+      self._manifests = {}
+      self._manifests_dirty = set()
+      self._in_flight = {}
+      self._buffer_times = {}
+      self._ch_locks = {}
+      self._rollups = {}
+      self._rollups_dirty = set()
+      self._wal_files = {}
+      self._deltas = {}
+      self._delta_files = {}
+      self._backfill_pending = {}
+      self._backfill_gaps = set()
+      self._process_pool = None
+      self._process_pool_unavailable = False
+      self._active_readers = 0
+      self._readers_lock = threading.Lock()
+      for server_id in self.get_cached_server_ids():
+         for ch_id in self.get_cached_channel_ids(server_id):
+            buffered = self._read_wal(server_id, ch_id)
+            if not buffered is None:
+               self._get_ch_buffer(server_id, ch_id).extend(buffered)
+      return self
+
    def __init__(self, token):
       if not token is self._SECRET_TOKEN:
          raise RuntimeError("Not allowed to instantiate directly. Please use get_instance().")
       return
 
+   # RETURNS: List of IDs of every server with a directory in the cache.
+   def get_cached_server_ids(self):
+      try:
+         names = os.listdir(self._data_dir)
+      except FileNotFoundError:
+         return []
+      return sorted(x for x in names if os.path.isdir(self._data_dir + x))
+
+   # RETURNS: List of IDs of every channel of a server with a directory in
+   #          the cache, including channels the bot can no longer see.
+   def get_cached_channel_ids(self, server_id):
+      server_dir = self._data_dir + server_id + "/"
+      try:
+         names = os.listdir(server_dir)
+      except FileNotFoundError:
+         return []
+      return sorted(x for x in names if os.path.isdir(server_dir + x))
+
    # PRECONDITION: Currently not operating on the buffers.
    async def record_message(self, msg):
       if not isinstance(msg.channel, discord.Channel):
          return # Never caches private messages.
+      if (msg.server.id, msg.channel.id) in self._backfill_gaps:
+         return # Fetched again by the next backfill.
 
-      ch_dict = None
       try:
-         ch_dict = self._data[msg.server.id]
+         pending = self._backfill_pending[(msg.server.id, msg.channel.id)]
+         pending.append(self._message_dict(msg))
+         return # Merged in once the channel's backfill is done.
       except KeyError:
-         ch_dict = {}
-         self._data[msg.server.id] = ch_dict
+         pass
+
+      msg_dict = self._message_dict(msg)
+      ch_list = self._get_ch_buffer(msg.server.id, msg.channel.id)
+      if len(ch_list) == 0:
+         self._buffer_times[(msg.server.id, msg.channel.id)] = time.monotonic()
+      ch_list.append(msg_dict)
+      self._wal_append(msg.server.id, msg.channel.id, msg_dict)
+
+      # Wake up the flusher if buffer is large enough.
+      if len(ch_list) >= self._FLUSH_MESSAGES:
+         self._flush_event.set()
+
+      return
 
-      ch_list = None
+   # Records an edit to a message.
+   # Messages still in the buffers are simply replaced. Messages already
+   # written (or being written) get a patch in the channel's delta log.
+   async def record_edit(self, msg):
+      if not isinstance(msg.channel, discord.Channel):
+         return
+      self._bump_edit_generation(msg.server.id, msg.channel.id)
+      msg_dict = self._message_dict(msg)
+      if self._replace_buffered(msg.server.id, msg.channel.id, msg.id, msg_dict):
+         return
+      patch = {k: msg_dict[k] for k in self._PATCHABLE_FIELDS}
+      self._delta_append(msg.server.id, msg.channel.id, int(msg.id), patch)
+      return
+
+   # Records the deletion of a message.
+   # Messages still in the buffers are simply removed. Messages already
+   # written (or being written) get a tombstone in the channel's delta log.
+   async def record_delete(self, msg):
+      if not isinstance(msg.channel, discord.Channel):
+         return
+      self._bump_edit_generation(msg.server.id, msg.channel.id)
+      if self._replace_buffered(msg.server.id, msg.channel.id, msg.id, None):
+         return
+      self._delta_append(msg.server.id, msg.channel.id, int(msg.id), None)
+      return
+
+   # Replaces (or removes, if msg_dict is None) a message in a channel's
+   # buffer or backfill pending list.
+   # RETURNS: True if the message was found.
+   def _replace_buffered(self, server_id, ch_id, msg_id, msg_dict):
+      key = (server_id, ch_id)
+      found = False
+      for ch_list in [self._backfill_pending.get(key, []), self._data.get(server_id, {}).get(ch_id, [])]:
+         for i in range(len(ch_list) - 1, -1, -1):
+            if ch_list[i]["i"] == msg_id:
+               if msg_dict is None:
+                  del ch_list[i]
+               else:
+                  ch_list[i] = msg_dict
+               found = True
+               break
+      if found:
+         if not key in self._backfill_pending:
+            if msg_dict is None:
+               self._wal_append(server_id, ch_id, {"i": msg_id, "d": 1})
+            else:
+               self._wal_append(server_id, ch_id, msg_dict)
+         return True
+      # Messages after the high-water mark that aren't buffered haven't been
+      # fetched by the backfill yet, so it'll get them as they are now.
+      if int(msg_id) > self._get_ch_high_water(server_id, ch_id):
+         with self._get_ch_lock(server_id, ch_id):
+            in_flight = self._in_flight.get(key, [])
+            if not any(int(msg_id) <= int(x[1][-1]["i"]) for x in in_flight):
+               return True
+      return False
+
+   # Counts an edit or deletion in the channel's manifest, so that
+   # get_watermark() changes even if the last message stays the same.
+   # It's saved along with the manifest the next time the writer thread saves
+   # it anyway, or by _save_dirty_manifests().
+   def _bump_edit_generation(self, server_id, ch_id):
+      manifest = self._get_manifest(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         manifest["edit generation"] = manifest.get("edit generation", 0) + 1
+         self._manifests_dirty.add((server_id, ch_id))
+      return
+
+   # Returns a value that changes whenever the messages that would be read
+   # from a channel change, so results computed from a channel's messages can
+   # be cached until it does.
+   # Messages are only ever added after the last message, and every edit or
+   # deletion bumps the channel's edit generation, so the watermark is the
+   # ID of the last cached message (including buffered messages) along with
+   # the edit generation. Both persist across restarts.
+   # The timestamp of the last message is also returned, since later
+   # messages can't be any earlier than it.
+   # RETURNS: A tuple (last message ID, edit generation, last message
+   #          timestamp). The timestamp is None if the channel is empty.
+   def get_watermark(self, server_id, ch_id):
+      manifest = self._get_manifest(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         last_id = manifest.get("last message id", "0")
+         last_timestamp = manifest.get("last message timestamp", None)
+         if not last_timestamp is None:
+            last_timestamp = self._naive_utc(last_timestamp)
+         in_flight = self._in_flight.get((server_id, ch_id), [])
+         if len(in_flight) > 0:
+            last_id = in_flight[-1][1][-1]["i"]
+            last_timestamp = in_flight[-1][1][-1]["t"]
+         edit_generation = manifest.get("edit generation", 0)
       try:
-         ch_list = ch_dict[msg.channel.id]
+         buffered = self._data[server_id][ch_id]
+         if len(buffered) > 0:
+            last_id = buffered[-1]["i"]
+            last_timestamp = buffered[-1]["t"]
       except KeyError:
-         ch_list = []
-         ch_dict[msg.channel.id] = ch_list
+         pass
+      return (last_id, edit_generation, last_timestamp)
+
+   # Generator reads cached messages from a channel, starting from the earliest.
+   # Messages read from disk are yielded as messagesegment.MessageView objects,
+   # which only decode the fields that are actually accessed. They must not be
+   # kept beyond the loop iteration that produced them. (Use to_dict() if
+   # the message needs to be kept.)
+   # PARAMETER: since - If not None, only messages with a timestamp at or after
+   #                    this (naive UTC) datetime are read.
+   # PARAMETER: until - If not None, only messages with a timestamp before this
+   #                    (naive UTC) datetime are read.
+   # PARAMETER: authors - If not None, an iterable of user IDs. Only messages
+   #                      by these users are read.
+   # Segment files that can't contain any matching message are skipped
+   # entirely using the segment index.
+   def read_messages(self, server_id, ch_id, since=None, until=None, authors=None):
+      if (since is None) and (until is None) and (authors is None):
+         yield from self._read_all_messages(server_id, ch_id)
+         return
+
+      since_us = None
+      if not since is None:
+         since_us = messagesegment.datetime_to_epoch_us(since)
+      until_us = None
+      if not until is None:
+         until_us = messagesegment.datetime_to_epoch_us(until)
+      author_strs = None
+      author_ints = None
+      if not authors is None:
+         author_strs = set(str(x) for x in authors)
+         author_ints = set(int(x) for x in author_strs)
+
+      def in_range(epoch_us):
+         if (not since_us is None) and (epoch_us < since_us):
+            return False
+         if (not until_us is None) and (epoch_us >= until_us):
+            return False
+         return True
+
+      self._reader_started()
+      try:
+         (segments, in_flight, buffered, deltas) = self._snapshot(server_id, ch_id)
+         ch_dir = self._get_ch_dir(server_id, ch_id)
 
-      ch_list.append(self._message_dict(msg))
+         def read_segments():
+            for entry in segments:
+               if not messagesegment.index_may_match(entry, since_us, until_us, author_strs):
+                  continue
+               filepath = ch_dir + str(entry["n"]) + messagesegment.SEGMENT_EXT
+               segment = messagesegment.SegmentView(filepath)
+               with segment:
+                  for i in range(len(segment)):
+                     if not in_range(segment.get_int("t", i)):
+                        continue
+                     if (not author_ints is None) and (not segment.get_int("a", i) in author_ints):
+                        continue
+                     yield messagesegment.MessageView(segment, i)
+            return
 
-      # Move to file if buffer is large enough.
-      if len(self._data[msg.server.id][msg.channel.id]) >= 200:
-         self._move_to_disk(msg.server.id, msg.channel.id)
+         def filter_dicts(msg_dicts):
+            for msg_dict in msg_dicts:
+               if not in_range(messagesegment.datetime_to_epoch_us(msg_dict["t"])):
+                  continue
+               if (not author_strs is None) and (not msg_dict["a"] in author_strs):
+                  continue
+               yield msg_dict
+            return
 
+         yield from self._apply_deltas(read_segments(), deltas)
+         yield from self._apply_deltas(filter_dicts(itertools.chain(*in_flight)), deltas)
+         yield from filter_dicts(buffered)
+      finally:
+         self._reader_finished()
       return
 
-   # Generator reads cached messages from a channel, starting from the earliest.
-   def read_messages(self, server_id, ch_id):
-      ch_dir = self._get_ch_dir(server_id, ch_id)
+   def _read_all_messages(self, server_id, ch_id):
+      self._reader_started()
+      try:
+         (segments, in_flight, buffered, deltas) = self._snapshot(server_id, ch_id)
+         ch_dir = self._get_ch_dir(server_id, ch_id)
 
-      file_number = 0
-      while True:
-         file_number += 1
-         file_contents = None
+         def read_segments():
+            for entry in segments:
+               filepath = ch_dir + str(entry["n"]) + messagesegment.SEGMENT_EXT
+               segment = messagesegment.SegmentView(filepath)
+               with segment:
+                  for i in range(len(segment)):
+                     yield messagesegment.MessageView(segment, i)
+            return
+
+         yield from self._apply_deltas(read_segments(), deltas)
+
+         # After having read all files, output messages still being written,
+         # then buffered messages.
+         yield from self._apply_deltas(itertools.chain(*in_flight), deltas)
+         yield from buffered
+      finally:
+         self._reader_finished()
+      return
+
+   # Generator applies a channel's deltas (edits and deletions) to messages
+   # read from segment files or in-flight chunks.
+   # Edited messages are yielded as message dicts.
+   @classmethod
+   def _apply_deltas(cls, messages, deltas):
+      if len(deltas) == 0:
+         yield from messages
+         return
+      for msg in messages:
+         msg_id = None
+         if isinstance(msg, messagesegment.MessageView):
+            msg_id = msg.id_int
+         else:
+            msg_id = int(msg["i"])
+         try:
+            patch = deltas[msg_id]
+         except KeyError:
+            yield msg
+            continue
+         if patch is None:
+            continue # Deleted
+         if isinstance(msg, messagesegment.MessageView):
+            msg = msg.to_dict()
+         else:
+            msg = copy.copy(msg)
+         msg.update(patch)
+         yield msg
+      return
+
+   # Runs a function over the cached messages of several channels in a pool of
+   # worker processes, and combines the results.
+   # Segment files are read inside the workers. Only the buffered tail of each
+   # channel is sent to them from this process.
+   # PARAMETER: mapper - Called as mapper(ch_id, messages, *mapper_args) for
+   #                     each shard, where messages iterates over messages in
+   #                     the same way as read_messages(). Since it runs in
+   #                     another process, it must be a module-level function,
+   #                     and both mapper_args and the return value must be
+   #                     picklable.
+   # PARAMETER: reducer - Called as reducer(accumulated, partial) in this
+   #                      process with each shard's result (in no particular
+   #                      order), returning the new accumulated value.
+   # PARAMETER: initial - The initial accumulated value.
+   # PARAMETER: split_segments - If False, each channel is a shard, and the
+   #                             mapper sees all of its messages in order. If
+   #                             True, each segment file is its own shard,
+   #                             which spreads the work more evenly.
+   # PARAMETER: progress - If not None, called as progress(messages_done,
+   #                       messages_total) each time a shard is reduced.
+   # RETURNS: The final accumulated value.
+   async def map_reduce(self, server_id, channel_ids, mapper, reducer, initial=None, mapper_args=(), split_segments=False, progress=None):
+      ext = messagesegment.SEGMENT_EXT
+      shards = [] # List of (ch_id, filepaths, tail, deltas)
+      shard_sizes = [] # Number of messages in each shard (before deltas).
+      accumulated = initial
+      loop = asyncio.get_event_loop()
+      tasks = []
+      # Worker processes open the snapshotted segment files later on, so the
+      # scan counts as a reader from before the first snapshot.
+      self._reader_started()
+      try:
+         for ch_id in channel_ids:
+            (segments, in_flight, buffered, deltas) = self._snapshot(server_id, ch_id)
+            ch_dir = self._get_ch_dir(server_id, ch_id)
+            tail = list(self._apply_deltas(itertools.chain(*in_flight), deltas))
+            tail.extend(buffered)
+            if not split_segments:
+               filepaths = [ch_dir + str(x["n"]) + ext for x in segments]
+               shards.append((ch_id, filepaths, tail, deltas))
+               shard_sizes.append(sum(x["count"] for x in segments) + len(tail))
+               continue
+            for entry in segments:
+               (min_id, max_id) = (int(entry["min id"]), int(entry["max id"]))
+               entry_deltas = {k: v for (k, v) in deltas.items() if min_id <= k <= max_id}
+               shards.append((ch_id, [ch_dir + str(entry["n"]) + ext], [], entry_deltas))
+               shard_sizes.append(entry["count"])
+            if len(tail) > 0:
+               shards.append((ch_id, [], tail, {}))
+               shard_sizes.append(len(tail))
+
+         messages_total = sum(shard_sizes)
+         messages_done = 0
+         async def run_shard(shard, shard_size):
+            return (await self._run_shard(mapper, mapper_args, *shard), shard_size)
+         tasks = [loop.create_task(run_shard(*x)) for x in zip(shards, shard_sizes)]
+         for future in asyncio.as_completed(tasks):
+            (partial, shard_size) = await future
+            accumulated = reducer(accumulated, partial)
+            messages_done += shard_size
+            if not progress is None:
+               progress(messages_done, messages_total)
+      finally:
+         # Nothing is left running if the reducer (or progress) raised.
+         for task in tasks:
+            task.cancel()
+         self._reader_finished()
+      return accumulated
+
+   # Runs a single map_reduce() shard in the process pool. If the pool can't
+   # be used (e.g. the bot itself is running as a daemonic process, which can't
+   # have children), it's run in a thread instead.
+   async def _run_shard(self, mapper, mapper_args, ch_id, filepaths, tail, deltas):
+      loop = asyncio.get_event_loop()
+      fn_args = [mapper, mapper_args, ch_id, filepaths, tail, deltas]
+      if not self._process_pool_unavailable:
          try:
-            file_contents = utils.json_read(ch_dir + str(file_number) + ".json")
+            if self._process_pool is None:
+               self._process_pool = ProcessPoolExecutor()
+            future = self._process_pool.submit(_map_shard, *fn_args)
+         except Exception:
+            print(traceback.format_exc())
+            print("MessageCache process pool unavailable. Running scans in threads instead.")
+            self._process_pool_unavailable = True
+            future = None
+         if not future is None:
+            try:
+               return await asyncio.wrap_future(future)
+            except BrokenProcessPool:
+               print("MessageCache process pool broke. It will be restarted.")
+               self._process_pool = None
+      return await loop.run_in_executor(None, _map_shard, *fn_args)
+
+   # Takes a consistent snapshot of where a channel's messages currently are,
+   # so that readers neither miss nor repeat messages that get flushed while
+   # they're reading.
+   # RETURNS: A tuple (segments, in_flight, buffered, deltas), where segments
+   #          is the list of segment index entries in read order, in_flight is
+   #          a list of message lists still being written (in order), buffered
+   #          is the list of buffered messages, and deltas is a copy of the
+   #          channel's deltas.
+   def _snapshot(self, server_id, ch_id):
+      manifest = self._get_manifest(server_id, ch_id)
+      deltas = self._get_deltas(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         segments = list(manifest["segments"])
+         in_flight = [x[1] for x in self._in_flight.get((server_id, ch_id), [])]
+         deltas = dict(deltas)
+      buffered = None
+      try:
+         buffered = self._data[server_id][ch_id]
+      except KeyError:
+         buffered = []
+      return (segments, in_flight, buffered, deltas)
+
+   # Returns a channel's manifest, loading it from channel.json the first time.
+   # A manifest is a dictionary:
+   #    "last message id": ID of the last message in a segment file.
+   #    "last message timestamp": Timestamp of that message (isoformat).
+   #    "edit generation": (Optional) Number of edits and deletions recorded.
+   #    "next segment": File number to be given to the next segment file.
+   #    "segments": List of segment index entries (see
+   #                messagesegment.index_messages()) in read order.
+   # Manifests are only modified while holding the channel's lock, and are
+   # saved by _save_manifest().
+   def _get_manifest(self, server_id, ch_id):
+      key = (server_id, ch_id)
+      try:
+         return self._manifests[key]
+      except KeyError:
+         pass
+      with self._get_ch_lock(server_id, ch_id):
+         ch_json_data = None
+         try:
+            ch_json_data = utils.json_read(self._get_ch_dir(server_id, ch_id) + self._CH_JSON_FILENAME)
          except FileNotFoundError:
-            break
-         for msg_dict in file_contents:
-            msg_dict["t"] = dateutil.parser.parse(msg_dict["t"])
-            yield msg_dict
+            # Nothing cached yet. It's saved once there's a segment.
+            ch_json_data = {"segments": [], "next segment": 1}
+         if "next segment" in ch_json_data:
+            self._manifests[key] = ch_json_data
+         else:
+            self._manifests[key] = self._build_manifest(server_id, ch_id, ch_json_data)
+            if not self._read_only:
+               self._save_manifest(server_id, ch_id)
+      # Nothing can be reading replaced segments before the manifest is loaded.
+      self._delete_obsolete(server_id, ch_id)
+      return self._manifests[key]
 
-      # After having read all files, output buffered messages.
+   # Builds a manifest for a channel cached by an older version, where
+   # channel.json only held the last message timestamp (and possibly an
+   # incomplete segment index). The channel directory is scanned and every
+   # segment file indexed.
+   def _build_manifest(self, server_id, ch_id, ch_json_data):
+      ch_dir = self._get_ch_dir(server_id, ch_id)
+      ext = messagesegment.SEGMENT_EXT
+      file_numbers = []
       try:
-         for msg_dict in self._data[server_id][ch_id]:
-            yield msg_dict
+         file_names = os.listdir(ch_dir)
+      except FileNotFoundError:
+         file_names = []
+      for file_name in file_names:
+         if file_name.endswith(ext):
+            try:
+               file_numbers.append(int(file_name[:-len(ext)]))
+            except ValueError:
+               continue
+      file_numbers.sort()
+
+      manifest = {"segments": []}
+      for file_number in file_numbers:
+         entry = messagesegment.index_segment(file_number, ch_dir + str(file_number) + ext)
+         manifest["segments"].append(entry)
+      manifest["next segment"] = max(file_numbers, default=0) + 1
+      if len(manifest["segments"]) > 0:
+         manifest["last message id"] = max((x["max id"] for x in manifest["segments"]), key=int)
+      try:
+         manifest["last message timestamp"] = ch_json_data["last message timestamp"]
       except KeyError:
          pass
+      return manifest
 
+   # Atomically saves a channel's manifest to its channel.json.
+   # PRECONDITION: The channel's lock is held.
+   def _save_manifest(self, server_id, ch_id):
+      self._manifests_dirty.discard((server_id, ch_id))
+      ch_dir = self._get_ch_dir(server_id, ch_id)
+      ch_json_filepath = ch_dir + self._CH_JSON_FILENAME
+      utils.json_write(ch_json_filepath + ".tmp", data=self._manifests[(server_id, ch_id)], fsync=True)
+      os.replace(ch_json_filepath + ".tmp", ch_json_filepath)
+      utils.fsync_dir(ch_dir)
+      return
+
+   # Saves manifests that have only had their edit generation changed. This
+   # runs in the writer thread.
+   def _save_dirty_manifests(self):
+      for key in list(self._manifests_dirty):
+         with self._get_ch_lock(*key):
+            if key in self._manifests_dirty:
+               self._save_manifest(*key)
+      return
+
+   def _get_ch_lock(self, server_id, ch_id):
+      return self._ch_locks.setdefault((server_id, ch_id), threading.Lock())
+
+   # Backfills every channel with messages sent since the last time the bot
+   # was running.
+   # Each channel is paged forwards from its high-water mark (the ID of the
+   # last message stored on disk), so messages are appended in order. At most
+   # _BACKFILL_CONCURRENCY channels are fetched at once.
+   # While a channel is being backfilled, live messages from record_message()
+   # are held in self._backfill_pending and merged in once it finishes.
+   # If fetching a page fails, the channel's backfill is resumed from its last
+   # fetched message after a delay. If it still fails, the held messages are
+   # dropped rather than merged in after the missing ones.
    async def _fill_buffers(self):
       await self._client.set_temp_game_status("filling cache buffers.")
       loop = asyncio.get_event_loop()
-      
-      total_channels = [0]
+      semaphore = asyncio.Semaphore(self._BACKFILL_CONCURRENCY)
+
+      total_channels = len(self._backfill_pending)
       channels_done = [0]
-      channels_done_lock = asyncio.Lock()
-      all_channels = {}
-      servers = list(self._client.servers)
-      for server in servers:
-         i = all_channels[server.id] = list(server.channels)
-         total_channels[0] += len(i)
-      
-      async def cache_server(server):
-         ch_dict = None
-         ch_dict_lock = asyncio.Lock()
-         try:
-            ch_dict = self._data[server.id]
-         except KeyError:
-            ch_dict = {}
-            self._data[server.id] = ch_dict
 
-         async def cache_channel(ch):
-            if ch.type is discord.ChannelType.voice:
-               return
-            # print("MessageCache caching messages in #" + ch.name)
-
-            # TODO: Rename these variable names.
-            # TODO: Turn this into a function? (see duplicated code...)
-            ch_dir = self._get_ch_dir(server.id, ch.id)
-            ch_json_filepath = ch_dir + self._CH_JSON_FILENAME
-            
-            ch_json_data = None
-            try:
-               ch_json_data = utils.json_read(ch_json_filepath)
-            except FileNotFoundError:
-               ch_json_data = {}
+      def report_progress(ch, text):
+         channels_done[0] += 1
+         new_args = [str(channels_done[0]), str(total_channels), text, ch.name]
+         print("({}/{}) MessageCache {} #{}".format(*new_args))
+         return
 
-            # TODO: Turn this into a function? (see duplicated code...)
-            ch_stored_timestamp = None
-            try:
-               ch_stored_timestamp = dateutil.parser.parse(ch_json_data["last message timestamp"])
-            except KeyError:
-               ch_stored_timestamp = datetime.datetime(datetime.MINYEAR, 1, 1)
-               ch_json_data["last message timestamp"] = ch_stored_timestamp.isoformat()
-               utils.json_write(ch_json_filepath, data=ch_json_data)
+      # Fetches everything after the channel's last cached message.
+      async def fetch_channel(server, ch):
+         after_id = self._get_ch_high_water(server.id, ch.id)
+         ch_list = self._get_ch_buffer(server.id, ch.id)
+         if len(ch_list) > 0:
+            after_id = int(ch_list[-1]["i"]) # Replayed from the WAL, or fetched before a retry.
+         while True:
+            page = []
+            after_obj = discord.Object(id=str(after_id))
+            async for msg in self._client.logs_from(ch, limit=self._BACKFILL_PAGE_SIZE, after=after_obj):
+               page.append(self._message_dict(msg))
+            if len(page) == 0:
+               break
+            page.sort(key=lambda x: int(x["i"]))
+            ch_list.extend(page)
+            after_id = int(page[-1]["i"])
+            # Move every 5000 messages to disk as we go.
+            while len(ch_list) >= 5000:
+               await asyncio.shield(self._queue_flush(server.id, ch.id, messages=5000))
+               ch_list = self._get_ch_buffer(server.id, ch.id)
+            if len(page) < self._BACKFILL_PAGE_SIZE:
+               break
+         return
 
-            # This will now fill a buffer of all messages of a channel.
-            msg_buffer = []
+      async def cache_channel(server, ch):
+         status = "cached messages in"
+         failed = False
+         retries = 0
+         while True:
+            await semaphore.acquire()
             try:
-               async for msg in self._client.logs_from(ch, limit=ARBITRARILY_LARGE_NUMBER):
-                  if msg.timestamp <= ch_stored_timestamp:
-                     break
-                  # Insert in front since we're reading messages starting from most recent.
-                  msg_buffer.insert(0, self._message_dict(msg))
+               await fetch_channel(server, ch)
+               break
             except discord.errors.Forbidden:
-               await channels_done_lock.acquire()
-               channels_done[0] += 1
-               new_args = [str(channels_done[0]), str(total_channels[0]), ch.name]
-               print("({}/{}) MessageCache unable to read #{}".format(*new_args))
-               channels_done_lock.release()
-               return
+               status = "unable to read"
+               failed = True
+               break
+            except discord.errors.HTTPException:
+               if retries >= self._BACKFILL_RETRIES:
+                  status = "failed to finish reading"
+                  failed = True
+                  break
+            except asyncio.CancelledError:
+               raise
+            except Exception as e:
+               # Anything else is unexpected, but the other channels still
+               # carry on.
+               status = "failed to finish reading"
+               failed = True
+               await self._client.report_exception(e, handled_by="MessageCache._fill_buffers().")
+               break
+            finally:
+               semaphore.release()
+            retries += 1
+            await asyncio.sleep(self._BACKFILL_RETRY_DELAY * retries)
+         # (Not done if cancelled. See shutdown_flush().)
+         if failed:
+            self._drop_backfill_pending(server.id, ch.id)
+         else:
+            self._merge_backfill_pending(server.id, ch.id)
 
-            await ch_dict_lock.acquire()
+         # Move every 1000 messages to disk.
+         while len(self._get_ch_buffer(server.id, ch.id)) >= 1000:
+            await asyncio.shield(self._queue_flush(server.id, ch.id, messages=1000))
 
-            ch_dict[ch.id] = msg_buffer
+         # Now move every 200 messages to disk.
+         while len(self._get_ch_buffer(server.id, ch.id)) >= 200:
+            await asyncio.shield(self._queue_flush(server.id, ch.id, messages=200))
 
-            # Move every 5000 messages to disk.
-            while len(ch_dict[ch.id]) >= 5000:
-               self._move_to_disk(server.id, ch.id, messages=5000)
+         report_progress(ch, status)
+         return
 
-            # Move every 1000 messages to disk.
-            while len(ch_dict[ch.id]) >= 1000:
-               self._move_to_disk(server.id, ch.id, messages=1000)
+      futures = []
+      for server in list(self._client.servers):
+         for ch in list(server.channels):
+            if (server.id, ch.id) in self._backfill_pending:
+               futures.append(loop.create_task(cache_channel(server, ch)))
+      await asyncio.gather(*futures)
 
-            # Now move every 200 messages to disk.
-            while len(ch_dict[ch.id]) >= 200:
-               self._move_to_disk(server.id, ch.id, messages=200)
+      print("MessageCache backfill complete.")
+      await self._client.remove_temp_game_status()
+      return
 
-            ch_dict_lock.release()
-            await channels_done_lock.acquire()
-            channels_done[0] += 1
-            new_args = [str(channels_done[0]), str(total_channels[0]), ch.name]
-            print("({}/{}) Cached messages in #{}".format(*new_args))
-            channels_done_lock.release()
+   # Merges live messages that arrived during a channel's backfill into its
+   # buffer, then stops holding messages back for that channel.
+   def _merge_backfill_pending(self, server_id, ch_id):
+      pending = self._backfill_pending.pop((server_id, ch_id), [])
+      ch_list = self._get_ch_buffer(server_id, ch_id)
+      seen = set(x["i"] for x in ch_list)
+      high_water = self._get_ch_high_water(server_id, ch_id)
+      for msg_dict in pending:
+         # Messages may have been fetched by the backfill as well.
+         if (not msg_dict["i"] in seen) and (int(msg_dict["i"]) > high_water):
+            ch_list.append(msg_dict)
+            seen.add(msg_dict["i"])
+      ch_list.sort(key=lambda x: int(x["i"]))
+      self._wal_rewrite(server_id, ch_id)
+      return
 
-            return
+   # Used instead of _merge_backfill_pending() if a channel's backfill failed.
+   # Whatever was fetched is kept, but the live messages held back (and any
+   # received from now on) would leave a gap before them, so they're dropped
+   # instead. The next backfill fetches them again, resuming from the last
+   # message that was fetched.
+   def _drop_backfill_pending(self, server_id, ch_id):
+      key = (server_id, ch_id)
+      self._backfill_pending.pop(key, None)
+      self._backfill_gaps.add(key)
+      return
 
-         chcache_futures = []
-         for j in all_channels[server.id]:
-            chcache_futures.append(loop.create_task(cache_channel(j)))
-         await asyncio.gather(*chcache_futures)
+   #################################################################################
+   # WRITE-AHEAD LOG ###############################################################
+   #################################################################################
 
-      scache_futures = []
-      for i in servers:
-         scache_futures.append(loop.create_task(cache_server(i)))
-      await asyncio.gather(*scache_futures)
+   # Each channel has a write-ahead log file, holding one json-encoded message
+   # dict per line. It always holds exactly the messages of that channel that
+   # are buffered or in flight (i.e. not yet in a segment file), so that they
+   # survive a crash or restart without having to be fetched again.
+   # An edited buffered message is simply logged again, and a deleted one gets
+   # a tombstone line {"i": message ID, "d": 1}. Later lines win.
+   # Messages held back during a channel's backfill aren't logged since they
+   # may not be contiguous with what's on disk. They're logged once merged.
 
-      await self._client.remove_temp_game_status()
+   def _get_wal_filepath(self, server_id, ch_id):
+      return self._get_ch_dir(server_id, ch_id) + self._WAL_FILENAME
+
+   @classmethod
+   def _wal_encode(cls, msg_dict):
+      msg_dict = copy.copy(msg_dict)
+      if isinstance(msg_dict.get("t"), datetime.datetime):
+         msg_dict["t"] = msg_dict["t"].isoformat()
+      return json.dumps(msg_dict, separators=(",", ":")) + "\n"
+
+   # Appends a message to a channel's write-ahead log.
+   def _wal_append(self, server_id, ch_id, msg_dict):
+      key = (server_id, ch_id)
+      f = None
+      try:
+         f = self._wal_files[key]
+      except KeyError:
+         filepath = self._get_wal_filepath(server_id, ch_id)
+         utils.mkdir_recursive(filepath)
+         f = open(filepath, encoding="utf-8", mode="a")
+         self._wal_files[key] = f
+      f.write(self._wal_encode(msg_dict))
+      f.flush() # Hands it to the OS, so it survives the process being killed.
       return
 
-   # Moves specified channel's messages to disk.
-   # PARAMETER: messages - Number of earlier messages to move to a single file.
-   #                       If None, then all messages are moved.
-   # PRECONDITION: messages > 0
-   # PRECONDITION: server_id and ch_id are both valid keys.
-   def _move_to_disk(self, server_id, ch_id, messages=None):
-      print("MessageCache moving messages to disk.")
-      ch_dir = self._get_ch_dir(server_id, ch_id)
-      ch_json_filepath = ch_dir + self._CH_JSON_FILENAME
+   # Rewrites a channel's write-ahead log to hold only what's not yet on disk.
+   def _wal_rewrite(self, server_id, ch_id):
+      key = (server_id, ch_id)
+      try:
+         self._wal_files.pop(key).close()
+      except KeyError:
+         pass
+      to_log = [x[1] for x in self._in_flight.get(key, [])]
+      try:
+         to_log.append(self._data[server_id][ch_id])
+      except KeyError:
+         pass
+      filepath = self._get_wal_filepath(server_id, ch_id)
+      if sum(len(x) for x in to_log) == 0:
+         try:
+            os.remove(filepath)
+         except FileNotFoundError:
+            pass
+         return
+      utils.mkdir_recursive(filepath)
+      with open(filepath + ".tmp", encoding="utf-8", mode="w") as f:
+         for msg_dict in itertools.chain(*to_log):
+            f.write(self._wal_encode(msg_dict))
+      os.replace(filepath + ".tmp", filepath)
+      return
+
+   # Loads a channel's write-ahead log back into its buffer. Anything already
+   # in a segment file is dropped.
+   def _replay_wal(self, server_id, ch_id):
+      replayed = self._read_wal(server_id, ch_id)
+      if replayed is None:
+         return
+      ch_list = self._get_ch_buffer(server_id, ch_id)
+      ch_list.extend(replayed)
+      if len(ch_list) > 0:
+         self._buffer_times[(server_id, ch_id)] = time.monotonic()
+         print("MessageCache replayed {} messages in {}.".format(str(len(ch_list)), ch_id))
+      self._wal_rewrite(server_id, ch_id)
+      return
 
-      # TODO: Turn this into a function? (see duplicated code...)
-      ch_json_data = None
+   # Reads the messages in a channel's write-ahead log that aren't already on
+   # disk.
+   # RETURNS: List of message dicts in order, or None if there's no log.
+   def _read_wal(self, server_id, ch_id):
+      filepath = self._get_wal_filepath(server_id, ch_id)
+      lines = None
       try:
-         ch_json_data = utils.json_read(ch_json_filepath)
+         with open(filepath, encoding="utf-8", mode="r") as f:
+            lines = f.readlines()
       except FileNotFoundError:
-         ch_json_data = {}
+         return None
+      high_water = self._get_ch_high_water(server_id, ch_id)
+      replayed = {}
+      for line in lines:
+         try:
+            msg_dict = json.loads(line)
+         except ValueError:
+            continue # Probably cut off by a crash.
+         if int(msg_dict["i"]) <= high_water:
+            continue
+         if "d" in msg_dict:
+            replayed.pop(msg_dict["i"], None)
+            continue
+         msg_dict["t"] = self._naive_utc(msg_dict["t"])
+         replayed[msg_dict["i"]] = msg_dict
+      return sorted(replayed.values(), key=lambda x: int(x["i"]))
 
-      # TODO: Turn this into a function? (see duplicated code...)
-      ch_stored_timestamp = None
+   # Returns the buffer list for a channel, creating it if necessary.
+   def _get_ch_buffer(self, server_id, ch_id):
+      ch_dict = None
+      try:
+         ch_dict = self._data[server_id]
+      except KeyError:
+         ch_dict = {}
+         self._data[server_id] = ch_dict
       try:
-         ch_stored_timestamp = dateutil.parser.parse(ch_json_data["last message timestamp"])
+         return ch_dict[ch_id]
       except KeyError:
-         ch_stored_timestamp = datetime.datetime(datetime.MINYEAR, 1, 1)
-         ch_json_data["last message timestamp"] = ch_stored_timestamp.isoformat()
-         utils.json_write(ch_json_filepath, data=ch_json_data)
+         ch_list = []
+         ch_dict[ch_id] = ch_list
+         return ch_list
+
+   # Returns the ID (as an int) of the last message stored on disk for a
+   # channel, or 0 if nothing is stored yet.
+   def _get_ch_high_water(self, server_id, ch_id):
+      manifest = self._get_manifest(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         return int(manifest.get("last message id", "0"))
 
+   # Periodically flushes buffers that are either large enough to fill a
+   # segment file, or have been holding messages for too long.
+   async def _flush_loop(self):
+      while True:
+         try:
+            await asyncio.wait_for(self._flush_event.wait(), self._FLUSH_CHECK_INTERVAL)
+         except asyncio.TimeoutError:
+            pass
+         self._flush_event.clear()
+         try:
+            self._flush_due()
+            if len(self._manifests_dirty) > 0:
+               loop = asyncio.get_event_loop()
+               await loop.run_in_executor(self._writer, self._save_dirty_manifests)
+         except Exception as e:
+            await self._client.report_exception(e, handled_by="MessageCache._flush_loop().")
+      return
+
+   # Queues every buffer that is due to be flushed.
+   # PARAMETER: force - If True, all buffered messages are flushed.
+   def _flush_due(self, force=False):
+      now = time.monotonic()
+      for (server_id, ch_dict) in self._data.items():
+         for ch_id in list(ch_dict.keys()):
+            key = (server_id, ch_id)
+            if key in self._backfill_pending:
+               continue # The backfill flushes these itself.
+            while len(ch_dict[ch_id]) >= self._FLUSH_MESSAGES:
+               self._queue_flush(server_id, ch_id, messages=self._FLUSH_MESSAGES)
+            if len(ch_dict[ch_id]) == 0:
+               continue
+            buffered_since = self._buffer_times.setdefault(key, now)
+            if force or (now - buffered_since >= self._FLUSH_MAX_AGE):
+               self._queue_flush(server_id, ch_id)
+      return
+
+   # Splits off a channel's earliest buffered messages and queues them to be
+   # moved to disk by the writer thread.
+   # PARAMETER: messages - Number of earlier messages to move to a single file.
+   #                       If None, then all messages are moved.
+   # PRECONDITION: The buffer has at least one message.
+   # RETURNS: A task that completes once the messages are on disk.
+   def _queue_flush(self, server_id, ch_id, messages=None):
+      key = (server_id, ch_id)
       ch_dict = self._data[server_id]
 
       # Split off the messages to be stored.
@@ -226,43 +958,123 @@ class MessageCache:
       else:
          to_store = ch_dict[ch_id][:messages]
          ch_dict[ch_id] = ch_dict[ch_id][messages:]
+      if len(ch_dict[ch_id]) == 0:
+         self._buffer_times.pop(key, None)
 
-      latest_message = to_store[-1:][0]
-      latest_timestamp_isoformat = latest_message["t"].isoformat()
-      ch_json_data["last message timestamp"] = latest_timestamp_isoformat
+      manifest = self._get_manifest(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         file_number = manifest["next segment"]
+         manifest["next segment"] = file_number + 1
+         chunk = (file_number, to_store)
+         self._in_flight.setdefault(key, []).append(chunk)
 
-      for msg_dict in to_store:
-         # TODO: I still don't know what's causing this to be a string...
-         # This temporary fix will have to do for now.
-         if isinstance(msg_dict["t"], str):
-            print("WARNING: msg_dict[t] is already a string. contents: " + msg_dict["t"])
-         else:
-            msg_dict["t"] = msg_dict["t"].isoformat() # Make serializable
+      loop = asyncio.get_event_loop()
+      future = loop.run_in_executor(self._writer, self._move_to_disk, server_id, ch_id, chunk)
+      task = loop.create_task(self._await_write(key, chunk, future))
+      self._write_tasks.add(task)
+      task.add_done_callback(self._write_tasks.discard)
+      return task
 
-      # Check the highest numbered json file.
-      highest_json_file_number = 0
-      for file_name in os.listdir(ch_dir):
-         if file_name.endswith(".json"):
-            file_number = None
-            try:
-               file_number = int(file_name[:-5])
-            except ValueError:
-               continue
-            if file_number > highest_json_file_number:
-               highest_json_file_number = file_number
+   async def _await_write(self, key, chunk, future):
+      try:
+         await future
+      except Exception as e:
+         # Everything after this message would be written out of order, so
+         # we restart and let the backfill pick up from the last good segment.
+         buf_hb = "MessageCache._await_write()."
+         buf_fi = "**THIS BOT WILL NOW RESTART.**"
+         await self._client.report_exception(e, handled_by=buf_hb, final_info=buf_fi)
+         sys.exit(1)
+      self._wal_rewrite(*key)
+      return
 
-      # Store data in the next available json file number
-      file_name = str(highest_json_file_number + 1) + ".json"
-      utils.json_write(ch_dir + file_name, data=to_store)
+   # Writes messages to disk as a new segment file, and adds it to the
+   # channel's manifest.
+   # Only ever runs in the writer thread.
+   # PARAMETER: chunk - A (file number, message dicts) tuple from self._in_flight.
+   def _move_to_disk(self, server_id, ch_id, chunk):
+      print("MessageCache moving messages to disk.")
+      (file_number, to_store) = chunk
+      ch_dir = self._get_ch_dir(server_id, ch_id)
 
-      # Save latest message timestamp.
-      utils.json_write(ch_json_filepath, data=ch_json_data)
+      file_name = str(file_number) + messagesegment.SEGMENT_EXT
+      utils.mkdir_recursive(ch_dir + file_name)
+      num_bytes = messagesegment.write_segment(ch_dir + file_name, to_store, fsync=True)
+      # The manifest mustn't list a segment that a crash could still lose.
+      utils.fsync_dir(ch_dir)
+      entry = messagesegment.index_messages(file_number, num_bytes, to_store)
+      rollup = self._get_rollup(server_id, ch_id)
+      new_rollup = messagerollup.ChannelRollup()
+      new_rollup.add_all(to_store)
+      new_rollup.segments.add(file_number)
+
+      latest_message = to_store[-1]
+      manifest = self._manifests[(server_id, ch_id)]
+      with self._get_ch_lock(server_id, ch_id):
+         manifest["segments"].append(entry)
+         rollup.merge(new_rollup)
+         self._rollups_dirty.add((server_id, ch_id))
+         manifest["last message id"] = latest_message["i"]
+         manifest["last message timestamp"] = latest_message["t"].isoformat()
+         self._in_flight[(server_id, ch_id)].remove(chunk)
+         self._save_manifest(server_id, ch_id)
+      return
+
+   # Flushes all buffered messages to disk, waiting at most timeout seconds for
+   # them to be written. Called when the bot is shutting down.
+   async def shutdown_flush(self, timeout=_SHUTDOWN_FLUSH_TIMEOUT):
+      self._flush_task.cancel()
+      self._compact_task.cancel()
+      self._rollup_task.cancel()
+      if not self._process_pool is None:
+         self._process_pool.shutdown(wait=False)
+      if not self._backfill_task.done():
+         self._backfill_task.cancel()
+         # Live messages held back during the backfill aren't contiguous with
+         # what has been fetched so far, so they're left for the next backfill
+         # to fetch again.
+         self._backfill_pending = {}
+      self._flush_due(force=True)
+      if len(self._write_tasks) > 0:
+         print("MessageCache writing buffered messages to disk...")
+         (done, not_done) = await asyncio.wait(list(self._write_tasks), timeout=timeout)
+         if len(not_done) > 0:
+            print("MessageCache timed out with {} segments unwritten.".format(str(len(not_done))))
+      loop = asyncio.get_event_loop()
+      if len(self._manifests_dirty) > 0:
+         await asyncio.wait([loop.run_in_executor(self._writer, self._save_dirty_manifests)], timeout=timeout)
+      if len(self._rollups_dirty) > 0:
+         await asyncio.wait([loop.run_in_executor(self._writer, self._save_rollups)], timeout=timeout)
+      self._writer.shutdown(wait=False)
+      for f in self._wal_files.values():
+         f.close()
+      self._wal_files = {}
+      for f in self._delta_files.values():
+         f.close()
+      self._delta_files = {}
+      return
+
+   # One-time conversion of numbered json files (the old on-disk format) into
+   # segment files. A format marker file is written once done so that this
+   # doesn't have to walk the whole cache directory on every startup.
+   def _migrate_legacy_json(self):
+      format_filepath = self._data_dir + self._FORMAT_JSON_FILENAME
+      try:
+         format_data = utils.json_read(format_filepath)
+         if format_data.get("segment format") == messagesegment.SEGMENT_EXT:
+            return
+      except FileNotFoundError:
+         pass
+      print("MessageCache converting old json files to segment files...")
+      converted = messagesegment.migrate_json_tree(self._data_dir)
+      print("MessageCache converted {} files.".format(str(converted)))
+      utils.json_write(format_filepath, data={"segment format": messagesegment.SEGMENT_EXT})
       return
 
    @classmethod
    def _message_dict(cls, msg):
       i = {}
-      i["t"] = msg.timestamp # Datetime (must convert before storing!!!)
+      i["t"] = cls._naive_utc(msg.timestamp) # Datetime (must convert before storing!!!)
       i["i"] = msg.id # String
       i["a"] = msg.author.id # String
       i["c"] = msg.content # String
@@ -279,9 +1091,496 @@ class MessageCache:
       i["f"] = tmp
       return i
 
+   # Everything buffered holds its timestamp as a naive UTC datetime, which
+   # is what the segment files expect.
+   # PARAMETER: value - A datetime (naive UTC or timezone-aware), or a string
+   #                    as stored in the write-ahead log.
+   @classmethod
+   def _naive_utc(cls, value):
+      if isinstance(value, str):
+         value = dateutil.parser.parse(value)
+      if not value.tzinfo is None:
+         value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+      return value
+
    def _get_ch_dir(self, server_id, ch_id):
       return self._data_dir + server_id + "/" + ch_id + "/"
 
+   #################################################################################
+   # DELTA LOG #####################################################################
+   #################################################################################
+
+   # Edits and deletions of messages that are already in segment files are
+   # kept in a per-channel delta log rather than rewriting the segments. Each
+   # line is a json object, either {"i": id, "d": 1} (a tombstone) or
+   # {"i": id, "p": {field: value, ...}} (a patch). They are applied by
+   # read_messages(), and merged into the segment files by the compactor.
+   # The delta log file is only touched while holding the channel's lock.
+
+   _PATCHABLE_FIELDS = ["c", "h", "e", "f"]
+
+   # Returns a channel's deltas, loading them the first time.
+   # RETURNS: A dict mapping message ID (int) -> patch dict, or None if the
+   #          message was deleted.
+   def _get_deltas(self, server_id, ch_id):
+      key = (server_id, ch_id)
+      try:
+         return self._deltas[key]
+      except KeyError:
+         pass
+      deltas = {}
+      try:
+         with open(self._get_ch_dir(server_id, ch_id) + self._DELTAS_FILENAME, encoding="utf-8", mode="r") as f:
+            for line in f:
+               try:
+                  record = json.loads(line)
+               except ValueError:
+                  continue # Probably cut off by a crash.
+               self._merge_delta(deltas, int(record["i"]), record.get("p", None))
+      except FileNotFoundError:
+         pass
+      self._deltas[key] = deltas
+      return deltas
+
+   # Patches are never modified in place, so a delta can be compared by
+   # identity to tell whether it's changed.
+   @classmethod
+   def _merge_delta(cls, deltas, msg_id, patch):
+      if patch is None:
+         deltas[msg_id] = None
+      else:
+         try:
+            existing = deltas[msg_id]
+            if existing is None:
+               return # Can't edit a deleted message.
+            new_patch = copy.copy(existing)
+            new_patch.update(patch)
+            deltas[msg_id] = new_patch
+         except KeyError:
+            deltas[msg_id] = patch
+      return
+
+   # Adds an edit (or deletion, if patch is None) to a channel's delta log.
+   def _delta_append(self, server_id, ch_id, msg_id, patch):
+      key = (server_id, ch_id)
+      deltas = self._get_deltas(server_id, ch_id)
+      record = {"i": str(msg_id)}
+      if patch is None:
+         record["d"] = 1
+      else:
+         record["p"] = patch
+      with self._get_ch_lock(server_id, ch_id):
+         self._merge_delta(deltas, msg_id, patch)
+         f = None
+         try:
+            f = self._delta_files[key]
+         except KeyError:
+            filepath = self._get_ch_dir(server_id, ch_id) + self._DELTAS_FILENAME
+            utils.mkdir_recursive(filepath)
+            f = open(filepath, encoding="utf-8", mode="a")
+            self._delta_files[key] = f
+         f.write(json.dumps(record, separators=(",", ":")) + "\n")
+         f.flush()
+      return
+
+   # Rewrites a channel's delta log from its in-memory deltas.
+   # PRECONDITION: The channel's lock is held.
+   def _delta_rewrite(self, server_id, ch_id):
+      key = (server_id, ch_id)
+      try:
+         self._delta_files.pop(key).close()
+      except KeyError:
+         pass
+      filepath = self._get_ch_dir(server_id, ch_id) + self._DELTAS_FILENAME
+      deltas = self._deltas[key]
+      if len(deltas) == 0:
+         try:
+            os.remove(filepath)
+         except FileNotFoundError:
+            pass
+         return
+      with open(filepath + ".tmp", encoding="utf-8", mode="w") as f:
+         for (msg_id, patch) in deltas.items():
+            record = {"i": str(msg_id)}
+            if patch is None:
+               record["d"] = 1
+            else:
+               record["p"] = patch
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+      os.replace(filepath + ".tmp", filepath)
+      return
+
+   #################################################################################
+   # COMPACTION ####################################################################
+   #################################################################################
+
+   # The live message path writes small segments (_FLUSH_MESSAGES messages at a
+   # time), so old history ends up spread over a lot of small files. The
+   # compactor merges runs of adjacent small segments into a single compressed
+   # segment, and swaps it into the channel's manifest in their place.
+   # Compaction runs in the writer thread, so it never races with flushes.
+   # Replaced segment files are listed under "obsolete" in the manifest and
+   # only deleted after _COMPACT_GRACE seconds (or on the next startup), so
+   # that readers that took a snapshot before the swap can still finish.
+
+   async def _compact_loop(self):
+      await asyncio.wait([self._backfill_task])
+      while True:
+         try:
+            await self.compact()
+         except Exception as e:
+            await self._client.report_exception(e, handled_by="MessageCache._compact_loop().")
+         try:
+            await asyncio.wait_for(self._compact_event.wait(), self._COMPACT_INTERVAL)
+         except asyncio.TimeoutError:
+            pass
+         self._compact_event.clear()
+      return
+
+   # Asks the compactor to run as soon as possible.
+   def request_compaction(self):
+      self._compact_event.set()
+      return
+
+   # Compacts every channel with a loaded manifest.
+   async def compact(self):
+      if self._compacting:
+         return
+      self._compacting = True
+      stats = {"started": datetime.datetime.utcnow(), "finished": None,
+         "channels": 0, "merged": 0, "written": 0, "bytes before": 0, "bytes after": 0}
+      self._compact_stats = stats
+      try:
+         loop = asyncio.get_event_loop()
+         for key in list(self._manifests.keys()):
+            if key in self._backfill_pending:
+               continue
+            await loop.run_in_executor(self._writer, self._compact_channel, key[0], key[1], stats)
+            stats["channels"] += 1
+         stats["finished"] = datetime.datetime.utcnow()
+         print("MessageCache compacted {} segments into {}.".format(str(stats["merged"]), str(stats["written"])))
+      finally:
+         self._compacting = False
+      return
+
+   # Compacts a single channel.
+   # Only ever runs in the writer thread.
+   def _compact_channel(self, server_id, ch_id, stats):
+      manifest = self._manifests[(server_id, ch_id)]
+      all_deltas = self._get_deltas(server_id, ch_id)
+      rollup = self._get_rollup(server_id, ch_id)
+      self._delete_obsolete(server_id, ch_id, before=time.time() - self._COMPACT_GRACE)
+      with self._get_ch_lock(server_id, ch_id):
+         segments = list(manifest["segments"])
+         deltas = dict(all_deltas)
+
+      ch_dir = self._get_ch_dir(server_id, ch_id)
+      ext = messagesegment.SEGMENT_EXT
+      for group in self._plan_compaction(segments, sorted(deltas.keys())):
+         msg_dicts = []
+         # The rollup swaps the group's totals for those of the merged
+         # segment, which have the deltas applied.
+         rollup_change = messagerollup.ChannelRollup()
+         all_rolled_up = True
+         for entry in group:
+            entry_dicts = list(messagesegment.read_segment(ch_dir + str(entry["n"]) + ext))
+            if entry["n"] in rollup.segments:
+               rollup_change.add_all(entry_dicts, sign=-1)
+            else:
+               all_rolled_up = False
+            msg_dicts.extend(entry_dicts)
+         merged_ids = [int(x["i"]) for x in msg_dicts if int(x["i"]) in deltas]
+         msg_dicts = list(self._apply_deltas(msg_dicts, deltas))
+         if len(msg_dicts) == 0:
+            msg_dicts = None # Everything was deleted.
+
+         new_entries = []
+         num_bytes = 0
+         if not msg_dicts is None:
+            with self._get_ch_lock(server_id, ch_id):
+               file_number = manifest["next segment"]
+               manifest["next segment"] = file_number + 1
+            filepath = ch_dir + str(file_number) + ext
+            num_bytes = messagesegment.write_segment(filepath, msg_dicts, compress=True, fsync=True)
+            utils.fsync_dir(ch_dir)
+            new_entry = messagesegment.index_messages(file_number, num_bytes, msg_dicts)
+            new_entry["compressed"] = True
+            new_entries.append(new_entry)
+            if all_rolled_up:
+               rollup_change.add_all(msg_dicts)
+               rollup_change.segments.add(file_number)
+
+         now = time.time()
+         with self._get_ch_lock(server_id, ch_id):
+            # Only this thread changes the segment list, so the group is
+            # still exactly where it was planned.
+            segments = manifest["segments"]
+            i = segments.index(group[0])
+            assert segments[i:i + len(group)] == group
+            segments[i:i + len(group)] = new_entries
+            if not "obsolete" in manifest:
+               manifest["obsolete"] = []
+            manifest["obsolete"].extend([x["n"], now] for x in group)
+            self._save_manifest(server_id, ch_id)
+            rollup.merge(rollup_change)
+            rollup.segments -= set(x["n"] for x in group)
+            self._rollups_dirty.add((server_id, ch_id))
+            # Drop the deltas that are now merged in, unless they changed
+            # again while compacting.
+            if len(merged_ids) > 0:
+               for msg_id in merged_ids:
+                  if all_deltas.get(msg_id, None) is deltas[msg_id]:
+                     del all_deltas[msg_id]
+               self._delta_rewrite(server_id, ch_id)
+
+         stats["merged"] += len(group)
+         stats["written"] += len(new_entries)
+         stats["bytes before"] += sum(x["bytes"] for x in group)
+         stats["bytes after"] += num_bytes
+      return
+
+   # Splits a channel's segments into groups to be compacted.
+   # Each group is a run of adjacent segments holding at most
+   # _COMPACT_TARGET_MESSAGES messages in total. Single segments are only
+   # included if they still need to be compressed, or have deltas to merge.
+   # PARAMETER: delta_ids - Sorted list of message IDs (ints) with deltas.
+   # RETURNS: A list of lists of segment index entries.
+   @classmethod
+   def _plan_compaction(cls, segments, delta_ids):
+      groups = []
+      group = []
+      group_count = 0
+
+      def end_group():
+         if len(group) > 1:
+            groups.append(group)
+         elif len(group) == 1:
+            if (not group[0].get("compressed", False)) or cls._segment_has_deltas(group[0], delta_ids):
+               groups.append(group)
+         return
+
+      for entry in segments:
+         if group_count + entry["count"] > cls._COMPACT_TARGET_MESSAGES:
+            end_group()
+            group = []
+            group_count = 0
+         group.append(entry)
+         group_count += entry["count"]
+      end_group()
+      return groups
+
+   # PARAMETER: delta_ids - Sorted list of message IDs (ints) with deltas.
+   # RETURNS: True if any of the IDs are within a segment's range of IDs.
+   @classmethod
+   def _segment_has_deltas(cls, entry, delta_ids):
+      i = bisect.bisect_left(delta_ids, int(entry["min id"]))
+      return (i < len(delta_ids)) and (delta_ids[i] <= int(entry["max id"]))
+
+   # Deletes segment files replaced by the compactor.
+   # PARAMETER: before - Only files replaced before this time.time() are
+   #                     deleted. If None, all are deleted.
+   def _delete_obsolete(self, server_id, ch_id, before=None):
+      if self._read_only:
+         return
+      if (not before is None) and (self._active_readers > 0):
+         return # Readers may still be about to open them.
+      manifest = self._manifests[(server_id, ch_id)]
+      with self._get_ch_lock(server_id, ch_id):
+         obsolete = manifest.get("obsolete", [])
+         to_delete = [x for x in obsolete if (before is None) or (x[1] < before)]
+         if len(to_delete) == 0:
+            return
+         manifest["obsolete"] = [x for x in obsolete if not x in to_delete]
+         self._save_manifest(server_id, ch_id)
+      ch_dir = self._get_ch_dir(server_id, ch_id)
+      for (file_number, replaced_time) in to_delete:
+         try:
+            os.remove(ch_dir + str(file_number) + messagesegment.SEGMENT_EXT)
+         except FileNotFoundError:
+            pass
+      return
+
+   # Readers holding a snapshot (see _snapshot()) are counted from before the
+   # snapshot is taken until they're done with it. Replaced segment files
+   # aren't deleted while there are any, however long they take.
+   # These may be called from any thread.
+   def _reader_started(self):
+      with self._readers_lock:
+         self._active_readers += 1
+      return
+
+   def _reader_finished(self):
+      with self._readers_lock:
+         self._active_readers -= 1
+      return
+
+   #################################################################################
+   # ROLLUPS #######################################################################
+   #################################################################################
+
+   # Each channel has a rollup (see messagerollup) of the messages in its
+   # segment files, saved to rollup.json. Rollups are only changed in the
+   # writer thread: segments are added as they're written, and swapped out as
+   # they're compacted. Segments that were written before rollups existed (or
+   # while the bot was down) are added once the backfill is done.
+   # Deltas aren't included until they're merged into the segments, so they
+   # (and messages not yet written) are added on the fly by read_rollup().
+
+   async def _rollup_loop(self):
+      await asyncio.wait([self._backfill_task])
+      loop = asyncio.get_event_loop()
+      try:
+         for key in list(self._manifests.keys()):
+            await loop.run_in_executor(self._writer, self._rollup_catch_up, key[0], key[1])
+         print("MessageCache rollups are up to date.")
+      except Exception as e:
+         await self._client.report_exception(e, handled_by="MessageCache._rollup_loop().")
+      while True:
+         await asyncio.sleep(self._ROLLUP_SAVE_INTERVAL)
+         try:
+            await loop.run_in_executor(self._writer, self._save_rollups)
+         except Exception as e:
+            await self._client.report_exception(e, handled_by="MessageCache._rollup_loop().")
+      return
+
+   # Returns a channel's rollup, loading it from rollup.json the first time.
+   # A saved rollup that includes segments that are no longer in the manifest
+   # was saved before a compaction finished, so it's discarded and rebuilt.
+   def _get_rollup(self, server_id, ch_id):
+      key = (server_id, ch_id)
+      try:
+         return self._rollups[key]
+      except KeyError:
+         pass
+      manifest = self._get_manifest(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         if key in self._rollups:
+            return self._rollups[key]
+         rollup = None
+         try:
+            json_data = utils.json_read(self._get_ch_dir(server_id, ch_id) + self._ROLLUP_FILENAME)
+            rollup = messagerollup.ChannelRollup.from_json(json_data)
+         except FileNotFoundError:
+            rollup = messagerollup.ChannelRollup()
+         if not rollup.segments <= set(x["n"] for x in manifest["segments"]):
+            print("MessageCache rollup for channel {} is out of date. Rebuilding.".format(ch_id))
+            rollup = messagerollup.ChannelRollup()
+         self._rollups[key] = rollup
+      return rollup
+
+   # Adds every segment not yet in a channel's rollup.
+   # Only ever runs in the writer thread.
+   def _rollup_catch_up(self, server_id, ch_id):
+      manifest = self._manifests[(server_id, ch_id)]
+      rollup = self._get_rollup(server_id, ch_id)
+      with self._get_ch_lock(server_id, ch_id):
+         to_add = [x["n"] for x in manifest["segments"] if not x["n"] in rollup.segments]
+      ch_dir = self._get_ch_dir(server_id, ch_id)
+      for file_number in to_add:
+         filepath = ch_dir + str(file_number) + messagesegment.SEGMENT_EXT
+         new_rollup = messagerollup.ChannelRollup()
+         new_rollup.add_all(messagesegment.read_segment(filepath, columns=messagerollup.SEGMENT_COLUMNS))
+         new_rollup.segments.add(file_number)
+         with self._get_ch_lock(server_id, ch_id):
+            rollup.merge(new_rollup)
+            self._rollups_dirty.add((server_id, ch_id))
+      return
+
+   # Saves every rollup that has changed.
+   # Only ever runs in the writer thread.
+   def _save_rollups(self):
+      for key in list(self._rollups_dirty):
+         self._rollups_dirty.discard(key)
+         with self._get_ch_lock(*key):
+            json_data = self._rollups[key].to_json()
+         filepath = self._get_ch_dir(*key) + self._ROLLUP_FILENAME
+         utils.mkdir_recursive(filepath)
+         utils.json_write(filepath + ".tmp", data=json_data)
+         os.replace(filepath + ".tmp", filepath)
+      return
+
+   # Reads a channel's rollup, including every cached message.
+   # RETURNS: A list of rows. (See messagerollup.iter_rows().)
+   def read_rollup(self, server_id, ch_id):
+      return list(messagerollup.iter_rows(self._read_rollup_totals(server_id, ch_id)))
+
+   # Same as read_rollup(), but in columns.
+   # RETURNS: See messagerollup.totals_to_columns().
+   def read_rollup_columns(self, server_id, ch_id):
+      return messagerollup.totals_to_columns(self._read_rollup_totals(server_id, ch_id))
+
+   def _read_rollup_totals(self, server_id, ch_id):
+      self._reader_started()
+      try:
+         manifest = self._get_manifest(server_id, ch_id)
+         rollup = self._get_rollup(server_id, ch_id)
+         deltas = self._get_deltas(server_id, ch_id)
+         with self._get_ch_lock(server_id, ch_id):
+            segments = list(manifest["segments"])
+            in_flight = [x[1] for x in self._in_flight.get((server_id, ch_id), [])]
+            deltas = dict(deltas)
+            ret = messagerollup.ChannelRollup()
+            ret.totals = dict(rollup.totals)
+            rolled_up = set(rollup.segments)
+         buffered = None
+         try:
+            buffered = self._data[server_id][ch_id]
+         except KeyError:
+            buffered = []
+
+         ch_dir = self._get_ch_dir(server_id, ch_id)
+         columns = ["i"] + messagerollup.SEGMENT_COLUMNS
+         delta_ids = sorted(deltas.keys())
+         for entry in segments:
+            filepath = ch_dir + str(entry["n"]) + messagesegment.SEGMENT_EXT
+            if not entry["n"] in rolled_up:
+               ret.add_all(self._apply_deltas(messagesegment.read_segment(filepath, columns=columns), deltas))
+            elif self._segment_has_deltas(entry, delta_ids):
+               for msg_dict in messagesegment.read_segment(filepath, columns=columns):
+                  try:
+                     patch = deltas[int(msg_dict["i"])]
+                  except KeyError:
+                     continue
+                  ret.add(msg_dict, sign=-1)
+                  if not patch is None:
+                     msg_dict.update(patch)
+                     ret.add(msg_dict)
+         ret.add_all(self._apply_deltas(itertools.chain(*in_flight), deltas))
+         ret.add_all(buffered)
+      finally:
+         self._reader_finished()
+      return ret.totals
+
+   def get_compaction_info(self):
+      total_segments = 0
+      small_segments = 0
+      total_bytes = 0
+      for manifest in list(self._manifests.values()):
+         for entry in manifest["segments"]:
+            total_segments += 1
+            total_bytes += entry["bytes"]
+            if not entry.get("compressed", False):
+               small_segments += 1
+      buf = "**Message cache:** {} segments ({} uncompressed), {} KiB.\n"
+      buf = buf.format(str(total_segments), str(small_segments), str(total_bytes // 1024))
+      stats = self._compact_stats
+      if self._compacting:
+         buf += "Compactor is currently running."
+      elif stats is None:
+         buf += "Compactor has not run yet."
+      elif stats["finished"] is None:
+         buf += "Compactor failed on its last run."
+      else:
+         buf += "Compactor last finished at {} UTC. ".format(stats["finished"].strftime("%Y-%m-%d %H:%M:%S"))
+         buf += "Merged {} segments into {} ".format(str(stats["merged"]), str(stats["written"]))
+         buf += "({} KiB -> {} KiB).".format(str(stats["bytes before"] // 1024), str(stats["bytes after"] // 1024))
+      return buf
+
+   def backfill_in_progress(self):
+      if self._read_only:
+         return False # Never backfills.
+      return not self._backfill_task.done()
+
    def get_debugging_info(self):
       # buf = "**Currently buffered messages:**\n"
       # for (serv_id, serv_dict) in self._data.items():
@@ -290,13 +1589,35 @@ class MessageCache:
       #       buf += str(len(ch_data)) + " (#" + ch.name + ")\n"
       # return buf[:-1]
       buf = "In cache:\n"
+      if not self._read_only:
+         buf = "(Segments being written: {})\n".format(str(len(self._write_tasks))) + buf
+      if self.backfill_in_progress():
+         buf = "(Backfill in progress: {} channels remaining.)\n".format(str(len(self._backfill_pending))) + buf
       for (serv_id, serv_dict) in self._data.items():
          for (ch_id, ch_data) in serv_dict.items():
-            ch = self._client.search_for_channel(ch_id, enablenamesearch=False, serverrestriction=None)
-            strcount = 0
-            for msg_dict in ch_data:
-               if isinstance(msg_dict["t"], str):
-                  strcount += 1
-            buf += str(len(ch_data)) + " with " + str(strcount) + " str (#" + ch.name + ")\n"
+            ch_name = ch_id # Offline instances can't look up channel names.
+            if not self._client is None:
+               ch = self._client.search_for_channel(ch_id, enablenamesearch=False, serverrestriction=None)
+               ch_name = ch.name
+            buf += str(len(ch_data)) + " (#" + ch_name + ")"
+            try:
+               segments = self._manifests[(serv_id, ch_id)]["segments"]
+               on_disk = sum(x["count"] for x in segments)
+               kib = sum(x["bytes"] for x in segments) // 1024
+               buf += " + {} on disk in {} segments ({} KiB)".format(str(on_disk), str(len(segments)), str(kib))
+            except KeyError:
+               pass
+            buf += "\n"
       return buf
 
+# Runs a map_reduce() mapper over one shard. This runs in a worker process.
+def _map_shard(mapper, mapper_args, ch_id, filepaths, tail, deltas):
+   def read_segments():
+      for filepath in filepaths:
+         segment = messagesegment.SegmentView(filepath)
+         with segment:
+            for i in range(len(segment)):
+               yield messagesegment.MessageView(segment, i)
+      return
+   messages = itertools.chain(MessageCache._apply_deltas(read_segments(), deltas), tail)
+   return mapper(ch_id, messages, *mapper_args)
@@ -0,0 +1,198 @@
+import sys
+import os
+import csv
+import json
+import gzip
+import argparse
+
+from . import utils, messagerollup
+from .messagecache import MessageCache
+
+# Bulk export of cached messages and rollups, for offline analysis.
+#
+# Rows are streamed from the message cache's readers straight into a
+# gzip-compressed CSV or JSON Lines file, one at a time, so memory use stays
+# the same no matter how much is exported. Files are written under a
+# temporary name and only renamed once they're complete.
+#
+# Messages are exported with these fields:
+#    server, channel, id, timestamp (ISO 8601, UTC), author, content,
+#    attachments (json), embeds (json), flags (see MessageCache._message_dict())
+#
+# Rollups are exported with these fields:
+#    server, channel, bucket start (ISO 8601, UTC), author, followed by every
+#    total in messagerollup.TOTALS.
+#
+# Exports can also be made with the bot offline:
+#    python -m mentionbot.messageexport [cache directory] [server ID] [output file] ...
+
+FORMATS = ["csv", "jsonl"]
+KINDS = ["messages", "rollups"]
+
+MESSAGE_FIELDS = ["server", "channel", "id", "timestamp", "author", "content", "attachments", "embeds", "flags"]
+ROLLUP_FIELDS = ["server", "channel", "bucket start", "author"] + messagerollup.TOTALS
+
+_PROGRESS_INTERVAL = 5000 # Rows written between progress reports.
+
+# Generator yields a row for every cached message of the channels.
+# PARAMETER: since, until, authors - Passed on to MessageCache.read_messages(),
+#                                    so segment files without matching
+#                                    messages aren't read at all.
+def message_rows(message_cache, server_id, channel_ids, since=None, until=None, authors=None):
+   for ch_id in channel_ids:
+      for msg in message_cache.read_messages(server_id, ch_id, since=since, until=until, authors=authors):
+         yield {
+            "server": server_id,
+            "channel": ch_id,
+            "id": msg["i"],
+            "timestamp": msg["t"].isoformat(),
+            "author": msg["a"],
+            "content": msg["c"],
+            "attachments": json.dumps(msg["h"]),
+            "embeds": json.dumps(msg["e"]),
+            "flags": msg["f"],
+         }
+   return
+
+# Generator yields a row for every rollup bucket and author of the channels,
+# in order of bucket. Rollups are much smaller than the messages, so each
+# channel's rollup is read (and sorted) in one go.
+# PARAMETER: since, until - Buckets are kept if they start within this range.
+# PARAMETER: authors - If not None, only these users' rows are kept.
+def rollup_rows(message_cache, server_id, channel_ids, since=None, until=None, authors=None):
+   if not authors is None:
+      authors = set(str(x) for x in authors)
+   for ch_id in channel_ids:
+      rows = message_cache.read_rollup(server_id, ch_id)
+      rows.sort(key=lambda x: (x["t"], int(x["a"])))
+      for row in rows:
+         bucket_start = messagerollup.bucket_start(messagerollup.bucket_of(row["t"]))
+         if (not since is None) and (bucket_start < since):
+            continue
+         if (not until is None) and (bucket_start >= until):
+            continue
+         if (not authors is None) and (not row["a"] in authors):
+            continue
+         ret = {
+            "server": server_id,
+            "channel": ch_id,
+            "bucket start": bucket_start.isoformat(),
+            "author": row["a"],
+         }
+         for total_name in messagerollup.TOTALS:
+            ret[total_name] = row[total_name]
+         yield ret
+   return
+
+# Writes rows to a gzip-compressed file.
+# PARAMETER: progress - If not None, called as progress(rows_written) every
+#                       so often while writing. If it raises an exception,
+#                       the export is abandoned.
+# RETURNS: Number of rows written.
+def write_rows(rows, filepath, fmt, fields, progress=None):
+   if not fmt in FORMATS:
+      raise ValueError("Unknown export format: " + fmt)
+   utils.mkdir_recursive(filepath)
+   rows_written = 0
+   try:
+      with gzip.open(filepath + ".tmp", mode="wt", encoding="utf-8", newline="") as f:
+         writer = None
+         if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+         for row in rows:
+            if fmt == "csv":
+               writer.writerow(row)
+            else:
+               f.write(json.dumps(row, separators=(",", ":")) + "\n")
+            rows_written += 1
+            if (not progress is None) and (rows_written % _PROGRESS_INTERVAL == 0):
+               progress(rows_written)
+   except BaseException:
+      os.remove(filepath + ".tmp")
+      raise
+   os.replace(filepath + ".tmp", filepath)
+   if not progress is None:
+      progress(rows_written)
+   return rows_written
+
+# Exports a server's cached messages or rollups.
+# This blocks for as long as it takes, so the bot should run it in an
+# executor.
+# PARAMETER: channel_ids - If None, every channel cached for the server.
+# RETURNS: Number of rows written.
+def export(message_cache, filepath, server_id, kind="messages", fmt="csv", channel_ids=None, since=None, until=None, authors=None, progress=None):
+   if channel_ids is None:
+      channel_ids = message_cache.get_cached_channel_ids(server_id)
+   read_kwargs = {"since": since, "until": until, "authors": authors}
+   if kind == "messages":
+      rows = message_rows(message_cache, server_id, channel_ids, **read_kwargs)
+      fields = MESSAGE_FIELDS
+   elif kind == "rollups":
+      rows = rollup_rows(message_cache, server_id, channel_ids, **read_kwargs)
+      fields = ROLLUP_FIELDS
+   else:
+      raise ValueError("Unknown export kind: " + kind)
+   return write_rows(rows, filepath, fmt, fields, progress=progress)
+
+# RETURNS: The file extension for an export format.
+def get_file_extension(fmt):
+   return "." + fmt + ".gz"
+
+def run():
+   parser = argparse.ArgumentParser(
+      prog="python -m mentionbot.messageexport",
+      description="Exports cached messages or rollups to a gzip-compressed file. The bot must not be running.",
+   )
+   parser.add_argument("cache_directory", help="The bot's cache directory (containing messagecache/).")
+   parser.add_argument("server_id", help="ID of the server to export, or \"list\" to list cached servers.")
+   parser.add_argument("output", nargs="?", help="Output file path.")
+   parser.add_argument("--kind", choices=KINDS, default="messages")
+   parser.add_argument("--format", choices=FORMATS, default="csv")
+   parser.add_argument("--channel", action="append", dest="channels", help="Channel ID to export. (Can be repeated. Defaults to every cached channel.)")
+   parser.add_argument("--author", action="append", dest="authors", help="User ID to export. (Can be repeated. Defaults to everyone.)")
+   parser.add_argument("--since", help="Duration (e.g. 30d) or date to export from.")
+   parser.add_argument("--until", help="Duration (e.g. 30d) or date to export up to.")
+   args = parser.parse_args()
+
+   cache_directory = os.path.join(args.cache_directory, "")
+   message_cache = MessageCache.get_offline_instance(cache_directory)
+   if args.server_id == "list":
+      for server_id in message_cache.get_cached_server_ids():
+         num_channels = len(message_cache.get_cached_channel_ids(server_id))
+         print("{} ({} channels)".format(server_id, str(num_channels)))
+      return
+   if args.output is None:
+      parser.error("an output file path is required")
+   if not args.server_id in message_cache.get_cached_server_ids():
+      parser.error("server {} isn't cached".format(args.server_id))
+
+   try:
+      since = None
+      if not args.since is None:
+         since = utils.str_to_past_datetime(args.since)
+      until = None
+      if not args.until is None:
+         until = utils.str_to_past_datetime(args.until)
+   except ValueError as e:
+      parser.error(str(e).replace("`", ""))
+
+   def progress(rows_written):
+      print("\r{:,} rows written...".format(rows_written), end="", file=sys.stderr)
+      return
+   kwargs = {
+      "kind": args.kind,
+      "fmt": args.format,
+      "channel_ids": args.channels,
+      "since": since,
+      "until": until,
+      "authors": args.authors,
+      "progress": progress,
+   }
+   rows_written = export(message_cache, args.output, args.server_id, **kwargs)
+   print("", file=sys.stderr)
+   print("Exported {:,} rows to {}.".format(rows_written, args.output))
+   return
+
+if __name__ == '__main__':
+   run()
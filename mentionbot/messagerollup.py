@@ -0,0 +1,146 @@
+import datetime
+
+from . import messagesegment
+
+# Rollup tables for the message cache.
+#
+# A channel's rollup holds aggregate totals for every (bucket, author) pair,
+# where a bucket is a BUCKET_SECONDS interval of time. This is enough to
+# answer message/character/word count statistics without reading the
+# messages themselves.
+#
+# Buckets are 15 minutes long (rather than an hour) so that the day15min
+# statistics binning can still be answered exactly.
+#
+# TOTALS (in order):
+#    msgs      - Number of messages.
+#    chars     - Total length of message contents.
+#    words     - Total words in message contents (delimited by whitespace).
+#    wordchars - Total length of those words (i.e. excluding whitespace).
+
+BUCKET_SECONDS = 15 * 60
+TOTALS = ["msgs", "chars", "words", "wordchars"]
+
+_BUCKET_US = BUCKET_SECONDS * 1000000
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Columns needed to roll up messages read from segment files.
+SEGMENT_COLUMNS = ["t", "a", "c"]
+
+def bucket_of(timestamp):
+   return messagesegment.datetime_to_epoch_us(timestamp) // _BUCKET_US
+
+def bucket_start_seconds(bucket):
+   return bucket * BUCKET_SECONDS
+
+def bucket_start(bucket):
+   return _EPOCH + datetime.timedelta(seconds=bucket_start_seconds(bucket))
+
+# Rows are timestamped with the middle of their bucket, so that binning
+# functions that round down (e.g. to a day) put the whole bucket in the same
+# bin as its messages.
+def bucket_middle_seconds(bucket):
+   return (bucket * BUCKET_SECONDS) + (BUCKET_SECONDS // 2)
+
+def bucket_middle(bucket):
+   return _EPOCH + datetime.timedelta(seconds=bucket_middle_seconds(bucket))
+
+# RETURNS: A tuple of the message's totals, in the same order as TOTALS.
+def message_totals(msg_dict):
+   content = msg_dict["c"]
+   words = content.split()
+   wordchars = 0
+   for word in words:
+      wordchars += len(word)
+   return (1, len(content), len(words), wordchars)
+
+class ChannelRollup:
+   """
+   Totals for a single channel, keyed by (bucket, author ID).
+
+   Also keeps track of the segment file numbers that have been rolled up, so
+   that the message cache can tell which messages still need to be added.
+
+   Totals are replaced rather than modified in place, so a shallow copy of
+   self.totals is a consistent snapshot.
+   """
+
+   def __init__(self):
+      self.segments = set()
+      self.totals = {}
+      return
+
+   # Adds a message to the totals, or removes it if sign is -1.
+   def add(self, msg_dict, sign=1):
+      key = (bucket_of(msg_dict["t"]), msg_dict["a"])
+      to_add = message_totals(msg_dict)
+      try:
+         prev = self.totals[key]
+      except KeyError:
+         prev = (0, 0, 0, 0)
+      new = tuple(x + (y * sign) for (x, y) in zip(prev, to_add))
+      if not any(new):
+         self.totals.pop(key, None)
+      else:
+         self.totals[key] = new
+      return
+
+   def add_all(self, msg_dicts, sign=1):
+      for msg_dict in msg_dicts:
+         self.add(msg_dict, sign=sign)
+      return
+
+   # Adds the totals of another rollup into this one.
+   def merge(self, other):
+      for (key, to_add) in other.totals.items():
+         try:
+            prev = self.totals[key]
+         except KeyError:
+            prev = (0, 0, 0, 0)
+         new = tuple(x + y for (x, y) in zip(prev, to_add))
+         if not any(new):
+            self.totals.pop(key, None)
+         else:
+            self.totals[key] = new
+      self.segments |= other.segments
+      return
+
+   def to_json(self):
+      rows = [[k[0], k[1]] + list(v) for (k, v) in self.totals.items()]
+      return {"segments": sorted(self.segments), "rows": rows}
+
+   @classmethod
+   def from_json(cls, json_data):
+      self = cls()
+      self.segments = set(json_data["segments"])
+      for row in json_data["rows"]:
+         self.totals[(row[0], row[1])] = tuple(row[2:])
+      return self
+
+# Generator converts rollup totals into row dictionaries, where:
+#    "t" -> Middle of the bucket (naive UTC datetime).
+#    "a" -> Author ID.
+#    Every key in TOTALS -> That total.
+# The "t" and "a" keys mean the same as in a message dictionary, so binning
+# and filtering functions written for messages also work on rows.
+def iter_rows(totals):
+   for ((bucket, author_id), values) in totals.items():
+      row = {"t": bucket_middle(bucket), "a": author_id}
+      row.update(zip(TOTALS, values))
+      yield row
+   return
+
+# Converts rollup totals into columns, as a dict mapping:
+#    "t" -> List of bucket middle times, in seconds since the Unix epoch.
+#    "a" -> List of author IDs, as ints.
+#    Every key in TOTALS -> List of that total.
+def totals_to_columns(totals):
+   ret = {"t": [], "a": []}
+   for total_name in TOTALS:
+      ret[total_name] = []
+   for ((bucket, author_id), values) in totals.items():
+      ret["t"].append(bucket_middle_seconds(bucket))
+      ret["a"].append(int(author_id))
+      for (total_name, value) in zip(TOTALS, values):
+         ret[total_name].append(value)
+   return ret
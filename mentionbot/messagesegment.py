@@ -0,0 +1,586 @@
+import os
+import sys
+import mmap
+import json
+import struct
+import array
+import datetime
+import itertools
+import zlib
+
+import dateutil.parser
+
+# Columnar binary segment format for the message cache.
+#
+# Each segment file holds a batch of cached messages from a single channel,
+# stored column-by-column so that a scan only needs to decode the columns it
+# actually uses.
+#
+# FILE LAYOUT (all integers are little-endian):
+#
+#    Header:
+#       4 bytes  Magic number (b"MBSG")
+#       u16      Format version
+#       u16      Number of columns
+#       u32      Number of messages
+#    Column directory (one entry per column):
+#       1 byte   Column name (e.g. b"t")
+#       1 byte   Column type (see _COLTYPE_*)
+#       u16      Column flags (see _COLFLAG_*)
+#       u64      Offset of the column block from the start of the file
+#       u64      Length of the column block in bytes
+#    Column blocks (each starting on an 8-byte boundary):
+#       Fixed-width columns are simply an array of 64-bit integers.
+#       Variable-length columns are an array of u32 byte lengths (one per
+#       message), followed by all the UTF-8 payloads concatenated together.
+#       If a column has the _COLFLAG_ZLIB flag set, the whole block (as
+#       described above) is zlib-compressed, and the length in the directory
+#       is that of the compressed block.
+#
+# COLUMNS:
+#    t - Timestamp, as microseconds since the Unix epoch (i64).
+#    i - Message ID (u64).
+#    a - Author ID (u64).
+#    c - Message content (UTF-8).
+#    h - Attachments (compact JSON, UTF-8).
+#    e - Embeds (compact JSON, UTF-8).
+#    f - Flags string (UTF-8). (See MessageCache._message_dict().)
+
+SEGMENT_EXT = ".seg"
+LEGACY_EXT = ".json"
+
+_MAGIC = b"MBSG"
+_FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHI")
+_DIRENTRY = struct.Struct("<ccHQQ")
+
+_COLTYPE_I64 = b"q"
+_COLTYPE_U64 = b"Q"
+_COLTYPE_VARLEN = b"v"
+
+_COLFLAG_ZLIB = 0x0001
+
+_ZLIB_LEVEL = 6
+
+# Maps column name -> column type, in the order they are written.
+_COLUMNS = [
+   ("t", _COLTYPE_I64),
+   ("i", _COLTYPE_U64),
+   ("a", _COLTYPE_U64),
+   ("c", _COLTYPE_VARLEN),
+   ("h", _COLTYPE_VARLEN),
+   ("e", _COLTYPE_VARLEN),
+   ("f", _COLTYPE_VARLEN),
+]
+ALL_COLUMNS = tuple(x[0] for x in _COLUMNS)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+class SegmentFormatError(Exception):
+   pass
+
+#################################################################################
+# VALUE CONVERSION ##############################################################
+#################################################################################
+
+# Converts a naive UTC datetime object (as used by discord.py) into an integer
+# number of microseconds since the Unix epoch.
+def datetime_to_epoch_us(dt):
+   if not dt.tzinfo is None:
+      dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+   return (dt - _EPOCH) // _ONE_MICROSECOND
+
+def epoch_us_to_datetime(value):
+   return _EPOCH + datetime.timedelta(microseconds=value)
+
+def _encode_json(obj):
+   return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def _decode_json(data):
+   return json.loads(data.decode("utf-8"))
+
+def _encode_str(text):
+   return text.encode("utf-8")
+
+def _decode_str(data):
+   return data.decode("utf-8")
+
+# Maps column name -> (encode function, decode function)
+# Only used for variable-length columns.
+_VARLEN_CODECS = {
+   "c": (_encode_str, _decode_str),
+   "h": (_encode_json, _decode_json),
+   "e": (_encode_json, _decode_json),
+   "f": (_encode_str, _decode_str),
+}
+
+def _int64_array(typecode, values):
+   arr = array.array(typecode, values)
+   assert arr.itemsize == 8
+   if sys.byteorder != "little":
+      arr.byteswap()
+   return arr
+
+#################################################################################
+# WRITING #######################################################################
+#################################################################################
+
+# Writes a list of message dictionaries (see MessageCache._message_dict()) into
+# a new segment file.
+# The file is written to a temporary file first, then moved into place, so a
+# segment file is never seen half-written.
+# PARAMETER: compress - If True, every column is zlib-compressed. Compressed
+#                       segments are smaller, but can't be read zero-copy.
+# PARAMETER: fsync - If True, the file's contents are on disk before it's moved
+#                    into place. (The directory isn't synced.)
+# RETURNS: Size of the file in bytes.
+def write_segment(filepath, msg_dicts, compress=False, fsync=False):
+   count = len(msg_dicts)
+   blocks = []
+   for (col_name, col_type) in _COLUMNS:
+      if col_type == _COLTYPE_VARLEN:
+         encode = _VARLEN_CODECS[col_name][0]
+         payloads = [encode(d[col_name]) for d in msg_dicts]
+         lengths = array.array("I", (len(x) for x in payloads))
+         assert lengths.itemsize == 4
+         if sys.byteorder != "little":
+            lengths.byteswap()
+         block = lengths.tobytes() + b"".join(payloads)
+      elif col_name == "t":
+         block = _int64_array("q", (datetime_to_epoch_us(d["t"]) for d in msg_dicts)).tobytes()
+      else:
+         block = _int64_array("Q", (int(d[col_name]) for d in msg_dicts)).tobytes()
+      flags = 0
+      if compress:
+         block = zlib.compress(block, _ZLIB_LEVEL)
+         flags |= _COLFLAG_ZLIB
+      blocks.append((col_name, col_type, flags, block))
+
+   header = _HEADER.pack(_MAGIC, _FORMAT_VERSION, len(blocks), count)
+   offset = _HEADER.size + (_DIRENTRY.size * len(blocks))
+   directory = []
+   padded_blocks = []
+   for (col_name, col_type, flags, block) in blocks:
+      # Blocks are aligned so they can be used directly out of a memory map.
+      padding = -offset % 8
+      offset += padding
+      padded_blocks.append(bytes(padding))
+      padded_blocks.append(block)
+      directory.append(_DIRENTRY.pack(col_name.encode("ascii"), col_type, flags, offset, len(block)))
+      offset += len(block)
+
+   temp_filepath = filepath + ".tmp"
+   with open(temp_filepath, "wb") as f:
+      f.write(header)
+      f.write(b"".join(directory))
+      for block in padded_blocks:
+         f.write(block)
+      if fsync:
+         f.flush()
+         os.fsync(f.fileno())
+   os.replace(temp_filepath, filepath)
+   return offset
+
+#################################################################################
+# READING #######################################################################
+#################################################################################
+
+# Parses the header and column directory of a segment.
+# PARAMETER: buf - A buffer containing at least the whole header and column
+#                  directory.
+# RETURNS: A tuple (count, directory), where directory maps column name ->
+#          (column type, column flags, offset, length).
+def _parse_directory(buf):
+   if len(buf) < _HEADER.size:
+      raise SegmentFormatError("Truncated segment header.")
+   (magic, version, n_columns, count) = _HEADER.unpack_from(buf, 0)
+   if magic != _MAGIC:
+      raise SegmentFormatError("Not a message cache segment.")
+   if version != _FORMAT_VERSION:
+      raise SegmentFormatError("Unsupported segment format version {}.".format(str(version)))
+   if len(buf) < _HEADER.size + (_DIRENTRY.size * n_columns):
+      raise SegmentFormatError("Truncated segment column directory.")
+   directory = {}
+   for i in range(n_columns):
+      entry_offset = _HEADER.size + (i * _DIRENTRY.size)
+      (col_name, col_type, flags, offset, length) = _DIRENTRY.unpack_from(buf, entry_offset)
+      directory[col_name.decode("ascii")] = (col_type, flags, offset, length)
+   return (count, directory)
+
+def _read_directory(f):
+   buf = f.read(_HEADER.size)
+   if len(buf) == _HEADER.size:
+      n_columns = _HEADER.unpack(buf)[2]
+      buf += f.read(_DIRENTRY.size * n_columns)
+   return _parse_directory(buf)
+
+# Decodes a single column block into a list of Python values.
+def _decode_column(col_name, col_type, block, count):
+   if col_type == _COLTYPE_VARLEN:
+      decode = _VARLEN_CODECS[col_name][1]
+      lengths = array.array("I")
+      lengths.frombytes(block[:count * 4])
+      if sys.byteorder != "little":
+         lengths.byteswap()
+      ret = []
+      start = count * 4
+      for end in itertools.accumulate(lengths):
+         end += count * 4
+         ret.append(decode(block[start:end]))
+         start = end
+      return ret
+   arr = array.array(col_type.decode("ascii"))
+   arr.frombytes(block)
+   if sys.byteorder != "little":
+      arr.byteswap()
+   if col_name == "t":
+      return [epoch_us_to_datetime(x) for x in arr]
+   else:
+      return [str(x) for x in arr]
+
+# Reads the selected columns of a segment.
+# PARAMETER: columns - An iterable of column names to read, or None to read
+#                      every column.
+# RETURNS: A tuple (count, columns_dict), where columns_dict maps column
+#          name -> list of values.
+def read_segment_columns(filepath, columns=None):
+   if columns is None:
+      columns = ALL_COLUMNS
+   ret = {}
+   with open(filepath, "rb") as f:
+      (count, directory) = _read_directory(f)
+      for col_name in columns:
+         (col_type, flags, offset, length) = directory[col_name]
+         f.seek(offset)
+         block = f.read(length)
+         if flags & _COLFLAG_ZLIB:
+            block = zlib.decompress(block)
+         ret[col_name] = _decode_column(col_name, col_type, block, count)
+   return (count, ret)
+
+# Generator reads a segment, yielding message dictionaries in the same form
+# as MessageCache._message_dict(), except that only the selected columns are
+# present.
+def read_segment(filepath, columns=None):
+   (count, cols) = read_segment_columns(filepath, columns=columns)
+   col_items = list(cols.items())
+   for i in range(count):
+      yield {k: v[i] for (k, v) in col_items}
+
+#################################################################################
+# ZERO-COPY READING #############################################################
+#################################################################################
+
+class SegmentView:
+   """
+   A read-only, memory-mapped view of a segment file.
+
+   Columns are only located (and variable-length offsets only computed) the
+   first time they are accessed, and values are only decoded when they are
+   individually requested through a MessageView. This means a scan that only
+   looks at, say, authors never touches the content column at all.
+
+   Must be closed after use (or used as a context manager). Any MessageView
+   objects obtained from it stop working once it's closed.
+   """
+
+   def __init__(self, filepath):
+      with open(filepath, "rb") as f:
+         try:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+         except ValueError:
+            raise SegmentFormatError("Empty segment file.")
+      self._buf = memoryview(self._mm)
+      self._views = [] # All derived memoryviews, to be released on close().
+      self._columns = {} # Maps column name -> column accessor tuple.
+      try:
+         (self._count, self._directory) = _parse_directory(self._buf)
+      except:
+         self.close()
+         raise
+      return
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+      return False
+
+   def __len__(self):
+      return self._count
+
+   def close(self):
+      if self._mm is None:
+         return
+      self._columns = {}
+      for view in reversed(self._views):
+         view.release()
+      self._views = []
+      self._buf.release()
+      try:
+         self._mm.close()
+      except BufferError:
+         pass # A stray export still exists. The map is freed when it's collected.
+      self._mm = None
+      return
+
+   def has_column(self, col_name):
+      return col_name in self._directory
+
+   def is_compressed(self):
+      return any(x[1] & _COLFLAG_ZLIB for x in self._directory.values())
+
+   # Returns the raw integer value of a fixed-width column.
+   def get_int(self, col_name, index):
+      return self._get_column(col_name)[1][index]
+
+   # Returns the raw UTF-8 bytes of a variable-length column as a memoryview.
+   # The memoryview must not outlive this object.
+   def get_raw(self, col_name, index):
+      (col_type, offsets, payload) = self._get_column(col_name)
+      return payload[offsets[index]:offsets[index + 1]]
+
+   # Returns the decoded value of a column, in the same form as found in
+   # MessageCache._message_dict().
+   def get_value(self, col_name, index):
+      column = self._get_column(col_name)
+      if column[0] == _COLTYPE_VARLEN:
+         (col_type, offsets, payload) = column
+         raw = payload[offsets[index]:offsets[index + 1]]
+         if col_name == "h" or col_name == "e":
+            return json.loads(str(raw, "utf-8"))
+         return str(raw, "utf-8")
+      elif col_name == "t":
+         return epoch_us_to_datetime(column[1][index])
+      else:
+         return str(column[1][index])
+
+   def _get_column(self, col_name):
+      try:
+         return self._columns[col_name]
+      except KeyError:
+         pass
+      (col_type, flags, offset, length) = self._directory[col_name]
+      block = self._buf[offset:offset + length]
+      if flags & _COLFLAG_ZLIB:
+         # Compressed columns are decompressed into memory in one go.
+         compressed = block
+         block = memoryview(zlib.decompress(compressed))
+         compressed.release()
+      self._views.append(block)
+      if col_type == _COLTYPE_VARLEN:
+         lengths = self._fixed_view(b"I", block[:self._count * 4])
+         offsets = [0]
+         offsets.extend(itertools.accumulate(lengths))
+         payload = block[self._count * 4:]
+         self._views.append(payload)
+         column = (col_type, offsets, payload)
+      else:
+         column = (col_type, self._fixed_view(col_type, block))
+      self._columns[col_name] = column
+      return column
+
+   # PARAMETER: block - A memoryview of an array of integers.
+   def _fixed_view(self, typecode, block):
+      block = block[:]
+      if sys.byteorder == "little":
+         # Zero-copy. Values are read straight out of the memory map.
+         view = block.cast(typecode.decode("ascii"))
+         self._views.append(block)
+         self._views.append(view)
+         return view
+      else:
+         arr = array.array(typecode.decode("ascii"))
+         arr.frombytes(block)
+         arr.byteswap()
+         block.release()
+         return arr
+
+class MessageView:
+   """
+   A lightweight, read-only stand-in for a message dictionary, backed by a
+   SegmentView. Supports d["key"] and d.get("key") with the same keys and
+   value types as MessageCache._message_dict().
+
+   Fields are decoded every time they're accessed, so consumers that need a
+   field more than once should hold on to the value. Use to_dict() to get an
+   ordinary dictionary that remains valid after the segment is closed.
+   """
+
+   __slots__ = ["_segment", "_index"]
+
+   def __init__(self, segment, index):
+      self._segment = segment
+      self._index = index
+      return
+
+   def __getitem__(self, key):
+      try:
+         return self._segment.get_value(key, self._index)
+      except KeyError:
+         raise KeyError(key)
+
+   def __contains__(self, key):
+      return self._segment.has_column(key)
+
+   def get(self, key, default=None):
+      if not self._segment.has_column(key):
+         return default
+      return self._segment.get_value(key, self._index)
+
+   def keys(self):
+      return [x for x in ALL_COLUMNS if self._segment.has_column(x)]
+
+   def to_dict(self):
+      return {k: self[k] for k in self.keys()}
+
+   # Faster access to raw integer fields (no string conversion).
+   @property
+   def author_int(self):
+      return self._segment.get_int("a", self._index)
+
+   @property
+   def id_int(self):
+      return self._segment.get_int("i", self._index)
+
+   @property
+   def epoch_us(self):
+      return self._segment.get_int("t", self._index)
+
+# Generator yields a MessageView for every message in a segment.
+# The segment is closed once the generator is exhausted or closed, so views
+# must not be retained beyond the loop iteration that produced them (use
+# MessageView.to_dict() for that).
+def iter_segment_views(filepath):
+   with SegmentView(filepath) as segment:
+      for i in range(len(segment)):
+         yield MessageView(segment, i)
+   return
+
+#################################################################################
+# INDEXING ######################################################################
+#################################################################################
+
+# A segment index entry is a small summary of a segment file that is kept in
+# the channel's channel.json, allowing readers to skip whole files that can't
+# contain any message they're interested in. An entry looks like:
+#    {
+#       "n": 3,               # Segment file number.
+#       "count": 200,         # Number of messages.
+#       "bytes": 41872,       # Size of the file.
+#       "min t": 1462...,     # Earliest timestamp (microseconds since epoch).
+#       "max t": 1462...,     # Latest timestamp (microseconds since epoch).
+#       "min id": "1...",     # Smallest message ID.
+#       "max id": "1...",     # Largest message ID.
+#       "authors": ["1...", "2..."], # Sorted list of author IDs.
+#       "compressed": True,   # Only present (and True) for compressed segments.
+#    }
+
+def _index_entry(file_number, num_bytes, timestamps_us, id_ints, author_ints):
+   entry = {"n": file_number, "count": len(timestamps_us), "bytes": num_bytes}
+   if len(timestamps_us) > 0:
+      entry["min t"] = min(timestamps_us)
+      entry["max t"] = max(timestamps_us)
+      entry["min id"] = str(min(id_ints))
+      entry["max id"] = str(max(id_ints))
+   else:
+      entry["min t"] = entry["max t"] = 0
+      entry["min id"] = entry["max id"] = "0"
+   entry["authors"] = [str(x) for x in sorted(set(author_ints))]
+   return entry
+
+# Builds an index entry from the message dictionaries written to a segment.
+def index_messages(file_number, num_bytes, msg_dicts):
+   timestamps_us = [datetime_to_epoch_us(d["t"]) for d in msg_dicts]
+   id_ints = [int(d["i"]) for d in msg_dicts]
+   author_ints = [int(d["a"]) for d in msg_dicts]
+   return _index_entry(file_number, num_bytes, timestamps_us, id_ints, author_ints)
+
+# Builds an index entry by reading an existing segment file.
+# Only the timestamp, ID and author columns are touched.
+def index_segment(file_number, filepath):
+   num_bytes = os.path.getsize(filepath)
+   with SegmentView(filepath) as segment:
+      timestamps_us = [segment.get_int("t", i) for i in range(len(segment))]
+      id_ints = [segment.get_int("i", i) for i in range(len(segment))]
+      author_ints = [segment.get_int("a", i) for i in range(len(segment))]
+      compressed = segment.is_compressed()
+   entry = _index_entry(file_number, num_bytes, timestamps_us, id_ints, author_ints)
+   if compressed:
+      entry["compressed"] = True
+   return entry
+
+# Returns False if the segment described by an index entry definitely has no
+# message matching the given constraints. Any constraint may be None.
+# PARAMETER: since_us - Earliest timestamp (inclusive).
+# PARAMETER: until_us - Latest timestamp (exclusive).
+# PARAMETER: author_strs - A set of author IDs (as strings).
+def index_may_match(entry, since_us, until_us, author_strs):
+   if entry["count"] == 0:
+      return False
+   if (not since_us is None) and (entry["max t"] < since_us):
+      return False
+   if (not until_us is None) and (entry["min t"] >= until_us):
+      return False
+   if (not author_strs is None) and author_strs.isdisjoint(entry["authors"]):
+      return False
+   return True
+
+#################################################################################
+# LEGACY JSON MIGRATION #########################################################
+#################################################################################
+
+# Converts every numbered json file in a channel directory (the format used
+# before segment files) into a segment file of the same number.
+# Each json file is only removed after its replacement has been written.
+# RETURNS: Number of files converted.
+def migrate_json_channel_dir(ch_dir):
+   converted = 0
+   for file_name in os.listdir(ch_dir):
+      if not file_name.endswith(LEGACY_EXT):
+         continue
+      try:
+         file_number = int(file_name[:-len(LEGACY_EXT)])
+      except ValueError:
+         continue # Skips channel.json.
+      json_filepath = os.path.join(ch_dir, file_name)
+      with open(json_filepath, encoding="utf-8", mode="r") as f:
+         msg_dicts = json.loads(f.read())
+      for msg_dict in msg_dicts:
+         msg_dict["t"] = dateutil.parser.parse(msg_dict["t"])
+      write_segment(os.path.join(ch_dir, str(file_number) + SEGMENT_EXT), msg_dicts)
+      os.remove(json_filepath)
+      converted += 1
+   return converted
+
+# Converts an entire message cache directory tree.
+# (i.e. messagecache/<server>/<channel>/*.json)
+# RETURNS: Number of files converted.
+def migrate_json_tree(data_dir):
+   converted = 0
+   if not os.path.isdir(data_dir):
+      return converted
+   for server_id in os.listdir(data_dir):
+      server_dir = os.path.join(data_dir, server_id)
+      if not os.path.isdir(server_dir):
+         continue
+      for ch_id in os.listdir(server_dir):
+         ch_dir = os.path.join(server_dir, ch_id)
+         if os.path.isdir(ch_dir):
+            converted += migrate_json_channel_dir(ch_dir)
+   return converted
+
+def run():
+   if len(sys.argv) != 2:
+      print("Usage: python -m mentionbot.messagesegment [messagecache directory]")
+      print("Converts numbered json files into segment files. The bot must not be running.")
+      sys.exit(2)
+   converted = migrate_json_tree(sys.argv[1])
+   print("Converted {} files.".format(str(converted)))
+   return
+
+if __name__ == '__main__':
+   run()
@@ -0,0 +1,156 @@
+import collections
+
+from . import utils
+
+# Declarative message preprocessor rules.
+#
+# Rather than implementing msg_preprocessor(), server modules can register a
+# list of rules, each rewriting content that begins with some literal prefix
+# (e.g. "++" or the server's command prefix). Optionally, the rest of the
+# content must also match a regex, or its first word must be found in a
+# lookup table.
+#
+# ServerModuleGroup compiles every module's rules into a single
+# CompiledPreprocessor, which indexes them by the first character of their
+# prefix. Most messages don't begin with any of them, so they're let through
+# after a single dict lookup without calling into any module.
+#
+# Rules keep the same daisy-chained order as msg_preprocessor(). Modules are
+# tried in the order they were installed, each module's rules are tried in
+# the order they were registered, and once one of a module's rules rewrites
+# the content, the rest of that module's rules are skipped.
+
+# Used in place of a prefix to mean the server's command prefix.
+CMD_PREFIX = utils.SecretToken()
+
+# content - The content being preprocessed.
+# cmd_prefix - The server's command prefix.
+# rest - The content after the prefix.
+# word, args - rest, split into its first word and everything after it.
+# regex_match - The rule's regex matched against rest, or None if the rule has
+#               no regex.
+# value - If the rule's lookup table is a dict, the word's value in it.
+#         Otherwise, None.
+RuleMatch = collections.namedtuple("RuleMatch", ["content", "cmd_prefix", "rest", "word", "args", "regex_match", "value"])
+
+class PreprocessorRule:
+   """
+   Rewrites message content beginning with a prefix.
+
+   Everything but the rewrite is checked without calling into the module.
+   """
+
+   # PARAMETER: prefix - Literal text the content must begin with, or
+   #                     CMD_PREFIX. An empty string matches everything.
+   # PARAMETER: rewrite - Coroutine function called as rewrite(match, msg)
+   #                      (where match is a RuleMatch) if the rule matches.
+   #                      Returns the new content, or None to leave the
+   #                      content as it is.
+   # PARAMETER: ignore_case - If True, the prefix is matched ignoring case.
+   # PARAMETER: regex - If not None, a compiled regex that must match the
+   #                    beginning of the content after the prefix.
+   # PARAMETER: lookup - If not None, a set or dict that must contain the
+   #                     first word after the prefix.
+   # PARAMETER: lookup_key - If not None, a function applied to the first word
+   #                         before it's looked up (e.g. str.upper).
+   # PARAMETER: guard - If not None, a function called without arguments. If
+   #                    it returns False, the rule doesn't match. It's only
+   #                    called once everything else matches.
+   def __init__(self, prefix, rewrite, ignore_case=False, regex=None, lookup=None, lookup_key=None, guard=None):
+      self.prefix = prefix
+      self.rewrite = rewrite
+      self.ignore_case = ignore_case
+      self.regex = regex
+      self.lookup = lookup
+      self.lookup_key = lookup_key
+      self.guard = guard
+      return
+
+   # PARAMETER: prefix - self.prefix, with CMD_PREFIX substituted.
+   # RETURNS: A RuleMatch, or None if the rule doesn't match.
+   def match(self, content, prefix, cmd_prefix):
+      if self.ignore_case:
+         if not content[:len(prefix)].lower() == prefix.lower():
+            return None
+      elif not content.startswith(prefix):
+         return None
+      rest = content[len(prefix):]
+      (word, args) = utils.separate_left_word(rest)
+      regex_match = None
+      if not self.regex is None:
+         regex_match = self.regex.match(rest)
+         if not regex_match:
+            return None
+      value = None
+      if not self.lookup is None:
+         key = word
+         if not self.lookup_key is None:
+            key = self.lookup_key(word)
+         if not key in self.lookup:
+            return None
+         if isinstance(self.lookup, dict):
+            value = self.lookup[key]
+      if (not self.guard is None) and (not self.guard()):
+         return None
+      return RuleMatch(content, cmd_prefix, rest, word, args, regex_match, value)
+
+class CompiledPreprocessor:
+   """
+   Every installed module's preprocessor rules, indexed by first character.
+   """
+
+   # PARAMETER: module_rules - List of tuples (module, rules), in the order the
+   #                           modules are to be run in. module is a
+   #                           ServerModuleWrapper.
+   def __init__(self, module_rules, cmd_prefix):
+      self.cmd_prefix = cmd_prefix
+      entries = [] # List of (module position, module, rule, prefix)
+      for (position, (module, rules)) in enumerate(module_rules):
+         for rule in rules:
+            prefix = rule.prefix
+            if prefix is CMD_PREFIX:
+               prefix = cmd_prefix
+            entries.append((position, module, rule, prefix))
+
+      # Rules with an empty prefix are tried on everything, so they're added
+      # to every list.
+      self._always = [x for x in entries if len(x[3]) == 0]
+      self._index = {} # Maps first character -> list of entries, in order
+      for (position, module, rule, prefix) in entries:
+         if len(prefix) == 0:
+            continue
+         self._index[prefix[0]] = []
+         if rule.ignore_case:
+            self._index[prefix[0].lower()] = []
+            self._index[prefix[0].upper()] = []
+      for entry in entries:
+         (position, module, rule, prefix) = entry
+         for (first_char, char_entries) in self._index.items():
+            if (len(prefix) == 0) or (first_char == prefix[0]):
+               char_entries.append(entry)
+            elif rule.ignore_case and (first_char.lower() == prefix[0].lower()):
+               char_entries.append(entry)
+      return
+
+   async def run(self, content, msg):
+      next_position = 0 # Modules before this have already rewritten content.
+      entries = self._index.get(content[:1], self._always)
+      i = 0
+      while i < len(entries):
+         (position, module, rule, prefix) = entries[i]
+         i += 1
+         if position < next_position:
+            continue
+         if not module.is_active():
+            continue
+         match = rule.match(content, prefix, self.cmd_prefix)
+         if match is None:
+            continue
+         new_content = await module.call_registered_handler(rule.rewrite, match, msg)
+         if new_content is None:
+            continue
+         content = new_content
+         next_position = position + 1
+         entries = self._index.get(content[:1], self._always)
+         i = 0
+      return content
@@ -0,0 +1,127 @@
+import os
+import json
+import hashlib
+import collections
+
+from . import utils
+
+# On-disk cache of command results.
+#
+# A result is a file (e.g. a rendered graph), a message, or both. Results are
+# looked up by a key, which can be any json-serializable value that captures
+# everything the result depends on. Nothing is ever invalidated explicitly.
+# Instead, keys include things like message cache watermarks, so that a
+# stale result just stops being looked up, and is eventually evicted.
+
+class ResultCache:
+   """
+   Stores results in a directory, evicting the least recently used results
+   once their files and messages add up to more than max_bytes.
+
+   The index (which results exist, and in what order they were last used)
+   is saved to index.json whenever results are added or removed, so results
+   survive restarts. Looking a result up only reorders the index in memory,
+   so it's saved along with the next change. (Lookups since then only affect
+   which results get evicted first.)
+   """
+
+   _INDEX_FILENAME = "index.json"
+
+   def __init__(self, directory, max_bytes):
+      self._directory = directory
+      self._max_bytes = max_bytes
+      self._entries = collections.OrderedDict()
+      # Maps key digest -> entry dict, from least to most recently used.
+      # An entry dict has:
+      #    "file"    -> Name of the result file in the directory, or None.
+      #    "message" -> Result message, or None.
+      #    "bytes"   -> Size of the file and message.
+      self._total_bytes = 0
+      utils.mkdir_recursive(self._directory + self._INDEX_FILENAME)
+
+      try:
+         index = utils.json_read(self._directory + self._INDEX_FILENAME)
+      except (FileNotFoundError, ValueError):
+         index = []
+      for (digest, entry) in index:
+         if (not entry["file"] is None) and (not os.path.isfile(self._directory + entry["file"])):
+            continue
+         self._entries[digest] = entry
+         self._total_bytes += entry["bytes"]
+      return
+
+   @classmethod
+   def _digest(cls, key):
+      key_json = json.dumps(key, sort_keys=True, separators=(",", ":"))
+      return hashlib.sha1(key_json.encode("utf-8")).hexdigest()
+
+   # RETURNS: A tuple (filepath, message) of the cached result, where either
+   #          may be None. Returns None if there is no cached result.
+   def get(self, key):
+      digest = self._digest(key)
+      try:
+         entry = self._entries[digest]
+      except KeyError:
+         return None
+      self._entries.move_to_end(digest)
+      filepath = None
+      if not entry["file"] is None:
+         filepath = self._directory + entry["file"]
+      return (filepath, entry["message"])
+
+   # Adds a result to the cache, replacing any result with the same key.
+   # PARAMETER: filepath - If not None, the result file. It is moved into the
+   #                       cache directory (or deleted, if it's too big).
+   # PARAMETER: message - If not None, the result message.
+   def put(self, key, filepath=None, message=None):
+      digest = self._digest(key)
+      self._remove(digest)
+      num_bytes = 0
+      if not message is None:
+         num_bytes += len(message.encode("utf-8"))
+      if not filepath is None:
+         num_bytes += os.path.getsize(filepath)
+      if num_bytes > self._max_bytes:
+         if not filepath is None:
+            os.remove(filepath)
+         return
+
+      entry = {"file": None, "message": message, "bytes": num_bytes}
+      if not filepath is None:
+         entry["file"] = digest + os.path.splitext(filepath)[1]
+         os.replace(filepath, self._directory + entry["file"])
+      self._entries[digest] = entry
+      self._total_bytes += num_bytes
+      while self._total_bytes > self._max_bytes:
+         self._remove(next(iter(self._entries)))
+      self._save_index()
+      return
+
+   def clear(self):
+      for digest in list(self._entries):
+         self._remove(digest)
+      self._save_index()
+      return
+
+   # RETURNS: A tuple (number of results, total bytes).
+   def get_size(self):
+      return (len(self._entries), self._total_bytes)
+
+   def _remove(self, digest):
+      try:
+         entry = self._entries.pop(digest)
+      except KeyError:
+         return
+      self._total_bytes -= entry["bytes"]
+      if not entry["file"] is None:
+         try:
+            os.remove(self._directory + entry["file"])
+         except FileNotFoundError:
+            pass
+      return
+
+   def _save_index(self):
+      index_filepath = self._directory + self._INDEX_FILENAME
+      utils.json_write(index_filepath + ".tmp", data=list(self._entries.items()))
+      os.replace(index_filepath + ".tmp", index_filepath)
+      return
@@ -8,13 +8,15 @@ import copy
 import traceback
 import collections
 import textwrap
+import functools
 
 import discord
 
-from . import utils, errors, cmd
+from . import utils, errors, cmd, messageexport
 from .helpnode import HelpNode
 from .enums import PrivilegeLevel
 
+from .commanddispatch import CommandDispatchTable, CustomCommand
 from .servermodulegroup import ServerModuleGroup
 from .serverpersistentstorage import ServerPersistentStorage
 from .privilegemanager import PrivilegeManager
@@ -163,6 +165,8 @@ class ServerBotInstance:
       self._module_factory = await ServerModuleFactory.get_instance(self._client, self._server)
 
       self._modules = None # Initialize later
+      self._custom_cmds = {} # Maps command name -> CustomCommand
+      self._dispatch = None # CommandDispatchTable. Initialize later
 
       # Load and apply server settings
 
@@ -193,6 +197,7 @@ class ServerBotInstance:
       self._cmd_prefix = self._storage.get_prefix(self._default_command_prefix)
       self._main_help_content = self._storage.get_main_help_content()
 
+      self._rebuild_dispatch_table()
       return self
 
    def __init__(self, token):
@@ -231,45 +236,62 @@ class ServerBotInstance:
       await self._modules.on_message(msg, privilege_level)
       if privilege_level == PrivilegeLevel.NO_PRIVILEGE:
          return # Without warning.
+      await self._process_custom_cmd(msg)
       substr = await self._modules.msg_preprocessor(substr, msg, self._cmd_prefix)
 
-      
-      bot_mention = "<@{}>".format(str(self._client.user.id))
-      bot_mention2 = "<@!{}>".format(str(self._client.user.id))
-      
-      begins_with_bot_mention = False
-      bot_mention_len = None
-      match = utils.re_user_mention.match(substr)
-      if match:
-         uid = utils.umention_str_to_id(substr[match.start():match.end()])
-         if uid == str(self._client.user.id):
-            begins_with_bot_mention = True
-            bot_mention_len = match.end() - match.start()
-
-      is_command = False
-      if substr.startswith(self._cmd_prefix):
-         substr = substr[len(self._cmd_prefix):].strip()
-         is_command = True
-      elif begins_with_bot_mention:
-         # If message starts with this bot being mentioned, treat it as a command.
-         # This is done as a guaranteed way of invoking commands.
-         # Useful when multiple bots share the same command predicate.
-         substr = substr[bot_mention_len:].strip()
-         is_command = True
-         if len(substr) == 0:
-            substr = "help"
-
-      if is_command:
-         print("processing command: {pf}" + utils.str_asciionly(substr)) # Intentional un-substituted "{pf}"
-         
-         cmd_to_execute = None
-         (left, right) = utils.separate_left_word(substr)
-         if left in self._cmdd:
-            cmd_fn = await cmd.get(self._cmdd, left, privilege_level)
-            await cmd_fn(self, right, msg, privilege_level)
-         else:
-            # Execute a module command. This will also handle command failure.
-            await self._modules.process_cmd(substr, msg, privilege_level, silentfail=True)
+      command = self._dispatch.parse(substr)
+      if command is None:
+         return
+      (left, right) = command
+      print("processing command: {pf}" + utils.str_asciionly((left + " " + right).strip())) # Intentional un-substituted "{pf}"
+
+      entry = self._dispatch.get(left)
+      if (not entry is None) and (not entry.core is None):
+         cmd_fn = await cmd.get(self._cmdd, left, privilege_level)
+         await cmd_fn(self, right, msg, privilege_level)
+      elif (not entry is None) and (not entry.module is None):
+         # Execute a module command. This will also handle command failure.
+         await entry.module.process_cmd(right, msg, privilege_level, left)
+      else:
+         raise errors.SilentUnknownCommandError
+      return
+
+   # Custom commands are invoked from the message's original content, and
+   # are carried out alongside any core or module command of the same name.
+   async def _process_custom_cmd(self, msg):
+      custom_command = self._dispatch.parse_custom(msg.content)
+      if custom_command is None:
+         return
+      (custom_cmd, cmd_name, substr, is_help) = custom_command
+      if is_help:
+         await custom_cmd.module.call_registered_handler(custom_cmd.help_handler, msg, cmd_name)
+      else:
+         await custom_cmd.module.call_registered_handler(custom_cmd.handler, substr, msg, cmd_name)
+      return
+
+   # Replaces the custom commands served by a module.
+   # (See commanddispatch.CustomCommand.)
+   def set_custom_commands(self, module, cmd_names, handler, help_handler):
+      self._custom_cmds = {k: v for (k, v) in self._custom_cmds.items() if not v.module is module}
+      custom_cmd = CustomCommand(module=module, handler=handler, help_handler=help_handler)
+      for cmd_name in cmd_names:
+         self._custom_cmds[cmd_name] = custom_cmd
+      # Modules are activated before the dispatch table is first built.
+      if not self._dispatch is None:
+         self._rebuild_dispatch_table()
+      return
+
+   def preprocessor_rules_changed(self):
+      # Modules are activated before the module group is created.
+      if not self._modules is None:
+         self._modules.preprocessor_rules_changed()
+      return
+
+   # Must be called whenever the command prefix, installed modules or custom
+   # commands change.
+   def _rebuild_dispatch_table(self):
+      args = (self._cmd_prefix, self._client.user.id, self._cmdd, self._modules.get_modules_cmd_dict(), self._custom_cmds)
+      self._dispatch = CommandDispatchTable(*args)
       return
 
    async def on_member_join(self, member):
@@ -567,6 +589,91 @@ class ServerBotInstance:
       else:
          return await self._client.send_msg(msg, str(msg.server.icon_url))
 
+   ##############################
+   ### ANALYTICS JOB COMMANDS ###
+   ##############################
+
+   @cmd.add(_cmdd, "jobs")
+   @_core_command(_helpd, "admin")
+   @cmd.category("Analytics Jobs")
+   @cmd.minimum_privilege(PrivilegeLevel.ADMIN)
+   async def _cmdf_jobs(self, substr, msg, privilege_level):
+      """`{cmd}` - List this server's running, queued and recently finished analytics jobs."""
+      jobs = self._client.job_scheduler.get_jobs(server_id=self._server.id)
+      if len(jobs) == 0:
+         buf = "No analytics jobs."
+      else:
+         buf = "\n".join([x.get_status_str() for x in jobs])
+      await self._client.send_msg(msg, buf)
+      return
+
+   @cmd.add(_cmdd, "cancel", "canceljob")
+   @_core_command(_helpd, "admin")
+   @cmd.category("Analytics Jobs")
+   @cmd.minimum_privilege(PrivilegeLevel.ADMIN)
+   async def _cmdf_cancel(self, substr, msg, privilege_level):
+      """`{cmd} [job number]` - Cancel a queued or running analytics job."""
+      substr = substr.strip()
+      if substr.startswith("#"):
+         substr = substr[1:]
+      try:
+         job_id = int(substr)
+      except ValueError:
+         raise errors.InvalidCommandArgumentsError
+      if self._client.job_scheduler.cancel(job_id, server_id=self._server.id):
+         buf = "Cancelling job #{}.".format(str(job_id))
+      else:
+         buf = "Error: No queued or running job #{} in this server.".format(str(job_id))
+      await self._client.send_msg(msg, buf)
+      return
+
+   @cmd.add(_cmdd, "msgexport", "exportmessages")
+   @_core_command(_helpd, "admin")
+   @cmd.category("Analytics Jobs")
+   @cmd.minimum_privilege(PrivilegeLevel.ADMIN)
+   async def _cmdf_msgexport(self, substr, msg, privilege_level):
+      """
+      `{cmd}` - Export this server's cached messages to a gzip-compressed CSV file.
+      `{cmd} [messages|rollups] [csv|jsonl] [since:30d] [until:2016-01-01]` - Same, but choosing what's exported, the file format, and the time range.
+
+      The file is saved on the bot's host. For access to it, ask the bot owner.
+      """
+      kwargs = {"kind": "messages", "fmt": "csv"}
+      for term in substr.split():
+         (name, _, value) = term.partition(":")
+         if term in messageexport.KINDS:
+            kwargs["kind"] = term
+         elif term in messageexport.FORMATS:
+            kwargs["fmt"] = term
+         elif name in ["since", "until"]:
+            try:
+               kwargs[name] = utils.str_to_past_datetime(value)
+            except ValueError:
+               raise errors.InvalidCommandArgumentsError
+         else:
+            raise errors.InvalidCommandArgumentsError
+
+      timestamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+      filename = kwargs["kind"] + "_" + timestamp + messageexport.get_file_extension(kwargs["fmt"])
+      filepath = self._client.get_cache_dirname() + "exports/" + self._server.id + "/" + filename
+
+      async def run_job(job):
+         job.set_phase("Exporting " + kwargs["kind"] + "...")
+         def progress(rows_written):
+            job.scanned = rows_written
+            job.check_cancelled()
+            return
+         fn_kwargs = dict(kwargs, progress=progress)
+         fn = functools.partial(self._client.message_cache_export, filepath, self._server.id, **fn_kwargs)
+         rows_written = await job.run_in_executor(fn)
+         buf = "Exported {:,} rows to `{}`.".format(rows_written, filepath)
+         await self._client.send_msg(msg, buf)
+         return
+
+      key = ("msgexport", substr.strip())
+      await self._client.job_scheduler.submit(key, "msgexport " + substr.strip(), self._server.id, msg.channel, run_job)
+      return
+
    #######################################
    ### MODULE INFO/MANAGEMENT COMMANDS ###
    #######################################
@@ -584,6 +691,7 @@ class ServerBotInstance:
             new_module = await self._module_factory.new_module_instance(substr, self)
             await self._modules.add_server_module(new_module)
             await new_module.activate()
+            self._rebuild_dispatch_table()
             self._storage.add_module(substr)
             await self._client.send_msg(msg, "`{}` successfully installed.".format(substr))
       else:
@@ -598,6 +706,8 @@ class ServerBotInstance:
       """`{cmd} [module name]` - Remove a module."""
       if self._modules.module_is_installed(substr):
          await self._modules.remove_server_module(substr)
+         self._custom_cmds = {k: v for (k, v) in self._custom_cmds.items() if v.module.module_name != substr}
+         self._rebuild_dispatch_table()
          self._storage.remove_module(substr)
          await self._client.send_msg(msg, "`{}` successfully uninstalled.".format(substr))
       else:
@@ -1029,6 +1139,7 @@ class ServerBotInstance:
 
       self._cmd_prefix = substr
       self._storage.save_prefix(substr)
+      self._rebuild_dispatch_table()
 
       buf = textwrap.dedent("""
          `{p}` set as command prefix.
@@ -1205,6 +1316,26 @@ class ServerBotInstance:
       await self._client.send_msg(msg, buf)
       return
 
+   @cmd.add(_cmdd, "msgcachecompact")
+   @_core_command(_helpd, "admin")
+   @cmd.category("Bot Owner Only")
+   @cmd.minimum_privilege(PrivilegeLevel.BOT_OWNER)
+   async def _cmdf_msgcachecompact(self, substr, msg, privilege_level):
+      """
+      `{cmd}` - See message cache compaction status.
+      `{cmd} run` - Compact the message cache now.
+      """
+      substr = substr.strip().lower()
+      if substr == "run":
+         self._client.message_cache_request_compaction()
+         buf = "Message cache compaction requested."
+      elif len(substr) == 0:
+         buf = self._client.message_cache_compaction_str()
+      else:
+         raise errors.InvalidCommandArgumentsError
+      await self._client.send_msg(msg, buf)
+      return
+
    @cmd.add(_cmdd, "closebot", "quit", "exit")
    @_core_command(_helpd, "admin")
    @cmd.category("Bot Owner Only")
@@ -41,6 +41,17 @@ class ServerModule(HelpNode):
    # when processing this string.
    _HELP_SUMMARY = "`{modhelp}` <<PLACEHOLDER>>"
 
+   # Set to True if the module's on_message() and on_member_*() methods don't
+   # rely on being called before or after other modules' methods. These are
+   # then run concurrently with other modules' methods rather than one module
+   # at a time, in the order the modules were installed.
+   HOOKS_ORDER_INDEPENDENT = False
+
+   # Seconds an on_message() or on_member_*() call may take before it's
+   # reported as slow. Slow order-independent calls are no longer waited on.
+   # If None, calls are never reported as slow, and cost a little less.
+   HOOK_TIMEOUT = 10
+
    ##############################################################################
    # THE BELOW MUST NOT BE OVERRIDDEN ###########################################
    ##############################################################################
@@ -135,7 +146,7 @@ class ServerModule(HelpNode):
 
    # Every module has the opportunity to pre-process the contents of a message.
    # This is carried out after all modules have carried out their on_message()
-   # methods.
+   # methods (or have been reported as slow, if HOOKS_ORDER_INDEPENDENT).
    # The msg_preprocessor() methods for all installed server modules
    # are daisy-chained, i.e. the output from the first module.msg_preprocessor()
    # is the input into the next module.msg_preprocessor(). This means that
@@ -144,6 +155,11 @@ class ServerModule(HelpNode):
    # If you're not sure how to use this method, don't worry about implementing
    # it.
    #
+   # Most preprocessing only rewrites content beginning with some prefix.
+   # Rather than implementing this method, it's better to register rules for
+   # that with resources.set_preprocessor_rules() (see preprocessorrules.py),
+   # since they can be checked without calling this method on every message.
+   #
    # This method is often used for processing command shortcuts.
    #     Example:
    #        Server module "Random" has the command "/rng choose [args]".
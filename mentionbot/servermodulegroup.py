@@ -1,11 +1,26 @@
 import re
+import asyncio
 
-from . import utils, errors, cmd
+from . import utils, cmd
+from .preprocessorrules import PreprocessorRule, CompiledPreprocessor
 from .helpnode import HelpNode
 from .enums import PrivilegeLevel
 
 class ServerModuleGroup(HelpNode):
 
+   # Module methods that are called for every module. Each one is only called
+   # for modules that implement it.
+   _HOOK_NAMES = [
+      "msg_preprocessor",
+      "on_message",
+      "on_member_join",
+      "on_member_remove",
+      "on_member_ban",
+      "on_member_unban",
+      "on_member_update",
+      "get_extra_user_info",
+   ]
+
    # TODO: Implement more efficient data structures. Too much linear searching is going on.
 
    # PRECONDITION: initial_modules is a list of unique modules.
@@ -24,52 +39,122 @@ class ServerModuleGroup(HelpNode):
       for help_page in self._core_pages_list:
          for alias in help_page.get_all_aliases():
             self._core_pages_dict[alias] = help_page
+      self._slow_hooks = set() # Tasks of slow hooks that are no longer waited on.
+      self._hook_modules = None # Maps hook name -> list of modules implementing it
+      self._preprocessor = None # CompiledPreprocessor. Compiled when needed.
+      self._update_hook_modules()
       return
 
-   async def msg_preprocessor(self, content, msg, default_cmd_prefix):
-      for module in self._modules_list:
-         content = await module.msg_preprocessor(content, msg, default_cmd_prefix)
-      return content
+   # Must be called whenever self._modules_list changes.
+   def _update_hook_modules(self):
+      self._hook_modules = {}
+      for hook_name in self._HOOK_NAMES:
+         self._hook_modules[hook_name] = [x for x in self._modules_list if x.implements_hook(hook_name)]
+      self._preprocessor = None
+      return
 
-   async def on_message(self, msg, privilege_level):
+   # Must be called whenever a module sets its preprocessor rules.
+   def preprocessor_rules_changed(self):
+      self._preprocessor = None
+      return
+
+   # Modules implementing msg_preprocessor() are compiled in as a rule that
+   # matches everything, so they're still run in order with everything else.
+   def _compile_preprocessor(self, cmd_prefix):
+      module_rules = []
       for module in self._modules_list:
-         await module.on_message(msg, privilege_level)
+         if module.implements_hook("msg_preprocessor"):
+            async def rewrite(match, msg, module=module):
+               return await module.msg_preprocessor(match.content, msg, match.cmd_prefix)
+            module_rules.append((module, [PreprocessorRule("", rewrite)]))
+         elif len(module.preprocessor_rules) > 0:
+            module_rules.append((module, module.preprocessor_rules))
+      self._preprocessor = CompiledPreprocessor(module_rules, cmd_prefix)
       return
 
-   async def process_cmd(self, substr, msg, privilege_level, silentfail=False):
-      (left, right) = utils.separate_left_word(substr)
-      try:
-         await self._modules_cmd_dict[left].process_cmd(right, msg, privilege_level, left)
-      except KeyError:
-         if silentfail:
-            raise errors.SilentUnknownCommandError
-         else:
-            raise errors.UnknownCommandError
+   async def msg_preprocessor(self, content, msg, default_cmd_prefix):
+      if (self._preprocessor is None) or (self._preprocessor.cmd_prefix != default_cmd_prefix):
+         self._compile_preprocessor(default_cmd_prefix)
+      return await self._preprocessor.run(content, msg)
+
+   async def on_message(self, msg, privilege_level):
+      await self._run_hooks("on_message", msg, privilege_level)
       return
 
+   # RETURNS: A dict mapping every top-level command alias (including
+   #          shortcuts) to the module serving it.
+   def get_modules_cmd_dict(self):
+      return dict(self._modules_cmd_dict)
+
    async def on_member_join(self, member):
-      for module in self._modules_list:
-         await module.on_member_join(member)
+      await self._run_hooks("on_member_join", member)
       return
 
    async def on_member_remove(self, member):
-      for module in self._modules_list:
-         await module.on_member_remove(member)
+      await self._run_hooks("on_member_remove", member)
       return
 
    async def on_member_ban(self, member):
-      for module in self._modules_list:
-         await module.on_member_ban(member)
+      await self._run_hooks("on_member_ban", member)
       return
 
    async def on_member_unban(self, user):
-      for module in self._modules_list:
-         await module.on_member_unban(user)
+      await self._run_hooks("on_member_unban", user)
       return
 
    async def on_member_update(self, before, after):
-      for module in self._modules_list:
-         await module.on_member_update(before, after)
+      await self._run_hooks("on_member_update", before, after)
+      return
+
+   # Calls an event hook (e.g. on_message()) of every module.
+   # Order-independent modules' hooks run concurrently with everything else,
+   # while the rest run one at a time, in the order the modules were
+   # installed. Returns once every hook has returned or been reported as slow.
+   async def _run_hooks(self, hook_name, *args):
+      ordered_modules = []
+      concurrent_hooks = []
+      for module in self._hook_modules[hook_name]:
+         if module.hooks_order_independent:
+            concurrent_hooks.append(self._run_hook(module, hook_name, args))
+         else:
+            ordered_modules.append(module)
+      async def run_ordered_hooks():
+         for module in ordered_modules:
+            await self._run_hook(module, hook_name, args)
+         return
+      if len(concurrent_hooks) == 0:
+         await run_ordered_hooks()
+      else:
+         await asyncio.gather(run_ordered_hooks(), *concurrent_hooks)
+      return
+
+   # Calls a module's event hook, reporting it if it takes longer than the
+   # module's timeout. Slow hooks aren't cancelled, but if the module is
+   # order-independent, they're left to finish on their own.
+   # Hooks of modules without a timeout are simply awaited, which saves
+   # creating a task for every call.
+   async def _run_hook(self, module, hook_name, args):
+      hook = getattr(module, hook_name)(*args)
+      if module.hook_timeout is None:
+         await hook
+         return
+      loop = asyncio.get_event_loop()
+      task = loop.create_task(hook)
+      (done, pending) = await asyncio.wait([task], timeout=module.hook_timeout)
+      if len(done) > 0:
+         task.result() # Raises whatever the hook raised, like awaiting it would.
+         return
+      buf = "WARNING: Module '{}' {}() has taken over {} seconds."
+      print(buf.format(module.module_name, hook_name, str(module.hook_timeout)))
+      if not module.hooks_order_independent:
+         await task
+         return
+      self._slow_hooks.add(task)
+      def on_slow_hook_done(task):
+         self._slow_hooks.discard(task)
+         print("Slow hook finished: Module '{}' {}().".format(module.module_name, hook_name))
+         return
+      task.add_done_callback(on_slow_hook_done)
       return
 
    # Like the original get_extra_user_info method, except the tuple's
@@ -78,7 +163,7 @@ class ServerModuleGroup(HelpNode):
    async def get_extra_user_info(self, member):
       ret0 = []
       ret1 = []
-      for module in self._modules_list:
+      for module in self._hook_modules["get_extra_user_info"]:
          info_tuple = await module.get_extra_user_info(member)
          if not info_tuple is None:
             # TODO: Are these asserts redundant?
@@ -110,6 +195,7 @@ class ServerModuleGroup(HelpNode):
          if cmd_name in self._modules_cmd_dict:
             print("WARNING: Module with alias '{}' already exists.".format(cmd_name))
          self._modules_cmd_dict[cmd_name] = new_module
+      self._update_hook_modules()
 
    # Installs the module referenced by its base command name.
    # PRECONDITION: Module is currently installed.
@@ -123,6 +209,7 @@ class ServerModuleGroup(HelpNode):
       for cmd_name in module_to_remove.all_cmd_aliases:
          del self._modules_cmd_dict[cmd_name]
       self._modules_list.remove(module_to_remove)
+      self._update_hook_modules()
 
    # Returns list of all installed modules in this instance.
    # RETURNS: A list of tuples, each tuple in the format:
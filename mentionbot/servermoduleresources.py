@@ -87,8 +87,38 @@ class ServerModuleResources:
       utils.json_write(self._shared_settings_filepath, data=data)
       return
 
-   def message_cache_read(self, server_id, ch_id):
-      return self.client.message_cache_read(server_id, ch_id)
+   def message_cache_read(self, server_id, ch_id, since=None, until=None, authors=None):
+      return self.client.message_cache_read(server_id, ch_id, since=since, until=until, authors=authors)
+
+   async def message_cache_map_reduce(self, server_id, channel_ids, mapper, reducer, **kwargs):
+      return await self.client.message_cache_map_reduce(server_id, channel_ids, mapper, reducer, **kwargs)
+
+   def message_cache_read_rollup(self, server_id, ch_id):
+      return self.client.message_cache_read_rollup(server_id, ch_id)
+
+   def message_cache_read_rollup_columns(self, server_id, ch_id):
+      return self.client.message_cache_read_rollup_columns(server_id, ch_id)
+
+   def message_cache_get_watermark(self, server_id, ch_id):
+      return self.client.message_cache_get_watermark(server_id, ch_id)
+
+   # Queues a heavy analytics job. (See JobScheduler.submit().)
+   async def submit_job(self, key, description, channel, fn):
+      return await self.client.job_scheduler.submit(key, description, self._server.id, channel, fn)
+
+   # Sets the custom commands served by this module, replacing any it set
+   # before. (See commanddispatch.CustomCommand.)
+   # PARAMETER: cmd_names - Iterable of top-level command names.
+   def set_custom_commands(self, cmd_names, handler, help_handler):
+      self._sbi.set_custom_commands(self._module_wrapper, cmd_names, handler, help_handler)
+      return
+
+   # Sets the module's message preprocessor rules, replacing any it set
+   # before. (See preprocessorrules.PreprocessorRule.)
+   def set_preprocessor_rules(self, rules):
+      self._module_wrapper.set_preprocessor_rules(rules)
+      self._sbi.preprocessor_rules_changed()
+      return
 
    async def start_nonreturning_coro(self, coro):
       await self._module_wrapper.start_user_nonreturning_coro(coro)
@@ -7,6 +7,7 @@ import discord
 
 from .. import utils, errors, cmd
 from ..servermodule import ServerModule, registered
+from ..preprocessorrules import PreprocessorRule
 
 @registered
 class BsiStarkRavingMadBot(ServerModule):
@@ -116,43 +117,38 @@ class BsiStarkRavingMadBot(ServerModule):
          "(ﾉಠ_ಠ)ﾉ*:・ﾟ✧\ngit to sleep"
       ]
 
+      # Commands are only taken over while stark is offline.
+      stark_offline = lambda: not self.dont_run_module()
+      self._res.set_preprocessor_rules([
+         # Deal with type flair commands
+         PreprocessorRule("$", self._preprocess_typeflair, lookup=self._MBTI_TYPES_SET, lookup_key=str.upper, guard=stark_offline),
+         # Any other command
+         PreprocessorRule("$", self._preprocess_replace, lookup=self._preprocessor_replace, lookup_key=str.lower, guard=stark_offline),
+      ])
+
       self._res.suppress_autokill(True)
       return
 
-   async def msg_preprocessor(self, content, msg, default_cmd_prefix):
-      content = await super(BsiStarkRavingMadBot, self).msg_preprocessor(content, msg, default_cmd_prefix)
-      
-      if self.dont_run_module():
-         return content # Short-circuit if stark is not offline.
-
-      if content.startswith("$"):
-         new_content = content[1:]
-         (left, right) = utils.separate_left_word(new_content)
-         
-         # Deal with type flair commands
-         if left.upper() in self._MBTI_TYPES_SET:
-            return default_cmd_prefix + "jcfdiscord typeflair " + left
-
-         # Any other command
-         try:
-            left = self._preprocessor_replace[left.lower()]
-         except KeyError:
-            return content
-         print(left)
-
-         # Special case for whois command
-         if left.startswith("whois"):
-            left = left[5:] # Prefix
-            if len(right) == 0 or utils.re_user_mention.match(right):
-               left += "user"
-            else:
-               left += "role"
-
-         if right == "":
-            return left
-         else: 
-            return left + " " + right
-      return content
+   async def _preprocess_typeflair(self, match, msg):
+      return match.cmd_prefix + "jcfdiscord typeflair " + match.word
+
+   async def _preprocess_replace(self, match, msg):
+      left = match.value
+      right = match.args
+      print(left)
+
+      # Special case for whois command
+      if left.startswith("whois"):
+         left = left[5:] # Prefix
+         if len(right) == 0 or utils.re_user_mention.match(right):
+            left += "user"
+         else:
+            left += "role"
+
+      if right == "":
+         return left
+      else: 
+         return left + " " + right
 
    @cmd.add(_cmdd, "cmdnotimplemented")
    async def _cmdf_cmdnotimplemented(self, substr, msg, privilege_level):
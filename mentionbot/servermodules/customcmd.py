@@ -50,6 +50,7 @@ class CustomCmd(ServerModule):
       self._custom_commands = None # Initialize later.
 
       self._load_settings()
+      self._update_custom_commands()
 
       self._res.suppress_autokill(True)
       return
@@ -101,30 +102,10 @@ class CustomCmd(ServerModule):
       self._res.save_settings(settings)
       return
 
-   async def on_message(self, msg, privilege_level):
-      # TODO: Lots of potentially redundant string manipulation, but I suppose
-      #       I should've defined things better :/
-      #       Better safe than sorry, I guess, hence the redundancy.
-
-      if privilege_level == PrivilegeLevel.NO_PRIVILEGE:
-         return # Without warning.
-
-      # Get the command name.
-      cmd_prefix = self._res.cmd_prefix.strip()
-      content = msg.content.strip()
-      if content.startswith(cmd_prefix):
-         content = content[len(cmd_prefix):]
-         (left, right) = utils.separate_left_word(content)
-         if left in self._custom_commands:
-            await self._process_custom_command(right, msg, self._custom_commands[left])
-         if left == "help":
-            (left2, right2) = utils.separate_left_word(right)
-            if left2 in self._custom_commands:
-               # PLACEHOLDER IMPLEMENTATION
-               # Please note: another message will be sent by the real help command function.
-               # this might be confusing... so gonna have to figure out a solution for this.
-               buf = "`{}` is a custom command with a fixed reply.".format(cmd_prefix + left2)
-               await self._client.send_msg(msg, buf)
+   # Custom commands are served by the server's command dispatch table, so
+   # this must be called whenever self._custom_commands changes.
+   def _update_custom_commands(self):
+      self._res.set_custom_commands(self._custom_commands.keys(), self._process_custom_command, self._custom_command_help)
       return
 
    @cmd.add(_cmdd, "add", "create")
@@ -175,6 +156,7 @@ class CustomCmd(ServerModule):
       }
       self._custom_commands[left] = custcmd_data
       self._save_settings()
+      self._update_custom_commands()
 
       cmd_prefix = self._res.cmd_prefix.strip()
       buf = "Successfully created new custom command `{}`.".format(cmd_prefix + left)
@@ -194,6 +176,7 @@ class CustomCmd(ServerModule):
       
       del self._custom_commands[substr]
       self._save_settings()
+      self._update_custom_commands()
       buf = "Successfully deleted the custom command `{}`.".format(substr)
       await self._client.send_msg(msg, buf)
       return
@@ -205,6 +188,7 @@ class CustomCmd(ServerModule):
       """`{cmd}` - Clears all custom commands."""
       self._custom_commands = {}
       self._save_settings()
+      self._update_custom_commands()
       buf = "Successfully cleared all custom commands."
       await self._client.send_msg(msg, buf)
       return
@@ -224,10 +208,20 @@ class CustomCmd(ServerModule):
       await self._client.send_msg(msg, buf)
       return
 
-   async def _process_custom_command(self, substr, msg, custcmd_data):
+   async def _process_custom_command(self, substr, msg, custcmd_name):
+      custcmd_data = self._custom_commands[custcmd_name]
       assert custcmd_data["type"] == self.CmdType.FIXED_REPLY
       buf = custcmd_data["text"]
       await self._client.send_msg(msg, buf)
       return
 
+   async def _custom_command_help(self, msg, custcmd_name):
+      # PLACEHOLDER IMPLEMENTATION
+      # Please note: another message will be sent by the real help command function.
+      # this might be confusing... so gonna have to figure out a solution for this.
+      cmd_prefix = self._res.cmd_prefix.strip()
+      buf = "`{}` is a custom command with a fixed reply.".format(cmd_prefix + custcmd_name)
+      await self._client.send_msg(msg, buf)
+      return
+
    
\ No newline at end of file
@@ -13,6 +13,7 @@ class Debugging(ServerModule):
    MODULE_NAME = "Debugging"
    MODULE_SHORT_DESCRIPTION = "Bot debugging tools."
    RECOMMENDED_CMD_NAMES = ["debugging", "debug", "db"]
+   HOOKS_ORDER_INDEPENDENT = True
 
    _SECRET_TOKEN = utils.SecretToken()
    _cmdd = {} # Empty dict should work...
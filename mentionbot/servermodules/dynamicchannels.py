@@ -12,6 +12,7 @@ import discord
 
 from .. import utils, errors, cmd
 from ..servermodule import ServerModule, registered
+from ..preprocessorrules import PreprocessorRule
 from ..enums import PrivilegeLevel
 
 from ..attributedictwrapper import AttributeDictWrapper
@@ -22,6 +23,7 @@ class DynamicChannels(ServerModule):
    MODULE_NAME = "Dynamic Channels"
    MODULE_SHORT_DESCRIPTION = "Allows users to create temporary channels. (NOT YET FUNCTIONAL.)"
    RECOMMENDED_CMD_NAMES = ["dchannel", "dchannels", "dynamicchannels"]
+   HOOKS_ORDER_INDEPENDENT = True
    
    _SECRET_TOKEN = utils.SecretToken()
    _cmdd = {}
@@ -61,6 +63,11 @@ class DynamicChannels(ServerModule):
       loop = asyncio.get_event_loop()
       await self._res.start_nonreturning_coro(self._scheduler.run())
 
+      self._res.set_preprocessor_rules([
+         PreprocessorRule("+++", self._preprocess_open),
+         PreprocessorRule("++", self._preprocess_search),
+      ])
+
       self._res.suppress_autokill(True)
       return
 
@@ -133,12 +140,11 @@ class DynamicChannels(ServerModule):
       self._res.save_settings(settings)
       return
 
-   async def msg_preprocessor(self, content, msg, default_cmd_prefix):
-      if content.startswith("+++"):
-         content = default_cmd_prefix + self._res.module_cmd_aliases[0] + " open " + content[3:]
-      elif content.startswith("++"):
-         content = default_cmd_prefix + self._res.module_cmd_aliases[0] + " search " + content[2:]
-      return content
+   async def _preprocess_open(self, match, msg):
+      return match.cmd_prefix + self._res.module_cmd_aliases[0] + " open " + match.rest
+
+   async def _preprocess_search(self, match, msg):
+      return match.cmd_prefix + self._res.module_cmd_aliases[0] + " search " + match.rest
 
    async def process_cmd(self, substr, msg, privilege_level):
       if substr == "":
@@ -7,6 +7,7 @@ import discord
 
 from .. import utils, errors, cmd
 from ..servermodule import ServerModule, registered
+from ..preprocessorrules import PreprocessorRule, CMD_PREFIX
 from ..enums import PrivilegeLevel
 
 @registered
@@ -76,20 +77,20 @@ class JCFDiscord(ServerModule):
       self._res = resources
       self._client = self._res.client
 
+      self._res.set_preprocessor_rules([
+         PreprocessorRule(CMD_PREFIX, self._preprocess_typeflair, lookup=self._MBTI_TYPES_SET, lookup_key=str.upper),
+         PreprocessorRule("/xxxx", self._preprocess_xxxx, ignore_case=True),
+      ])
+
       self._res.suppress_autokill(True)
       return
 
-   async def msg_preprocessor(self, content, msg, default_cmd_prefix):
-      if content.startswith(default_cmd_prefix):
-         new_content = content[len(default_cmd_prefix):]
-         (left, right) = utils.separate_left_word(new_content)
-         if left.upper() in self._MBTI_TYPES_SET:
-            return default_cmd_prefix + self._res.module_cmd_aliases[0] + " typeflair " + left
-      elif content.lower().startswith("/xxxx"):
-         # TODO: Implement this in a nicer and more efficient way.
-         await self._client.send_msg(msg, "For example, to give yourself the ISFJ role, type in `/ISFJ`.")
-         return "arbitrary non-command string"
-      return await super(JCFDiscord, self).msg_preprocessor(content, msg, default_cmd_prefix)
+   async def _preprocess_typeflair(self, match, msg):
+      return match.cmd_prefix + self._res.module_cmd_aliases[0] + " typeflair " + match.word
+
+   async def _preprocess_xxxx(self, match, msg):
+      await self._client.send_msg(msg, "For example, to give yourself the ISFJ role, type in `/ISFJ`.")
+      return "arbitrary non-command string"
 
    @cmd.add(_cmdd, "functions", "fn", "stack", top="functions")
    async def _cmdf_functions(self, substr, msg, privilege_level):
@@ -11,6 +11,7 @@ class MentionsNotify(ServerModule):
    MODULE_NAME = "Mentions Notify"
    MODULE_SHORT_DESCRIPTION = "PMs offline users when mentioned."
    RECOMMENDED_CMD_NAMES = ["mnotify", "mentionsnotify", "mn"]
+   HOOKS_ORDER_INDEPENDENT = True
    
    _SECRET_TOKEN = utils.SecretToken()
    _cmdd = {}
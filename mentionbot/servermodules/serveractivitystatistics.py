@@ -1,20 +1,94 @@
-import asyncio
 import datetime
+import shlex
 import traceback
 import random
 import os
 import csv
 import collections
-import threading
 
 import discord
-import plotly.plotly as py
-import plotly.graph_objs as go
+try:
+   import numpy as np
+except ImportError:
+   np = None # Rollups are read row by row instead.
 
-from .. import utils, errors, cmd
+from .. import utils, errors, cmd, wordfreq, interactiongraph, chartrender, resultcache, messagerollup
 from ..servermodule import ServerModule, registered
 from ..enums import PrivilegeLevel
 
+# These are message cache map_reduce() mappers and reducers. Mappers run in
+# worker processes, so they must stay at module level.
+
+# Counts the words in a channel. (See wordfreq.count_words().)
+def _zipf_map(ch_id, messages, table, author_keys, default_key, approximate):
+   new_counter = collections.Counter
+   if approximate:
+      new_counter = wordfreq.ApproxWordCounter
+   kwargs = {"author_keys": author_keys, "default_key": default_key, "new_counter": new_counter}
+   return wordfreq.count_words(messages, table, **kwargs)
+
+# Accumulator functions for evaluation functions that sum a value over
+# messages. (See SIMPLE GRAPHING - STEP 1.)
+# PARAMETER: msg_value - Function returning the value of a message.
+# PARAMETER: total_name - The equivalent rollup total (see messagerollup).
+def _sum_evaluator(msg_value, total_name):
+   ret = {
+      "new acc": lambda: 0,
+      "acc fn": lambda acc, d: acc + msg_value(d),
+      "rollup acc fn": lambda acc, d: acc + d[total_name],
+      "merge acc": lambda x, y: x + y,
+      "acc value": lambda acc: acc,
+      "vacc": lambda cols, b: _np_sums_by_bin(b, cols[total_name]),
+   }
+   return ret
+
+# Accumulator functions for evaluation functions that average a value over
+# messages (i.e. sum of numerators / sum of denominators). Accumulators are
+# (denominator, numerator) tuples.
+# PARAMETER: msg_values - Function returning a message's (denominator,
+#                         numerator) tuple.
+def _ratio_evaluator(msg_values, denominator_name, numerator_name):
+   def new_fn(acc, d):
+      (denominator, numerator) = msg_values(d)
+      return (acc[0] + denominator, acc[1] + numerator)
+   def get_value(acc):
+      try:
+         return acc[1] / acc[0] # RETURNS FLOAT!!!
+      except ZeroDivisionError:
+         return 0
+   ret = {
+      "new acc": lambda: (0, 0),
+      "acc fn": new_fn,
+      "rollup acc fn": lambda acc, d: (acc[0] + d[denominator_name], acc[1] + d[numerator_name]),
+      "merge acc": lambda x, y: (x[0] + y[0], x[1] + y[1]),
+      "acc value": get_value,
+      "vacc": lambda cols, b: _np_pair_sums_by_bin(b, cols[denominator_name], cols[numerator_name]),
+   }
+   return ret
+
+# Vectorized accumulator helpers. (See _sg4_seed_channel().)
+# Each returns a dict mapping bin -> accumulator.
+
+def _np_sums_by_bin(bin_values, weights):
+   (bins, inverse) = np.unique(bin_values, return_inverse=True)
+   sums = np.bincount(inverse, weights=weights, minlength=len(bins)).astype(np.int64)
+   return dict(zip(bins.tolist(), sums.tolist()))
+
+def _np_pair_sums_by_bin(bin_values, weights1, weights2):
+   (bins, inverse) = np.unique(bin_values, return_inverse=True)
+   sums1 = np.bincount(inverse, weights=weights1, minlength=len(bins)).astype(np.int64)
+   sums2 = np.bincount(inverse, weights=weights2, minlength=len(bins)).astype(np.int64)
+   return {b: (x, y) for (b, x, y) in zip(bins.tolist(), sums1.tolist(), sums2.tolist())}
+
+def _np_authors_by_bin(bin_values, authors):
+   order = np.argsort(bin_values, kind="stable")
+   (bins, starts) = np.unique(bin_values[order], return_index=True)
+   groups = np.split(authors[order], starts[1:])
+   return {b: set(str(x) for x in group.tolist()) for (b, group) in zip(bins.tolist(), groups)}
+
+def _datetime_to_epoch_seconds(dt):
+   return (dt - datetime.datetime(1970, 1, 1)) // datetime.timedelta(seconds=1)
+
 @registered
 class ServerActivityStatistics(ServerModule):
 
@@ -29,6 +103,16 @@ class ServerActivityStatistics(ServerModule):
       `{modhelp}` - Generates user activity statistics.
       """
 
+   _RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+   _CHECKPOINT_MAX_QUERIES = 32
+   _SCANNED_REPORT_INTERVAL = 5000 # Rows read between job progress reports.
+
+   _renderer = None # chartrender.ChartRenderer shared by every server.
+   _result_cache = None # resultcache.ResultCache shared by every server.
+   _checkpoints = collections.OrderedDict()
+   # Maps query -> checkpoint of the last _CHECKPOINT_MAX_QUERIES queries,
+   # from least to most recently used. (See _sg4_generate_graph_data().)
+
    async def _initialize(self, resources):
       self._res = resources
       self._client = self._res.client
@@ -37,7 +121,15 @@ class ServerActivityStatistics(ServerModule):
       self._plotly_api_key = self._conf["api_keys"]["plotly_api_key"]
       self._plotly_username = self._conf["api_keys"]["plotly_username"]
 
-      py.sign_in(self._plotly_username, self._plotly_api_key)
+      if ServerActivityStatistics._renderer is None:
+         plotly_credentials = None
+         if not "PLACEHOLDER" in [self._plotly_username, self._plotly_api_key]:
+            plotly_credentials = (self._plotly_username, self._plotly_api_key)
+         renderer_name = self._conf["misc"]["chart_renderer"]
+         ServerActivityStatistics._renderer = chartrender.ChartRenderer(renderer_name, plotly_credentials=plotly_credentials)
+      if ServerActivityStatistics._result_cache is None:
+         cache_dir = self._res.shared_directory + "resultcache/"
+         ServerActivityStatistics._result_cache = resultcache.ResultCache(cache_dir, self._RESULT_CACHE_MAX_BYTES)
 
       self._res.suppress_autokill(True)
       return
@@ -99,38 +191,61 @@ class ServerActivityStatistics(ServerModule):
          graph_fn = graph_fn(self) # Get the graphing function
 
          filter_fn = None
-         (left4, right4) = utils.separate_left_word(right3)
          try:
-            filter_fn = self._sg_argument4[left4]
-         except KeyError:
-            buf = "Error: Unknown filter function."
+            filter_fn = self._sg_filter(right3, msg)
+         except (ValueError, OverflowError) as e:
+            buf = "Error: " + str(e)
             buf += "\n\n" + self._get_usage_info()
             await self._client.send_msg(msg, buf)
             raise errors.OperationAborted
-         filter_fn = filter_fn(self, substr, msg) # Get the graphing function
-
-         # right3 can be used for other things if need be...
-
-         await self._client.send_msg(msg, "Generating `plotly` graph/raw values. Please wait...")
-         
-         # Prepare for execution in process pool.
-         fn_args = [msg.channel, eval_obj["fn"], bin_obj["fn"], filter_fn["fn"]]
-         loop = asyncio.get_event_loop()
-         (data, x_vals) = await loop.run_in_executor(None, self._sg4_generate_graph_data, *fn_args)
-         
-         # Compile graph function kwargs
-         graph_kwargs = {
-            "title": filter_fn["title"] + " " + eval_obj["title"] + " " + bin_obj["title"],
-
-            "x_vals": x_vals,
-            "y_vals": data,
 
-            "x_axis_title": bin_obj["axis"],
-
-            "y_axis_title": eval_obj["axis"],
-         }
-
-         await graph_fn(msg.channel, **graph_kwargs)
+         title = filter_fn["title"] + " " + eval_obj["title"] + " " + bin_obj["title"]
+
+         # Identical queries are answered from the result cache until new
+         # messages land in the channels they read.
+         watermarks = self._sg_watermarks(filter_fn)
+         cache_key = self._sg_result_cache_key([left, left2, left3, right3], title, bin_obj, filter_fn, watermarks)
+         cached = self._result_cache.get(cache_key)
+         if not cached is None:
+            (filepath, text) = cached
+            if not text is None:
+               await self._client.send_msg(msg, text)
+            if not filepath is None:
+               await self._client.perm_send_file(msg.channel, filepath)
+            return
+
+         # Otherwise, the query's checkpoint (if it has one) only needs the
+         # messages sent since it was made to be added.
+         async def run_job(job):
+            job.set_phase("Reading messages...")
+            query = (self._res.server.id, left, left2, filter_fn["key"], tuple(sorted(watermarks)))
+            checkpoint = self._checkpoints.pop(query, {})
+            fn_args = [job, checkpoint, watermarks, eval_obj, bin_obj, filter_fn]
+            (data, x_vals, checkpoint) = await job.run_in_executor(self._sg4_generate_graph_data, *fn_args)
+            self._checkpoints[query] = checkpoint
+            while len(self._checkpoints) > self._CHECKPOINT_MAX_QUERIES:
+               self._checkpoints.popitem(last=False)
+
+            # Compile graph function kwargs
+            graph_kwargs = {
+               "title": title,
+
+               "x_vals": x_vals,
+               "y_vals": data,
+
+               "x_axis_title": bin_obj["axis"],
+
+               "y_axis_title": eval_obj["axis"],
+
+               "cache_key": cache_key,
+            }
+
+            job.set_phase("Sending results...")
+            await graph_fn(msg.channel, **graph_kwargs)
+            return
+
+         job_key = ("stats", title, left3, filter_fn["key"], tuple(sorted(watermarks)))
+         await self._res.submit_job(job_key, "stats " + substr, msg.channel, run_job)
 
       return
 
@@ -139,156 +254,137 @@ class ServerActivityStatistics(ServerModule):
    async def _cmdf_zipf(self, substr, msg, privilege_level):
       """
       `{cmd}` - Generate word rank statistics. (EXPERIMENTAL)
+      `{cmd} approx` - Same, but with bounded memory use. Only the top words are ranked, and their counts are estimates.
 
       Additionally, it dumps a bunch more files of data locally.
       For access to these files, ask the bot owner.
       """
-      # 
-      buf = "Hang on, generating your data."
-      buf += "\n*Note that this is a highly experimental command, and may be broken.*"
-      await self._client.send_msg(msg, buf)
-
-      ignore_colour_roles = True
-      send_debugging_messages = True
-
-      replace_with_space = [
-         '!','@','#','$','%','^','&','*','(',')','=','+','[',']','{','}',';',
-         ':','"',',','.','<','>','/','?','\\','|'
-      ]
+      approximate = False
+      if substr == "approx":
+         approximate = True
+      elif len(substr) != 0:
+         raise errors.InvalidCommandArgumentsError
+
+      async def run_job(job):
+         ignore_colour_roles = True
+
+         replace_with_space = [
+            '!','@','#','$','%','^','&','*','(',')','=','+','[',']','{','}',';',
+            ':','"',',','.','<','>','/','?','\\','|'
+         ]
+         table = wordfreq.make_translation_table(replace_with_space)
+         new_counter = collections.Counter
+         if approximate:
+            new_counter = wordfreq.ApproxWordCounter
       
-      server = self._res.server
-      channel_ids = [x.id for x in server.channels]
-      default_role_name = server.default_role.name
-
-      totals = {}
-      # totals is a dict of defaultdicts.
-      # totals[role][word.lower()] = count
-      totals_sorted = {}
-      # totals_sorted is instead a dict of sorted lists.
-      # We'll fill this later.
-      role_totals = {}
-      # role_totals[role] = the complete total of words said by the role.
-      member_roles = {}
-      # member_roles maps member IDs to lists of role names.
-      loop = asyncio.get_event_loop()
-
-      # Initialize a dict for every role.
-      # Note: Duplicate role names are treated as the same role.
-      for role in server.roles:
-         role_name = role.name
-         if not role_name in totals:
-            totals[role_name] = collections.defaultdict(lambda: 0)
-
-      # Initialize a list for every member.
-      for member in server.members:
-         role_set = set()
-         for role in member.roles:
-            role_set.add(role.name)
-         member_roles[member.id] = list(role_set)
-
-      # TODO: Pipeline this!
-      if send_debugging_messages:
-         await self._client.send_msg(msg, "Phase 1: Reading cache...")
-      print("(DEBUGGING) Reading cache.")
-      def cache_read():
-         server_id = server.id
-         for ch_id in channel_ids:
-            for msg_dict in self._res.message_cache_read(server_id, ch_id):
-               author_id = msg_dict["a"]
-               content = msg_dict["c"]
-               # Process the content before adding to totals.
-               for char_to_replace in replace_with_space:
-                  content = content.replace(char_to_replace, " ")
-               word_list = content.lower().split()
-               # word_list is all lowercase now.
-               if author_id in member_roles:
-                  for role in member_roles[author_id]:
-                     for word in word_list:
-                        totals[role][word] += 1
-               else:
-                  role = default_role_name
-                  for word in word_list:
-                     totals[role][word] += 1
-         return
-      await loop.run_in_executor(None, cache_read)
-
-      if send_debugging_messages:
-         await self._client.send_msg(msg, "Phase 2: Sorting totals...")
-      print("(DEBUGGING) Sorting totals.")
-      def sort_totals():
-         for (role, words) in totals.items():
-            totals_sorted[role] = sorted(words.items(), key=lambda x: -x[1])
-            role_total = 0
-            for (word, count) in totals_sorted[role]:
-               role_total += count
-            role_totals[role] = role_total
-         return
-      await loop.run_in_executor(None, sort_totals)
-
-      if send_debugging_messages:
-         await self._client.send_msg(msg, "Phase 3: Writing to files...")
-      print("(DEBUGGING) Writing to files.")
-      def write_to_files():
-         for (role, words) in totals_sorted.items():
-            role_total = role_totals[role]
-            lines_to_write = []
+         server = self._res.server
+         channel_ids = [x.id for x in server.channels]
+         default_role_name = server.default_role.name
+
+         totals = None
+         # totals is a dict of counters (see wordfreq).
+         # totals[role][word.lower()] = count
+         totals_sorted = {}
+         # totals_sorted is instead a dict of sorted lists.
+         # We'll fill this later.
+         role_totals = {}
+         # role_totals[role] = the complete total of words said by the role.
+         member_roles = {}
+         # member_roles maps member IDs to lists of role names.
+
+         # Initialize a list for every member.
+         # Note: Duplicate role names are treated as the same role.
+         for member in server.members:
+            role_set = set()
+            for role in member.roles:
+               role_set.add(role.name)
+            member_roles[member.id] = sorted(role_set)
+
+         # Words are counted per author, and summed into role totals at the end.
+         # Sketches are too big to keep one for every author, so approximate
+         # counts are kept for every set of roles instead.
+         author_keys = None
+         default_key = None
+         key_roles = member_roles
+         if approximate:
+            author_keys = {k: tuple(v) for (k, v) in member_roles.items()}
+            default_key = (default_role_name,)
+            key_roles = {v: v for v in author_keys.values()}
+
+         # TODO: Pipeline this!
+         job.set_phase("Phase 1: Reading cache...")
+         print("(DEBUGGING) Reading cache.")
+         mapper_args = (table, author_keys, default_key, approximate)
+         mr_kwargs = {"initial": {}, "mapper_args": mapper_args, "split_segments": (not approximate)}
+         mr_kwargs["progress"] = job.set_messages_progress
+         counts = await self._res.message_cache_map_reduce(server.id, channel_ids, _zipf_map, wordfreq.merge_counts, **mr_kwargs)
+         def add_role_totals():
+            nonlocal totals
+            totals = wordfreq.sum_by_role(counts, key_roles, default_role_name, new_counter=new_counter)
+            for role in server.roles:
+               if not role.name in totals:
+                  totals[role.name] = new_counter()
+            return
+         await job.run_in_executor(add_role_totals)
+
+         job.set_phase("Phase 2: Sorting totals...")
+         print("(DEBUGGING) Sorting totals.")
+         def sort_totals():
+            for (role, words) in totals.items():
+               totals_sorted[role] = sorted(words.items(), key=lambda x: -x[1])
+               role_totals[role] = wordfreq.total_count(words)
+            return
+         await job.run_in_executor(sort_totals)
+
+         job.set_phase("Phase 3: Writing to files...")
+         print("(DEBUGGING) Writing to files.")
+         def write_to_files():
+            for (role, words) in totals_sorted.items():
+               role_total = role_totals[role]
+               def lines_to_write():
+                  rank = 1
+                  for (word, count) in words:
+                     freq = count / role_total
+                     yield "\t".join([str(rank), word, str(count), str(freq)])
+                     rank += 1
+                  return
+               if len(words) > 0:
+                  filename = "wordcount_" + utils.str_asciionly(role) + ".txt"
+                  self._dump_lines_to_file(lines_to_write(), filename=filename)
+            return
+         await job.run_in_executor(write_to_files)
+
+         job.set_phase("Phase 4: Generating zipf data...")
+         print("(DEBUGGING) Getting zipf graph.")
+         x_data = []
+         y_data = []
+         def get_zipf_data():
+            word_rank = totals_sorted[default_role_name]
+            count_total = role_totals[default_role_name]
             rank = 1
-            for (word, count) in words:
-               freq = count / role_total
-               buf = "\t".join([str(rank), word, str(count), str(freq)])
-               lines_to_write.append(buf)
+            for (word, count) in word_rank:
+               x_data.append(rank)
+               y_data.append(count/count_total)
                rank += 1
-            buf = "\n".join(lines_to_write)
-            if len(buf) > 0:
-               filename = "wordcount_" + utils.str_asciionly(role) + ".txt"
-               self._dump_to_file(buf, filename=filename)
-         return
-      await loop.run_in_executor(None, write_to_files)
-
-      if send_debugging_messages:
-         await self._client.send_msg(msg, "Phase 4: Generating zipf data...")
-      print("(DEBUGGING) Getting zipf graph.")
-      x_data = []
-      y_data = []
-      def get_zipf_data():
-         word_rank = totals_sorted[default_role_name]
-         count_total = role_totals[default_role_name]
-         rank = 1
-         for (word, count) in word_rank:
-            x_data.append(rank)
-            y_data.append(count/count_total)
-            rank += 1
-         return
-      await loop.run_in_executor(None, get_zipf_data)
-
-      if send_debugging_messages:
-         await self._client.send_msg(msg, "Phase 5: Getting zipf graph...")
-      plotly_layout = None
-      plotly_data = None
-      def get_plotly_objects():
-         plotly_layout = go.Layout( 
-            title = "Word rank vs Word Frequency",
-            xaxis = dict(
-               title = "rank of each word",
-               type = "log",
-            ),
-            yaxis = dict(
-               title = "word frequency",
-               type = "log",
-            ),
-         )
-         plotly_data = [
-            go.Scatter(
-               x = x_data,
-               y = y_data,
-            )
-         ]
+            return
+         await job.run_in_executor(get_zipf_data)
+
+         chart = {
+            "type": "line",
+            "title": "Word rank vs Word Frequency",
+            "x_vals": x_data,
+            "y_vals": y_data,
+            "x_axis_title": "rank of each word",
+            "y_axis_title": "word frequency",
+            "x_log": True,
+            "y_log": True,
+         }
+
+         job.set_phase("Phase 5: Attempting to send zipf graph...")
+         await self._send_chart(msg.channel, chart)
          return
-      await loop.run_in_executor(None, get_plotly_objects)
 
-      if send_debugging_messages:
-         await self._client.send_msg(msg, "Phase 6: Attempting to send zipf graph...")
-      await self._send_plotly_graph_object(msg.channel, plotly_data, plotly_layout)
+      await self._res.submit_job(("zipf", approximate), ("zipf " + substr).strip(), msg.channel, run_job)
       return
 
    @cmd.add(_cmdd, "convstats", top=True)
@@ -296,209 +392,101 @@ class ServerActivityStatistics(ServerModule):
    async def _cmdf_conv(self, substr, msg, privilege_level):
       """
       `{cmd}` - Generate conversation statistics. (EXPERIMENTAL)
+      `{cmd} [k]` - Same, but also lists each user's top *k* interactions.
 
       <<Write an explanation here>>
       """
-      thread_num = 8
+      top_k = None
+      if len(substr) != 0:
+         try:
+            top_k = int(substr)
+         except ValueError:
+            raise errors.InvalidCommandArgumentsError
+         if top_k < 1:
+            raise errors.InvalidCommandArgumentsError
+
       timeframe = datetime.timedelta(minutes=5)
       mention_multiplier = 3 # Interaction rating multiplier for mentions.
       attachments_flat = 15 # Flat interaction rating added if an attachment is found.
 
-      buf = "Hang on, generating your data."
-      buf += "\n*Note that this is a highly experimental command, and may be broken.*"
-      await self._client.send_msg(msg, buf)
-
-      loop = asyncio.get_event_loop()
-      assert thread_num > 1
-      jobs = [None for x in range(thread_num)]
-      server = self._res.server
-      all_channels = list(server.channels)
-      jobs_per_thread = int(len(all_channels)/thread_num)
-      assert jobs_per_thread > 0
-      assert len(all_channels) > thread_num
-      for i in range(thread_num - 1):
-         jobs[i] = all_channels[:jobs_per_thread]
-         all_channels = all_channels[jobs_per_thread:]
-      jobs[thread_num - 1] = all_channels # Gets the remaining channels
-      # Now, all the channels are roughly evenly distributed among each
-      # thread.
-
-      interactions = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
-      interactions_lock = threading.Lock()
-      # interactions[uid1][uid2] = interaction_rating
-      def add_to_interactions(uid1, uid2, interaction_rating):
-         interactions_lock.acquire()
-         i = interactions[uid1][uid2] = interactions[uid1][uid2] + interaction_rating
-         j = interactions[uid2][uid1] = interactions[uid2][uid1] + interaction_rating
-         interactions_lock.release()
-         assert i == j
-         return
-
-      warnings_buf = []
-      warnings_lock = threading.Lock()
-
-      def read_channel(channels):
-         server_id = server.id
-         for ch in channels:
-            print("READING INTERACTIONS IN #" + ch.name)
-            last = [] # Tuples of (member_id, last_post_datetime)
-            for_deletion = [] # elements of last to be deleted. Reinitialize only as necessary.
-            debug_prev = datetime.datetime(datetime.MINYEAR, 1, 1) # This exists entirely for ensuring correctness.
-            for msg_dict in self._res.message_cache_read(server_id, ch.id):
-               author_id = msg_dict["a"]
-               content = msg_dict["c"]
-               timestamp = msg_dict["t"]
-               has_media = (len(msg_dict["h"]) + len(msg_dict["e"])) > 0
-               
-               # assert debug_prev <= timestamp
-               if debug_prev > timestamp:
-                  warnings_lock.acquire()
-                  warnings_buf.append("WARNING: debug_prev > timestamp.\n")
-                  warnings_buf.append("timestamp - debug_prev = " + utils.timedelta_to_string(timestamp - debug_prev) + "\n")
-                  warnings_buf.append("channel " + ch.id + "\n")
-                  warnings_buf.append("author " + author_id + "\n")
-                  warnings_buf.append("content " + content + "\n")
-                  warnings_lock.release()
-               debug_prev = timestamp
-               
-               interaction_rating = len(content)
-               if has_media:
-                  interaction_rating += attachments_flat
-               mentions = set(utils.get_all_mentions(content))
-               mentions.discard(author_id)
-
-               assert isinstance(for_deletion, list) and (len(for_deletion) == 0)
-               # for_deletion = [] # Optimized by only reinitializing when necessary.
-               seen = set() # This exists almost entirely for ensuring correctness.
-               for x in last:
-                  (last_uid, last_time) = (x[0], x[1])
-                  
-                  assert not last_uid in seen
-                  seen.add(last_uid)
-                  
-                  if (last_uid != author_id) and (timestamp - last_time <= timeframe):
-                     multiplier = 1
-                     if last_uid in mentions:
-                        multiplier = mention_multiplier
-                     add_to_interactions(author_id, last_uid, interaction_rating * multiplier)
-                  else:
-                     for_deletion.append(x)
-               if len(for_deletion) > 0:
-                  for x in for_deletion:
-                     last.remove(x)
-                  for_deletion = []
-               # Now we add the current message back in.
-               last.append((author_id, timestamp))
-               # Anyone else who was mentioned now gets interaction rating added as well.
-               for uid in mentions:
-                  if not uid in seen:
-                     add_to_interactions(author_id, uid, interaction_rating * mention_multiplier)
-         return
-      async def read_channel_wrapped(channels):
-         await loop.run_in_executor(None, read_channel, channels)
-         return
-      futures = []
-      for x in jobs:
-         # fn_args = [x]
-         # assert isinstance(fn_args[0], list)
-         futures.append(loop.create_task(read_channel_wrapped(x)))
-      await asyncio.gather(*futures)
-      if not len(warnings_buf) != 0:
-         print("ISSUES:\n" + "".join(warnings_buf))
+      async def run_job(job):
+         job.set_phase("Reading cache...")
+         server = self._res.server
+         channel_ids = [x.id for x in server.channels]
+
+         pairs = {}
+         # pairs[(uid1, uid2)] = interaction_rating (see interactiongraph)
+         warnings_buf = []
+         def conv_reduce(accumulated, partial):
+            (partial_pairs, partial_warnings) = partial
+            interactiongraph.merge_pairs(pairs, partial_pairs)
+            warnings_buf.extend(partial_warnings)
+            return None
+
+         # Each channel is read in order by a single worker, since interactions
+         # are found between neighbouring messages.
+         mr_kwargs = {"mapper_args": (timeframe, mention_multiplier, attachments_flat)}
+         mr_kwargs["progress"] = job.set_messages_progress
+         mapper = interactiongraph.channel_interactions
+         await self._res.message_cache_map_reduce(server.id, channel_ids, mapper, conv_reduce, **mr_kwargs)
+         if not len(warnings_buf) != 0:
+            print("ISSUES:\n" + "".join(warnings_buf))
       
-      # Get uid to uname mapping
-      uid_to_uname = {x.id: x.name for x in server.members}
-
-      def cpu_bound_work():
-         all_members = [k for (k, v) in interactions.items()]
-
-         ################################
-         # PHASE 1: Spit out raw scores #
-         ################################
-
-         print("WRITING INTERACTION RATINGS TO FILES.")
-         buf = [] # List of strings to be joined later.
-
-         # Top header row
-         buf.append("Raw Scores")
-         for uid in all_members:
-            buf.append("\t")
-            if uid in uid_to_uname:
-               buf.append(uid_to_uname[uid])
-            else:
-               buf.append(uid)
-         # All the other rows
-         for uid1 in all_members: # uid1 for each row
-            buf.append("\n")
-            # First print the member.
-            if uid1 in uid_to_uname:
-               buf.append(uid_to_uname[uid1])
-            else:
-               buf.append(uid1)
-            # Now we print the matrix.
-            for uid2 in all_members: # uid2 for each column
-               buf.append("\t")
-               buf.append(str(interactions[uid1][uid2]))
-         buf = "".join(buf)
-         filename = "interactions_1_raw_scores.txt"
-         self._dump_to_file(buf, filename=filename)
-
-         ################################################
-         # PHASE 2: Convert to a portion average matrix #
-         ################################################
-
-         portion_tables = collections.defaultdict(lambda: {})
-         # portion_tables[uid1][uid2] = portion
-         # This is the portion of the sum of uid1's total interactions in which
-         # uid1 spends on uid2.
-
-         # First, we build each table of portions.
-         for uid in all_members:
-            interactions_sum = 0
-            for uid2 in all_members:
-               interactions_sum += interactions[uid][uid2]
-            for uid2 in all_members:
-               portion_tables[uid][uid2] = float(interactions[uid][uid2]/interactions_sum) * 100
-
-         portion_matrix = collections.defaultdict(lambda: {})
-
-         # Then, we construct the matrix of portion averages.
-         for uid1 in all_members:
-            for uid2 in all_members:
-               value = (portion_tables[uid1][uid2] + portion_tables[uid2][uid1])/2
-               portion_matrix[uid1][uid2] = portion_matrix[uid2][uid1] = value
-
-         # And we spit it out into a file.
-         buf = [] # List of strings to be joined later.
-
-         # Top header row
-         buf.append("Portion Averages")
-         for uid in all_members:
-            buf.append("\t")
-            if uid in uid_to_uname:
-               buf.append(uid_to_uname[uid])
-            else:
-               buf.append(uid)
-         # All the other rows
-         for uid1 in all_members: # uid1 for each row
-            buf.append("\n")
-            # First print the member.
-            if uid1 in uid_to_uname:
-               buf.append(uid_to_uname[uid1])
-            else:
-               buf.append(uid1)
-            # Now we print the matrix.
-            for uid2 in all_members: # uid2 for each column
-               buf.append("\t")
-               buf.append(str(portion_matrix[uid1][uid2]))
-         buf = "".join(buf)
-         filename = "interactions_2_portion_avgs.txt"
-         self._dump_to_file(buf, filename=filename)
-
+         job.set_phase("Writing to files...")
+         # Get uid to uname mapping
+         uid_to_uname = {x.id: x.name for x in server.members}
+
+         def cpu_bound_work():
+            raw_scores = interactiongraph.InteractionMatrix.from_pairs(pairs)
+            unames = [uid_to_uname.get(uid, uid) for uid in raw_scores.uids]
+
+            # Matrices are written as one line per non-zero entry, since most
+            # pairs of users never interact.
+            def dump_matrix(matrix, title, filename):
+               def lines_to_write():
+                  yield "User\tOther User\t" + title
+                  for (i, j, value) in matrix.entries():
+                     yield unames[i] + "\t" + unames[j] + "\t" + str(value)
+                  return
+               self._dump_lines_to_file(lines_to_write(), filename=filename)
+               return
+
+            ################################
+            # PHASE 1: Spit out raw scores #
+            ################################
+
+            print("WRITING INTERACTION RATINGS TO FILES.")
+            dump_matrix(raw_scores, "Raw Score", "interactions_1_raw_scores.txt")
+
+            ################################################
+            # PHASE 2: Convert to a portion average matrix #
+            ################################################
+
+            # This is the average of the portions of each user's total
+            # interactions which they spend on each other.
+            portion_matrix = raw_scores.portion_averages()
+            dump_matrix(portion_matrix, "Portion Average", "interactions_2_portion_avgs.txt")
+
+            ##################################
+            # PHASE 3: Top interactions only #
+            ##################################
+
+            if not top_k is None:
+               buf = []
+               for (uid, top) in portion_matrix.top_k(top_k):
+                  line = [uid_to_uname.get(uid, uid)]
+                  for (other_uid, value) in top:
+                     line.append(uid_to_uname.get(other_uid, other_uid) + " (" + str(value) + ")")
+                  buf.append("\t".join(line))
+               self._dump_to_file("\n".join(buf), filename="interactions_3_top_" + str(top_k) + ".txt")
+
+            return
+         await job.run_in_executor(cpu_bound_work)
+
+         await self._client.send_msg(msg, "Done. Please check the files.")
          return
-      await loop.run_in_executor(None, cpu_bound_work)
 
-      await self._client.send_msg(msg, "Done. Please check the files.")
+      await self._res.submit_job(("convstats", top_k), ("convstats " + substr).strip(), msg.channel, run_job)
       return
 
    ###############################################
@@ -506,16 +494,30 @@ class ServerActivityStatistics(ServerModule):
    ###############################################
 
    # These return value evaluation functions.
-   # Sees every message once with parameter "d" to evaluate.
-   # Returned value accumulates, and this cumulative value is passed in with parameter "p".
-   # Associated bin value is parameter "b".
+   # Each bin's value is worked out from an accumulator, which every message
+   # in the bin is added to. Accumulators are kept per channel (and per bin),
+   # so they can be checkpointed and then merged into the bin's total.
 
    # You can think of this as the function that generates the y-value.
 
    # This factory method must return a dict where:
-   #     fn    -> The value evaluation function.
-   #     axis  -> Axis title
-   #     title -> Customized text to use in the graph title.
+   #     new acc       -> Returns a new (empty) accumulator.
+   #     acc fn        -> Adds message "d" to an accumulator, called with
+   #                      (acc, d). Returns the new accumulator, which may be
+   #                      the same object.
+   #     rollup acc fn -> Same, except "d" is a rollup row (see
+   #                      messagerollup.iter_rows()) instead of a message.
+   #     merge acc     -> Returns the merge of two accumulators, without
+   #                      modifying either of them.
+   #     acc value     -> Returns a bin's value, given its accumulator.
+   #     axis          -> Axis title
+   #     title         -> Customized text to use in the graph title.
+   # It may also include:
+   #     vacc -> Vectorized equivalent of rollup acc fn, called with (cols,
+   #             bin_values), where cols are rollup columns (see
+   #             messagerollup.totals_to_columns()) as numpy arrays and
+   #             bin_values is the bin of each row. Returns a dict mapping
+   #             bin -> accumulator.
 
    _sg_argument1 = {} # Command Dictionary
    _sg_arghelp1 = []
@@ -523,52 +525,41 @@ class ServerActivityStatistics(ServerModule):
    _sg_arghelp1.append("`chars` - Total characters in messages.")
    @cmd.add(_sg_argument1, "chars")
    def _sg1_chars(self):
-      ret = {
-         "fn": lambda p, d, b: p + len(d["c"]),
-         "axis": "total characters typed into messages",
-         "title": "Characters Typed",
-      }
+      ret = _sum_evaluator(lambda d: len(d["c"]), "chars")
+      ret["axis"] = "total characters typed into messages"
+      ret["title"] = "Characters Typed"
       return ret
 
    _sg_arghelp1.append("`words` - Total words in messages (delimited by whitespace).")
    @cmd.add(_sg_argument1, "words")
    def _sg1_words(self):
-      ret = {
-         "fn": lambda p, d, b: p + len(d["c"].split()),
-         "axis": "total words typed into messages",
-         "title": "Words Typed",
-      }
+      ret = _sum_evaluator(lambda d: len(d["c"].split()), "words")
+      ret["axis"] = "total words typed into messages"
+      ret["title"] = "Words Typed"
       return ret
 
    _sg_arghelp1.append("`msgs` - Total messages sent.")
    @cmd.add(_sg_argument1, "msgs")
    def _sg1_msgs(self):
-      ret = {
-         "fn": lambda p, d, b: p + 1,
-         "axis": "total messages sent",
-         "title": "Messages Sent",
-      }
+      ret = _sum_evaluator(lambda d: 1, "msgs")
+      ret["axis"] = "total messages sent"
+      ret["title"] = "Messages Sent"
       return ret
 
    _sg_arghelp1.append("`uuser` - Number of unique users that sent a message.")
    @cmd.add(_sg_argument1, "uuser")
    def _sg1_uuser(self):
-      bins_dict = {} # Maps bin value -> user id -> literally any possible value
-      def new_fn(p, d, b):
-         user_id = d["a"]
-         try:
-            users_dict = bins_dict[b]
-            try:
-               temp = users_dict[user_id]
-               return p
-            except KeyError:
-               users_dict[user_id] = None
-               return p + 1
-         except KeyError:
-            bins_dict[b] = {user_id:None}
-            return p + 1
+      # Accumulators are sets of user IDs.
+      def new_fn(acc, d):
+         acc.add(d["a"])
+         return acc
       ret = {
-         "fn": new_fn,
+         "new acc": set,
+         "acc fn": new_fn,
+         "rollup acc fn": new_fn, # Rows also have the author ID.
+         "merge acc": lambda x, y: x | y,
+         "acc value": len,
+         "vacc": lambda cols, b: _np_authors_by_bin(b, cols["a"]),
          "axis": "unique users that sent a message",
          "title": "Unique Users",
       }
@@ -598,51 +589,24 @@ class ServerActivityStatistics(ServerModule):
    _sg_arghelp1.append("`avgmsglen` - Average message length.")
    @cmd.add(_sg_argument1, "avgmsglen")
    def _sg1_avgmsglen(self):
-      bins_dict = {} # Maps bin value -> (msg count, char count)
-      def new_fn(p, d, b):
-         msg_len = len(d["c"])
-         try:
-            prev_tuple = bins_dict[b] # Previous number of messages encountered
-            new_tuple = (prev_tuple[0] + 1, prev_tuple[1] + msg_len)
-         except KeyError:
-            new_tuple = (1, msg_len)
-         bins_dict[b] = new_tuple
-         try:
-            return new_tuple[1] / new_tuple[0] # RETURNS FLOAT!!!
-         except ZeroDivisionError:
-            return 0
-      ret = {
-         "fn": new_fn,
-         "axis": "average message length",
-         "title": "Average Message Length",
-      }
+      ret = _ratio_evaluator(lambda d: (1, len(d["c"])), "msgs", "chars")
+      ret["axis"] = "average message length"
+      ret["title"] = "Average Message Length"
       return ret
 
    _sg_arghelp1.append("`avgwordlen` - Average word length (delimited by whitespace).")
    @cmd.add(_sg_argument1, "avgwordlen")
    def _sg1_avgwordlen(self):
-      bins_dict = {} # Maps bin value -> (word count, char count)
-      def new_fn(p, d, b):
+      def msg_values(d):
          split_text = d["c"].split()
          text_words = len(split_text) # Note that this doesn't count whitespace.
          text_len = 0
          for word in split_text:
             text_len += len(word)
-         try:
-            prev_tuple = bins_dict[b] # Previous number of messages encountered
-            new_tuple = (prev_tuple[0] + text_words, prev_tuple[1] + text_len)
-         except KeyError:
-            new_tuple = (text_words, text_len)
-         bins_dict[b] = new_tuple
-         try:
-            return new_tuple[1] / new_tuple[0] # RETURNS FLOAT!!!
-         except ZeroDivisionError:
-            return 0
-      ret = {
-         "fn": new_fn,
-         "axis": "average word length",
-         "title": "Average Word Length",
-      }
+         return (text_words, text_len)
+      ret = _ratio_evaluator(msg_values, "words", "wordchars")
+      ret["axis"] = "average word length"
+      ret["title"] = "Average Word Length"
       return ret
 
    #############################################
@@ -650,11 +614,25 @@ class ServerActivityStatistics(ServerModule):
    #############################################
 
    # These return binning functions, which determines which x-value a message will be binned in.
+   # Bins are absolute (e.g. the day a message was sent, rather than how many
+   # days ago it was sent), so that checkpointed accumulators stay valid as
+   # time passes. They're only converted to x-values once the graph is made.
 
    # This factory method must return a dict where:
    #     fn    -> The bin evaluation function.
    #     axis  -> Axis title
    #     title -> Customized text to use in the graph title.
+   # It may also include:
+   #     rebase -> Converts a bin to its x-value, counting from the right
+   #               (i.e. 0 is the rightmost x-value). Bins with negative
+   #               x-values are left out. If it's not included, bins are
+   #               already x-values.
+   #     key   -> Anything else (json-serializable) the bins depend on, such
+   #              as the current time. Cached results are only reused if it
+   #              hasn't changed.
+   #     vfn   -> Vectorized equivalent, which takes a numpy array of
+   #              timestamps (seconds since the Unix epoch) and returns an
+   #              array of bins.
 
    _sg_argument2 = {} # Command Dictionary
    _sg_arghelp2 = []
@@ -664,8 +642,13 @@ class ServerActivityStatistics(ServerModule):
    def _sg2_eachday(self):
       now = utils.datetime_rounddown_to_day(datetime.datetime.utcnow())
       now += datetime.timedelta(days=1)
+      now_s = _datetime_to_epoch_seconds(now)
+      today = (now_s // 86400) - 1
       ret = {
-         "fn": lambda d: (now - d["t"]).days,
+         "fn": lambda d: _datetime_to_epoch_seconds(d["t"]) // 86400,
+         "vfn": lambda t: t // 86400,
+         "rebase": lambda b: today - b,
+         "key": now_s,
          "axis": "Each day of the server's life (left = earliest)",
          "title": "Each Day",
       }
@@ -676,11 +659,13 @@ class ServerActivityStatistics(ServerModule):
    def _sg2_eachhour(self):
       now = utils.datetime_rounddown_to_hour(datetime.datetime.utcnow())
       now += datetime.timedelta(hours=1)
-      def new_fn(d):
-         delta = now - d["t"]
-         return (delta.days * 24) + int(delta.seconds/3600) # Rounds down.
+      now_s = _datetime_to_epoch_seconds(now)
+      this_hour = (now_s // 3600) - 1
       ret = {
-         "fn": new_fn,
+         "fn": lambda d: _datetime_to_epoch_seconds(d["t"]) // 3600,
+         "vfn": lambda t: t // 3600,
+         "rebase": lambda b: this_hour - b,
+         "key": now_s,
          "axis": "Each hour of the server's life (left = earliest)",
          "title": "Each Hour",
       }
@@ -692,6 +677,7 @@ class ServerActivityStatistics(ServerModule):
    def _sg2_weekday(self):
       ret = {
          "fn": lambda d: 6 - d["t"].weekday(),
+         "vfn": lambda t: 6 - (((t // 86400) + 3) % 7), # 1/1/1970 was a Thursday.
          "axis": "Each day of the week (1 = Mon, 2 = Tue, etc.)",
          "title": "Each Day Of The Week",
       }
@@ -702,6 +688,7 @@ class ServerActivityStatistics(ServerModule):
    def _sg2_dayhour(self):
       ret = {
          "fn": lambda d: 23 - d["t"].hour,
+         "vfn": lambda t: 23 - ((t % 86400) // 3600),
          "axis": "Each hour of the day (0 to 23, UTC) ",
          "title": "Each Hour Of The Day",
       }
@@ -715,6 +702,7 @@ class ServerActivityStatistics(ServerModule):
          return 95 - (t.hour * 4) + int(t.minute/15)
       ret = {
          "fn": new_fn,
+         "vfn": lambda t: 95 - (((t % 86400) // 3600) * 4) + ((t % 3600) // 900),
          "axis": "Each 15 minute interval of the day (Leftmost = 0:00-0:15 UTC) ",
          "title": "Each 15 Minute Interval Of The Day",
       }
@@ -724,30 +712,201 @@ class ServerActivityStatistics(ServerModule):
    ### SIMPLE GRAPHING - STEP 3 (FILTER) ###
    #########################################
 
+   # The filter argument is one or more terms, separated by spaces. Each term
+   # is either a filter name or "name:value" (quotes can be used for values
+   # with spaces in them).
+   # Filter factories are called with the term's value ("" if there isn't
+   # one) and return a dict of constraints, which may have any of:
+   #     channels -> List of the only channel IDs to read.
+   #     since    -> Only messages at or after this (naive UTC) datetime are
+   #                 read.
+   #     authors  -> Set of the only user IDs whose messages are read.
+   #     title    -> Customized text to use in the graph title.
+   # Invalid values raise ValueError, with a message for the user.
+   # The terms are then combined into a single filter. (See _sg_filter().)
+
    _sg_argument4 = {} # Command Dictionary
    _sg_arghelp4 = []
 
    _sg_arghelp4.append("`wholeserver` - All messages in the server are analyzed.")
    @cmd.add(_sg_argument4, "wholeserver")
-   def _sg3_wholeserver(self, substr, msg):
+   def _sg3_wholeserver(self, value, msg):
+      return {}
+
+   _sg_arghelp4.append("`thischannel` - Only this channel is analyzed.")
+   @cmd.add(_sg_argument4, "thischannel")
+   def _sg3_thischannel(self, value, msg):
       ret = {
-         "fn": lambda d, ch_id: True,
-         "title": "Server -",
+         "channels": [msg.channel.id],
+         "title": "#" + msg.channel.name,
       }
       return ret
 
-   _sg_arghelp4.append("`thischannel` - Only this channel is analyzed.")
-   @cmd.add(_sg_argument4, "thischannel")
-   def _sg3_thischannel(self, substr, msg):
-      filt_ch_id = msg.channel.id
+   _sg_arghelp4.append("`channel:#a,#b` - Only these channels are analyzed.")
+   @cmd.add(_sg_argument4, "channel", "channels")
+   def _sg3_channel(self, value, msg):
+      server = self._res.server
+      channels = []
+      for ch_str in utils.remove_blank_strings(value.split(",")):
+         channel = None
+         if utils.re_ch_mention.fullmatch(ch_str):
+            channel = server.get_channel(ch_str[2:-1])
+         else:
+            ch_name = ch_str.lstrip("#")
+            for x in server.channels:
+               if x.name == ch_name:
+                  channel = x
+                  break
+         if channel is None:
+            raise ValueError("Unknown channel `{}`.".format(ch_str))
+         channels.append(channel)
+      if len(channels) == 0:
+         raise ValueError("No channels given.")
+      ret = {
+         "channels": [x.id for x in channels],
+         "title": ", ".join(["#" + x.name for x in channels]),
+      }
+      return ret
+
+   _sg_arghelp4.append("`since:30d` - Only messages from the last 30 days (or `h` hours, `w` weeks, `y` years) are analyzed. Also takes a date, e.g. `since:2016-01-01`.")
+   @cmd.add(_sg_argument4, "since")
+   def _sg3_since(self, value, msg):
+      since = utils.str_to_past_datetime(value)
+      if utils.re_duration.fullmatch(value):
+         title = "Last " + value
+      else:
+         title = "Since " + since.strftime("%Y-%m-%d")
+      # Rounded down to the start of a rollup bucket, so that rollup rows
+      # are either entirely kept or entirely left out.
+      since = messagerollup.bucket_start(messagerollup.bucket_of(since))
+      ret = {
+         "since": since,
+         "title": title,
+      }
+      return ret
+
+   _sg_arghelp4.append("`user:@x` - Only messages by this user are analyzed.")
+   @cmd.add(_sg_argument4, "user")
+   def _sg3_user(self, value, msg):
+      user_id = value
+      if utils.re_user_mention.fullmatch(value):
+         user_id = utils.umention_str_to_id(value)
+      elif not utils.re_digits.fullmatch(value):
+         raise ValueError("`{}` isn't a user mention.".format(value))
+      member = self._res.server.get_member(user_id)
+      name = user_id
+      if not member is None:
+         name = member.name
+      ret = {
+         "authors": {user_id},
+         "title": "@" + name,
+      }
+      return ret
+
+   _sg_arghelp4.append("`role:Name` - Only messages by current members of this role are analyzed.")
+   @cmd.add(_sg_argument4, "role")
+   def _sg3_role(self, value, msg):
+      server = self._res.server
+      role = utils.flair_name_to_object(server, value, case_sensitive=False)
+      if role is None:
+         raise ValueError("Unknown role `{}`.".format(value))
+      authors = set()
+      for member in server.members:
+         if role in member.roles:
+            authors.add(member.id)
+      ret = {
+         "authors": authors,
+         "title": role.name,
+      }
+      return ret
+
+   # Combines filter terms into a filter dict, which has:
+   #     fn    -> The filter function, called with (d, ch_id).
+   #     vfn   -> Vectorized equivalent, called with (cols, ch_id), which
+   #              returns a numpy boolean array of the rows to keep.
+   #     key   -> Hashable (and json-serializable) value capturing the since
+   #              and authors constraints. Checkpoints and cached results are
+   #              only reused if it hasn't changed.
+   #     title -> Customized text to use in the graph title.
+   # It also has these keys if the terms constrain them, so that they can be
+   # pushed down into reading the message cache:
+   #     channels -> List of the only channel IDs the filter can keep rows
+   #                 from. Other channels aren't read at all, and cached
+   #                 results aren't affected by new messages in them.
+   #     since    -> Messages before this datetime aren't read.
+   #     authors  -> Set of the only user IDs whose messages are read.
+   # Channel and author terms add to each other, while the latest since term
+   # is used.
+   # RETURNS: The filter dict.
+   # Raises ValueError (with a message for the user) if a term is invalid.
+   def _sg_filter(self, text, msg):
+      try:
+         terms = shlex.split(text)
+      except ValueError:
+         raise ValueError("Unmatched quotes in the filter.")
+      if len(terms) == 0:
+         raise ValueError("No filter given.")
+      channels = None
+      since = None
+      authors = None
+      titles = []
+      for term in terms:
+         (name, _, value) = term.partition(":")
+         try:
+            factory = self._sg_argument4[name.lower()]
+         except KeyError:
+            raise ValueError("Unknown filter `{}`.".format(name))
+         constraints = factory(self, value, msg)
+         if "channels" in constraints:
+            if channels is None:
+               channels = []
+            channels += [x for x in constraints["channels"] if not x in channels]
+         if "since" in constraints:
+            if (since is None) or (constraints["since"] > since):
+               since = constraints["since"]
+         if "authors" in constraints:
+            if authors is None:
+               authors = set()
+            authors |= constraints["authors"]
+         if "title" in constraints:
+            titles.append(constraints["title"])
+      if channels is None:
+         titles.insert(0, "Server")
+
+      since_s = None
+      if not since is None:
+         since_s = _datetime_to_epoch_seconds(since)
+      author_ints = None
+      if not authors is None:
+         author_ints = sorted(int(x) for x in authors)
+
       def new_fn(d, ch_id):
-         if ch_id == filt_ch_id:
-            return True
-         return False
+         if (not channels is None) and (not ch_id in channels):
+            return False
+         if (not since is None) and (d["t"] < since):
+            return False
+         if (not authors is None) and (not d["a"] in authors):
+            return False
+         return True
+      def new_vfn(cols, ch_id):
+         keep = np.full(len(cols["t"]), (channels is None) or (ch_id in channels), dtype=bool)
+         if not since_s is None:
+            keep &= (cols["t"] >= since_s)
+         if not author_ints is None:
+            keep &= np.isin(cols["a"], np.array(author_ints, dtype=np.int64))
+         return keep
       ret = {
          "fn": new_fn,
-         "title": "#" + msg.channel.name + " -",
+         "vfn": new_vfn,
+         "key": (since_s, None if author_ints is None else tuple(author_ints)),
+         "title": " ".join(titles) + " -",
       }
+      if not channels is None:
+         ret["channels"] = channels
+      if not since is None:
+         ret["since"] = since
+      if not authors is None:
+         ret["authors"] = authors
       return ret
    
    ########################################################
@@ -756,31 +915,61 @@ class ServerActivityStatistics(ServerModule):
 
    # This function generates graph data based on the value evaluation
    # and binning functions.
-
-   def _sg4_generate_graph_data(self, channel, measured, bins, sfilter):
-      data_temp = {} # Maps day delta -> chars sent
-      for ch in self._res.server.channels:
-         for msg_dict in self._res.message_cache_read(self._res.server.id, ch.id):
-            if not sfilter(msg_dict, ch.id):
+   # A checkpoint holds every channel's accumulators, along with how far
+   # into the channel they've got. Since messages are only ever added to the
+   # end of a channel, a checkpoint only needs the messages after that to be
+   # added. Channels that had messages edited or deleted (or that have no
+   # checkpoint yet) start over from _sg4_seed_channel().
+   # A checkpoint is a dict mapping channel ID -> channel checkpoint dict:
+   #     edit generation -> Edit generation of the channel (see
+   #                        MessageCache.get_watermark()).
+   #     last id         -> ID (as an int) of the last message added.
+   #     since           -> Messages from here on may not have been added yet.
+   #     accs            -> Dict mapping bin -> accumulator.
+   # PARAMETER: job - The jobscheduler.Job running the query, which progress
+   #                  is reported to.
+   # PARAMETER: checkpoint - The query's previous checkpoint, which may be
+   #                         modified. (Use an empty dict if there isn't one.)
+   # PARAMETER: watermarks - Dict mapping channel ID -> watermark of every
+   #                         channel to read.
+   # RETURNS: A tuple (data, x_vals, new checkpoint).
+
+   def _sg4_generate_graph_data(self, job, checkpoint, watermarks, measured, bins, sfilter):
+      new_checkpoint = {}
+      for (i, (ch_id, watermark)) in enumerate(watermarks.items()):
+         job.set_progress(i, len(watermarks))
+         ch_checkpoint = None
+         try:
+            ch_checkpoint = checkpoint[ch_id]
+            if ch_checkpoint["edit generation"] != watermark[1]:
+               raise KeyError
+         except KeyError:
+            ch_checkpoint = self._sg4_seed_channel(job, ch_id, watermark, measured, bins, sfilter)
+         self._sg4_add_new_messages(job, ch_checkpoint, ch_id, watermark, measured, bins, sfilter)
+         new_checkpoint[ch_id] = ch_checkpoint
+      job.set_progress(len(watermarks), len(watermarks))
+
+      # Merge every channel's accumulators into each x-value's.
+      rebase = bins.get("rebase", lambda b: b)
+      merged = {} # Maps x-value -> accumulator
+      for ch_checkpoint in new_checkpoint.values():
+         for (bin_value, acc) in ch_checkpoint["accs"].items():
+            x = rebase(bin_value)
+            if x < 0:
                continue
-            bin_value = bins(msg_dict)
-            prev = 0
             try:
-               prev = data_temp[bin_value]
-            except KeyError: # May also catch msg_dict keyerror...
-               pass
-            data_temp[bin_value] = measured(prev, msg_dict, bin_value)
-      bin_val = 0
+               merged[x] = measured["merge acc"](merged[x], acc)
+            except KeyError:
+               merged[x] = acc
+
       data = []
-      while bool(data_temp): # While dictionary still has data
-         content_len = 0
+      for x in range(max(merged, default=-1), -1, -1):
+         value = 0
          try:
-            content_len = data_temp[bin_val]
-            del data_temp[bin_val]
+            value = measured["acc value"](merged[x])
          except KeyError:
             pass
-         data.insert(0, content_len)
-         bin_val += 1
+         data.append(value)
 
       x_vals = []
       i = 1
@@ -788,7 +977,94 @@ class ServerActivityStatistics(ServerModule):
          x_vals.append(i)
          i += 1
 
-      return (data, x_vals)
+      return (data, x_vals, new_checkpoint)
+
+   # Starts a channel checkpoint from the channel's rollup, which is much
+   # faster than reading every message.
+   # Only rollup buckets from before the watermark's bucket are used. Since
+   # every message before the watermark is already cached, they can't gain
+   # any more messages. The rest are left to _sg4_add_new_messages().
+   # Binning and filter functions only see rollup rows' "t" (the middle of a
+   # 15 minute interval) and "a" keys.
+   # RETURNS: A channel checkpoint dict.
+
+   def _sg4_seed_channel(self, job, ch_id, watermark, measured, bins, sfilter):
+      (last_id, edit_generation, last_timestamp) = watermark
+      ret = {"edit generation": edit_generation, "last id": 0, "since": None, "accs": {}}
+      if last_timestamp is None:
+         return ret # Nothing cached yet.
+      bucket = messagerollup.bucket_of(last_timestamp)
+      ret["since"] = messagerollup.bucket_start(bucket)
+
+      server_id = self._res.server.id
+      accs = ret["accs"]
+      vectorized = ("vacc" in measured) and ("vfn" in bins) and ("vfn" in sfilter)
+      if (not np is None) and vectorized:
+         cols = self._res.message_cache_read_rollup_columns(server_id, ch_id)
+         cols = {k: np.array(v, dtype=np.int64) for (k, v) in cols.items()}
+         job.add_scanned(len(cols["t"]))
+         keep = sfilter["vfn"](cols, ch_id) & (cols["t"] < messagerollup.bucket_start_seconds(bucket))
+         cols = {k: v[keep] for (k, v) in cols.items()}
+         accs.update(measured["vacc"](cols, bins["vfn"](cols["t"])))
+      else:
+         scanned = 0
+         for row in self._res.message_cache_read_rollup(server_id, ch_id):
+            scanned += 1
+            if scanned == self._SCANNED_REPORT_INTERVAL:
+               job.add_scanned(scanned)
+               scanned = 0
+            if (row["t"] >= ret["since"]) or (not sfilter["fn"](row, ch_id)):
+               continue
+            bin_value = bins["fn"](row)
+            acc = None
+            try:
+               acc = accs[bin_value]
+            except KeyError:
+               acc = measured["new acc"]()
+            accs[bin_value] = measured["rollup acc fn"](acc, row)
+         job.add_scanned(scanned)
+      return ret
+
+   # Adds the messages that are newer than a channel checkpoint (up to the
+   # watermark) to it.
+   # The filter's since and authors constraints are passed on to the message
+   # cache, which skips segment files that can't contain any matching
+   # messages without decoding them.
+   def _sg4_add_new_messages(self, job, ch_checkpoint, ch_id, watermark, measured, bins, sfilter):
+      (prev_id, last_id) = (ch_checkpoint["last id"], int(watermark[0]))
+      if last_id <= prev_id:
+         return
+      since = ch_checkpoint["since"]
+      read_since = since
+      if ("since" in sfilter) and ((read_since is None) or (sfilter["since"] > read_since)):
+         read_since = sfilter["since"]
+      read_kwargs = {"since": read_since, "authors": sfilter.get("authors", None)}
+      accs = ch_checkpoint["accs"]
+      scanned = 0
+      for msg_dict in self._res.message_cache_read(self._res.server.id, ch_id, **read_kwargs):
+         scanned += 1
+         if scanned == self._SCANNED_REPORT_INTERVAL:
+            job.add_scanned(scanned)
+            scanned = 0
+         msg_id = int(msg_dict["i"])
+         if msg_id <= prev_id:
+            continue
+         elif msg_id > last_id:
+            break
+         since = msg_dict["t"]
+         if not sfilter["fn"](msg_dict, ch_id):
+            continue
+         bin_value = bins["fn"](msg_dict)
+         acc = None
+         try:
+            acc = accs[bin_value]
+         except KeyError:
+            acc = measured["new acc"]()
+         accs[bin_value] = measured["acc fn"](acc, msg_dict)
+      job.add_scanned(scanned)
+      ch_checkpoint["last id"] = last_id
+      ch_checkpoint["since"] = since
+      return
 
    ##############################################
    ### SIMPLE GRAPHING - STEP 5 (DATA OUTPUT) ###
@@ -803,14 +1079,7 @@ class ServerActivityStatistics(ServerModule):
    @cmd.add(_sg_argument3, "line")
    def _sg5_line(self):
       async def function(channel, **kwargs):
-         plotly_data = [
-            go.Scatter(
-               x = kwargs["x_vals"],
-               y = kwargs["y_vals"]
-            )
-         ]
-         plotly_layout = self._kwargs_to_plotly_layout(**kwargs)
-         await self._send_plotly_graph_object(channel, plotly_data, plotly_layout)
+         await self._send_chart(channel, self._kwargs_to_chart("line", **kwargs), cache_key=kwargs["cache_key"])
          return
       return function
 
@@ -818,14 +1087,7 @@ class ServerActivityStatistics(ServerModule):
    @cmd.add(_sg_argument3, "vbar")
    def _sg5_vbar(self):
       async def function(channel, **kwargs):
-         plotly_data = [
-            go.Bar(
-               x = kwargs["x_vals"],
-               y = kwargs["y_vals"]
-            )
-         ]
-         plotly_layout = self._kwargs_to_plotly_layout(**kwargs)
-         await self._send_plotly_graph_object(channel, plotly_data, plotly_layout)
+         await self._send_chart(channel, self._kwargs_to_chart("bar", **kwargs), cache_key=kwargs["cache_key"])
          return
       return function
 
@@ -837,7 +1099,9 @@ class ServerActivityStatistics(ServerModule):
          buf = "{} bins in order from lowest to highest:\n```\n".format(str(len(data)))
          for point in data:
             buf += str(point) + ", "
-         await self._client.send_msg(channel, buf[:-2] + "\n```")
+         buf = buf[:-2] + "\n```"
+         await self._client.send_msg(channel, buf)
+         self._store_result(kwargs["cache_key"], message=buf)
          return
       return function
 
@@ -852,23 +1116,58 @@ class ServerActivityStatistics(ServerModule):
             for (x, y) in zip(kwargs["x_vals"], kwargs["y_vals"]):
                csv_obj.writerow([x, y])
          await self._client.perm_send_file(channel, temp_filename)
-         os.remove(temp_filename)
+         self._store_result(kwargs["cache_key"], filepath=temp_filename)
          return
       return function
 
    # (Utility functions used for this step)
 
+   # RETURNS: Dict mapping channel ID -> watermark of every channel that the
+   #          filter can keep rows from.
+   def _sg_watermarks(self, filter_fn):
+      server = self._res.server
+      channel_ids = filter_fn.get("channels", [x.id for x in server.channels])
+      ret = {}
+      for ch_id in channel_ids:
+         ret[ch_id] = self._res.message_cache_get_watermark(server.id, ch_id)
+      return ret
+
+   # Results depend on the query, the messages in every channel that the
+   # filter can keep rows from, and possibly the time (via the bins' and
+   # filter's keys). The title is included since it may have a channel name
+   # in it.
+   def _sg_result_cache_key(self, args, title, bin_obj, filter_fn, watermarks):
+      ret = {
+         "server": self._res.server.id,
+         "args": args,
+         "title": title,
+         "bins key": bin_obj.get("key", None),
+         "filter key": filter_fn["key"],
+         "renderer": self._renderer.renderer_name,
+         "watermarks": {k: [v[0], v[1]] for (k, v) in watermarks.items()},
+      }
+      return ret
+
+   # Stores a result in the result cache, or just deletes the file if
+   # cache_key is None.
+   def _store_result(self, cache_key, filepath=None, message=None):
+      if cache_key is None:
+         if not filepath is None:
+            os.remove(filepath)
+      else:
+         self._result_cache.put(cache_key, filepath=filepath, message=message)
+      return
+
    @classmethod
-   def _kwargs_to_plotly_layout(cls, **kwargs):
-      return go.Layout( 
-         title = kwargs["title"],
-         xaxis = dict(
-            title = kwargs["x_axis_title"],
-         ),
-         yaxis = dict(
-            title = kwargs["y_axis_title"],
-         ),
-      )
+   def _kwargs_to_chart(cls, chart_type, **kwargs):
+      return {
+         "type": chart_type,
+         "title": kwargs["title"],
+         "x_vals": kwargs["x_vals"],
+         "y_vals": kwargs["y_vals"],
+         "x_axis_title": kwargs["x_axis_title"],
+         "y_axis_title": kwargs["y_axis_title"],
+      }
 
    ######################
    ### OTHER SERVICES ###
@@ -883,27 +1182,48 @@ class ServerActivityStatistics(ServerModule):
          f.write(text)
       return
 
+   # Same as _dump_to_file(), but writes lines as they're generated rather
+   # than building the whole file in memory first.
+   def _dump_lines_to_file(self, lines, filename=None):
+      data_dir = self._res.data_directory
+      if filename is None:
+         filename = utils.generate_temp_filename()
+      filepath = data_dir + filename
+      with open(filepath, encoding="utf-8", mode="w") as f:
+         first = True
+         for line in lines:
+            if not first:
+               f.write("\n")
+            f.write(line)
+            first = False
+      return
+
    # This is a utility function used by graph generating functions.
-   async def _send_plotly_graph_object(self, channel, data, layout):
-      loop = asyncio.get_event_loop()
+   # The chart is a chartrender chart dictionary.
+   # PARAMETER: cache_key - If not None, the result is stored in the result
+   #                        cache under this key.
+   async def _send_chart(self, channel, chart, cache_key=None):
+      renderer = self._renderer
       temp_filename = utils.generate_temp_filename()
-      temp_file_ext = ".png"
-      def get_plotly_objects():
-         py.image.save_as({'data':data, 'layout':layout}, temp_filename, format='png')
-         return
       try:
-         await loop.run_in_executor(None, get_plotly_objects)
+         temp_filename = await renderer.render(chart, temp_filename)
       except:
          print(traceback.format_exc())
-         buf = "**Unknown error occurred. Maybe my plotly login details are"
-         buf += " incorrect...**"
-         buf += "\n(Bot owner must manually enter a plotly username and API"
-         buf += " key in `config.ini` and relaunch the bot.)"
+         buf = "**Unknown error occurred while rendering the graph.**"
+         if renderer.renderer_name == "plotly":
+            buf = "**Unknown error occurred. Maybe my plotly login details are"
+            buf += " incorrect...**"
+            buf += "\n(Bot owner must manually enter a plotly username and API"
+            buf += " key in `config.ini` and relaunch the bot.)"
          await self._client.send_msg(channel, buf)
          raise errors.OperationAborted
+      text = None
+      if not renderer.draws_text():
+         text = "**{}**\nx: {}\ny: {}".format(chart["title"], chart["x_axis_title"], chart["y_axis_title"])
+         await self._client.send_msg(channel, text)
       try:
-         await self._client.perm_send_file(channel, temp_filename + temp_file_ext)
-         os.remove(temp_filename + temp_file_ext)
+         await self._client.perm_send_file(channel, temp_filename)
+         self._store_result(cache_key, filepath=temp_filename, message=text)
       except:
          print("Hopefully this allows us to identify the bug.")
          print(traceback.format_exc())
@@ -921,11 +1241,14 @@ class ServerActivityStatistics(ServerModule):
       buf += "\n\n**Argument 3 (Graph Type) is one of:**"
       for line in self._sg_arghelp3:
          buf += "\n" + line
-      buf += "\n\n**Argument 4 (Filter) is one of:**"
+      buf += "\n\n**Argument 4 (Filter) is one or more of:**"
       for line in self._sg_arghelp4:
          buf += "\n" + line
       buf += "\n\n**Example:** `" + self._res.cmd_prefix + self._res.module_cmd_aliases[0]
       buf += " chars eachday vbar wholeserver` - Bar graph of all characters"
       buf += " received by the server each day."
+      buf += "\n**Example:** `" + self._res.cmd_prefix + self._res.module_cmd_aliases[0]
+      buf += " msgs eachday line channel:#general since:30d` - Line graph of"
+      buf += " messages sent in #general each day, over the last 30 days."
       return buf
 
@@ -17,6 +17,7 @@ class PMGreetings(ServerModule):
    MODULE_NAME = "Server Greetings"
    MODULE_SHORT_DESCRIPTION = "Greets new users."
    RECOMMENDED_CMD_NAMES = ["servergreeting", "servergreetings"]
+   HOOKS_ORDER_INDEPENDENT = True
 
    _SECRET_TOKEN = utils.SecretToken()
    _cmdd = {} # Empty dict should work...
@@ -17,6 +17,7 @@ class SimpleLogger(ServerModule):
    MODULE_NAME = "Simple Event Logger"
    MODULE_SHORT_DESCRIPTION = "For logging basic events into a channel."
    RECOMMENDED_CMD_NAMES = ["simplelogger"]
+   HOOKS_ORDER_INDEPENDENT = True
 
    _SECRET_TOKEN = utils.SecretToken()
    _cmdd = {} # Empty dict should work...
@@ -3,7 +3,7 @@ import sys
 import concurrent
 import traceback
 
-from . import utils, errors, cmd
+from . import utils, errors, cmd, servermodule
 from .helpnode import HelpNode
 from .enums import PrivilegeLevel
 from .servermoduleresources import ServerModuleResources
@@ -44,6 +44,7 @@ class ServerModuleWrapper(HelpNode): #  # TODO Having weird issues here...
       self._module_class = module_class
       self._module_cmd_aliases = module_cmd_aliases
       self._shortcut_cmd_aliases = None # Maps top-level command alias to module command alias.
+      self._preprocessor_rules = [] # List of PreprocessorRule objects
 
       self._state_lock = asyncio.Lock()
 
@@ -89,6 +90,29 @@ class ServerModuleWrapper(HelpNode): #  # TODO Having weird issues here...
          aliases.append(alias)
       return aliases
 
+   @property
+   def hooks_order_independent(self):
+      return self._module_class.HOOKS_ORDER_INDEPENDENT
+
+   @property
+   def hook_timeout(self):
+      return self._module_class.HOOK_TIMEOUT
+
+   @property
+   def preprocessor_rules(self):
+      return self._preprocessor_rules
+
+   # PARAMETER: rules - List of PreprocessorRule objects, replacing any set
+   #                    before.
+   def set_preprocessor_rules(self, rules):
+      self._preprocessor_rules = list(rules)
+      return
+
+   # RETURNS: True if the module class overrides a ServerModule method, e.g.
+   #          "on_message". If it doesn't, calling the method does nothing.
+   def implements_hook(self, hook_name):
+      return getattr(self._module_class, hook_name) is not getattr(servermodule.ServerModule, hook_name)
+
    def is_active(self):
       return self._is_active
 
@@ -249,6 +273,18 @@ class ServerModuleWrapper(HelpNode): #  # TODO Having weird issues here...
          await self._module_method_error_handler(e)
          return content
 
+   # Calls a coroutine function the module registered elsewhere (e.g. a
+   # custom command handler), with the same error handling as the methods
+   # served by the module.
+   async def call_registered_handler(self, handler, *args):
+      if not self.is_active():
+         return
+      try:
+         return await handler(*args)
+      except Exception as e:
+         await self._module_method_error_handler(e)
+         return
+
    # PARAMETER: upper_cmd_alias is the command alias that was split off before
    #            the substring was passed into this function.
    #            E.g. if the full command was `/random choice A;B;C`, ServerBotInstance
@@ -10,6 +10,7 @@ import http.client
 import random
 
 import discord
+import dateutil.parser
 
 re_user_mention = re.compile("<@!?\d+>")
 re_ch_mention = re.compile("<#\d+>")
@@ -18,6 +19,7 @@ re_az_09 = re.compile("[a-z0-9]+")
 
 re_digits = re.compile("\d+")
 re_int = re.compile("[-\+]?\d+")
+re_duration = re.compile(r"\d+[hdwyHDWY]")
 
 # These two regexes must both be used to verify a folder name.
 re_dirname_fullmatch = re.compile("[a-z0-9_-]+") # This must be full-matched.
@@ -146,10 +148,26 @@ _CWD = os.getcwd()
 _ENCODING = "utf-8"
 
 # This overwrites whatever file is specified with the data.
-def json_write(relfilepath, data=None):
+# PARAMETER: fsync - If True, doesn't return until the data is on disk.
+def json_write(relfilepath, data=None, fsync=False):
    mkdir_recursive(relfilepath)
    with open(relfilepath, encoding=_ENCODING, mode="w") as f:
       f.write(json.dumps(data, sort_keys=True, indent=3))
+      if fsync:
+         f.flush()
+         os.fsync(f.fileno())
+   return
+
+# Makes sure files created, replaced or removed in a directory stay that way
+# if the machine crashes.
+def fsync_dir(reldirpath):
+   if os.name == "nt":
+      return # Directories can't be opened on Windows.
+   fd = os.open(os.path.join(_CWD, reldirpath), os.O_RDONLY)
+   try:
+      os.fsync(fd)
+   finally:
+      os.close(fd)
    return
 
 def json_read(relfilepath):
@@ -359,6 +377,27 @@ def timedelta_to_string(td, include_us=False):
       buf += str(td.microseconds) + "μs "
    return buf[:-1]
 
+_duration_units = {"h": 3600, "d": 86400, "w": 7 * 86400, "y": 365 * 86400}
+
+# Parses either a duration back from now (e.g. "30d", or h/w/y for hours,
+# weeks and years), or a date (e.g. "2016-01-01").
+# RETURNS: A naive UTC datetime.
+# Raises ValueError if the text is neither.
+def str_to_past_datetime(text):
+   if re_duration.fullmatch(text):
+      seconds = int(text[:-1]) * _duration_units[text[-1].lower()]
+      try:
+         return datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+      except OverflowError:
+         raise ValueError("`{}` isn't a duration or a date.".format(text))
+   try:
+      ret = dateutil.parser.parse(text)
+   except (ValueError, OverflowError):
+      raise ValueError("`{}` isn't a duration or a date.".format(text))
+   if not ret.tzinfo is None:
+      ret = ret.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+   return ret
+
 # TODO: Consider guaranteeing uniqueness of the filename.
 def generate_temp_filename():
    return "temp" + str(random.getrandbits(128))
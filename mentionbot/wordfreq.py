@@ -0,0 +1,183 @@
+import array
+import zlib
+import collections
+
+# Word frequency counting, as used by the zipf command.
+#
+# Words are counted per author (or per group of authors), and summed into
+# per-role totals once at the end. ApproxWordCounter can be used in place
+# of collections.Counter to bound memory use on large servers.
+
+# RETURNS: A translation table (for str.translate()) that replaces every
+#          character in chars_to_replace with a space.
+def make_translation_table(chars_to_replace):
+   return str.maketrans(dict.fromkeys(chars_to_replace, " "))
+
+# RETURNS: List of lowercase words in the content.
+def tokenize(content, table):
+   return content.translate(table).lower().split()
+
+# Counts the words said by each author.
+# PARAMETER: author_keys - If not None, maps author IDs to the key their
+#                          words are counted under. Authors not in it are
+#                          counted under default_key.
+# PARAMETER: new_counter - Called with no arguments to make a new counter.
+#                          The counter must have an update() method that
+#                          takes a list of words.
+# RETURNS: Dict mapping author ID (or key) -> counter.
+def count_words(messages, table, author_keys=None, default_key=None, new_counter=collections.Counter):
+   counts = {}
+   for msg_dict in messages:
+      key = msg_dict["a"]
+      if not author_keys is None:
+         key = author_keys.get(key, default_key)
+      word_list = tokenize(msg_dict["c"], table)
+      try:
+         counts[key].update(word_list)
+      except KeyError:
+         counter = new_counter()
+         counter.update(word_list)
+         counts[key] = counter
+   return counts
+
+# Merges one dict of counters (as returned by count_words()) into another.
+# Counters in partial may end up in (and be modified as part of) totals.
+# RETURNS: The merged dict.
+def merge_counts(totals, partial):
+   for (key, counter) in partial.items():
+      try:
+         _merge_counter(totals[key], counter)
+      except KeyError:
+         totals[key] = counter
+   return totals
+
+def _merge_counter(counter, other):
+   if isinstance(counter, ApproxWordCounter):
+      counter.merge(other)
+   else:
+      counter.update(other)
+   return
+
+# Sums counters into per-role totals.
+# Counters whose keys share the same set of roles are summed together first,
+# so each counter is only added once rather than once for every role.
+# PARAMETER: key_roles - Maps counter key -> iterable of role names. Keys
+#                        that aren't in it count towards default_role.
+# PARAMETER: new_counter - See count_words().
+# RETURNS: Dict mapping role name -> counter.
+def sum_by_role(counts, key_roles, default_role, new_counter=collections.Counter):
+   by_role_set = {}
+   for (key, counter) in counts.items():
+      role_set = frozenset(key_roles.get(key, [default_role]))
+      merge_counts(by_role_set, {role_set: counter})
+   ret = {}
+   for (role_set, counter) in by_role_set.items():
+      for role in role_set:
+         try:
+            role_counter = ret[role]
+         except KeyError:
+            role_counter = ret[role] = new_counter()
+         _merge_counter(role_counter, counter)
+   return ret
+
+# RETURNS: The total count of all words in a counter.
+def total_count(counter):
+   if isinstance(counter, ApproxWordCounter):
+      return counter.total
+   return sum(counter.values())
+
+class CountMinSketch:
+   """
+   Count-min sketch of word counts. Estimates are never below the real
+   count, and are over by at most (total count * e / width) with probability
+   (1 - e^-depth).
+
+   Words are hashed with zlib checksums rather than hash(), so that sketches
+   made in different processes can be merged.
+   """
+
+   def __init__(self, width, depth):
+      self.width = width
+      self.depth = depth
+      self._rows = [array.array("I", bytes(4 * width)) for i in range(depth)]
+      return
+
+   def _indices(self, word):
+      data = word.encode("utf-8")
+      h1 = zlib.crc32(data)
+      h2 = zlib.adler32(data) | 1
+      return [(h1 + (i * h2)) % self.width for i in range(self.depth)]
+
+   # RETURNS: The new estimate of the word's count.
+   def add(self, word, count=1):
+      estimate = None
+      for (row, i) in zip(self._rows, self._indices(word)):
+         value = row[i] + count
+         row[i] = value
+         if (estimate is None) or (value < estimate):
+            estimate = value
+      return estimate
+
+   def estimate(self, word):
+      return min(row[i] for (row, i) in zip(self._rows, self._indices(word)))
+
+   def merge(self, other):
+      assert (self.width == other.width) and (self.depth == other.depth)
+      for (row, other_row) in zip(self._rows, other._rows):
+         for i in range(self.width):
+            row[i] += other_row[i]
+      return
+
+class ApproxWordCounter:
+   """
+   Bounded-memory stand-in for collections.Counter, made of a count-min
+   sketch and a list of heavy hitters (the words most likely to be in the
+   top k). Only the top k words can be listed, and their counts are
+   estimates. The total count is exact.
+   """
+
+   def __init__(self, width=2**14, depth=4, k=2000):
+      self.k = k
+      self.total = 0
+      self._sketch = CountMinSketch(width, depth)
+      self._candidates = {} # Maps word -> last known estimate
+      self._threshold = 0 # Estimate a new word needs to become a candidate.
+      return
+
+   def update(self, words):
+      sketch = self._sketch
+      candidates = self._candidates
+      for word in words:
+         estimate = sketch.add(word)
+         if (word in candidates) or (estimate > self._threshold):
+            candidates[word] = estimate
+      self.total += len(words)
+      if len(candidates) > 2 * self.k:
+         self._prune()
+      return
+
+   def merge(self, other):
+      self._sketch.merge(other._sketch)
+      self.total += other.total
+      for word in set(self._candidates) | set(other._candidates):
+         self._candidates[word] = self._sketch.estimate(word)
+      self._prune()
+      return
+
+   # Drops all but the top k candidates.
+   def _prune(self):
+      top = sorted(self._candidates.items(), key=lambda x: -x[1])[:self.k]
+      self._candidates = dict(top)
+      if len(top) == self.k:
+         self._threshold = top[-1][1]
+      return
+
+   # RETURNS: List of up to k (word, estimated count) tuples, from the most
+   #          common word.
+   def most_common(self):
+      for word in self._candidates:
+         self._candidates[word] = self._sketch.estimate(word)
+      return sorted(self._candidates.items(), key=lambda x: -x[1])[:self.k]
+
+   def items(self):
+      return self.most_common()
@@ -38,6 +38,10 @@ config_defaults = {
 		"message_bot_owner_on_init": "TRUE",
 		"default_status": "bot is running",
 		"initialization_status": "bot is initializing",
+		"chart_renderer": "auto",
+		"max_analytics_jobs": "2",
+		"event_serialization": "server",
+		"max_concurrent_event_handlers": "8",
 	},
 }
 
@@ -123,6 +127,34 @@ def ini_parse(config_dict):
 		raise ValueError("Cache folder name must have at least one lowercase or digit.")
 	if not re_dirname_fullmatch.fullmatch(fname):
 		raise ValueError("Cache folder name must only be made of up lowercase, digits, underscores, or dashes.")
+
+	# Check chart renderer name.
+	renderer = config_dict["misc"]["chart_renderer"].lower()
+	if not renderer in {"auto", "plotly", "matplotlib", "builtin"}:
+		raise ValueError("Chart renderer must be 'auto', 'plotly', 'matplotlib', or 'builtin'.")
+	config_dict["misc"]["chart_renderer"] = renderer
+
+	# Check the analytics job limit.
+	try:
+		max_jobs = int(config_dict["misc"]["max_analytics_jobs"])
+	except ValueError:
+		max_jobs = 0
+	if max_jobs < 1:
+		raise ValueError("max_analytics_jobs must be a whole number of at least 1.")
+	config_dict["misc"]["max_analytics_jobs"] = max_jobs
+
+	# Check event handling settings.
+	serialization = config_dict["misc"]["event_serialization"].lower()
+	if not serialization in {"server", "channel"}:
+		raise ValueError("Event serialization must be 'server' or 'channel'.")
+	config_dict["misc"]["event_serialization"] = serialization
+	try:
+		max_handlers = int(config_dict["misc"]["max_concurrent_event_handlers"])
+	except ValueError:
+		max_handlers = 0
+	if max_handlers < 1:
+		raise ValueError("max_concurrent_event_handlers must be a whole number of at least 1.")
+	config_dict["misc"]["max_concurrent_event_handlers"] = max_handlers
 	return
 
 def run():
@@ -146,7 +178,7 @@ def run():
 	reconnect_on_error = config_dict["error_handling"]["reconnect_on_error"]
 	while True:
 		config_dict_copy = copy.deepcopy(config_dict)
-		proc = mp.Process(target=botentry.run, daemon=True, args=(config_dict_copy,))
+		proc = mp.Process(target=botentry.run, daemon=False, args=(config_dict_copy,))
 		proc.start()
 		proc.join()
 		ret = proc.exitcode
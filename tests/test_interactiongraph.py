@@ -0,0 +1,135 @@
+import random
+import datetime
+import unittest
+from unittest import mock
+
+from mentionbot import interactiongraph
+
+_BASE = datetime.datetime(2016, 1, 1)
+_TIMEFRAME = datetime.timedelta(minutes=5)
+
+def _msg_dict(seconds, author_id, content, attachments=0):
+   return {
+      "t": _BASE + datetime.timedelta(seconds=seconds),
+      "a": author_id,
+      "c": content,
+      "h": [{}] * attachments,
+      "e": [],
+   }
+
+def _random_messages(seed, num_messages):
+   rng = random.Random(seed)
+   ret = []
+   seconds = 0
+   for i in range(num_messages):
+      seconds += rng.randint(0, 200)
+      content = "x" * rng.randint(0, 30)
+      if rng.random() < 0.2:
+         content += " <@" + str(rng.randint(1, 45)) + ">"
+      attachments = 1 if rng.random() < 0.1 else 0
+      ret.append(_msg_dict(seconds, str(rng.randint(1, 40)), content, attachments))
+   return ret
+
+def _interactions(messages):
+   (pairs, warnings) = interactiongraph.channel_interactions("1", messages, _TIMEFRAME, 3, 15)
+   return pairs
+
+class TestChannelInteractions(unittest.TestCase):
+
+   def test_window_and_mentions(self):
+      messages = [
+         _msg_dict(0, "1", "aaaa"),
+         _msg_dict(60, "2", "bb"),
+         _msg_dict(120, "1", "c <@2>"),  # Mentions someone in the window.
+         _msg_dict(130, "3", "dd <@9>", attachments=1), # Mentions someone outside it.
+         _msg_dict(1000, "2", "e"),      # Everyone else has expired.
+      ]
+      self.assertEqual(_interactions(messages), {
+         ("1", "2"): 2 + (6 * 3),
+         ("1", "3"): 7 + 15,
+         ("2", "3"): 7 + 15,
+         ("3", "9"): (7 + 15) * 3,
+      })
+      return
+
+   def test_merge_pairs(self):
+      partials = [_interactions(_random_messages(x, 500)) for x in range(3)]
+      merged = {}
+      for partial in partials:
+         merged = interactiongraph.merge_pairs(merged, partial)
+      for key in set().union(*partials):
+         self.assertEqual(merged[key], sum(x.get(key, 0) for x in partials))
+      self.assertEqual(len(merged), len(set().union(*partials)))
+      return
+
+class TestInteractionMatrix(unittest.TestCase):
+   """
+   The numpy and plain list matrices must give the same results, and both
+   must agree with a dense matrix worked out by hand.
+   """
+
+   def setUp(self):
+      self.pairs = _interactions(_random_messages(3, 5000))
+      return
+
+   # RETURNS: Dict mapping (uid, other uid) -> average portion.
+   def _dense_portions(self):
+      totals = {}
+      for ((uid1, uid2), interaction_rating) in self.pairs.items():
+         totals[uid1] = totals.get(uid1, 0) + interaction_rating
+         totals[uid2] = totals.get(uid2, 0) + interaction_rating
+      ret = {}
+      for ((uid1, uid2), interaction_rating) in self.pairs.items():
+         portion1 = 0.0
+         portion2 = 0.0
+         if totals[uid1] != 0:
+            portion1 = interaction_rating / totals[uid1] * 100
+         if totals[uid2] != 0:
+            portion2 = interaction_rating / totals[uid2] * 100
+         ret[(uid1, uid2)] = (portion1 + portion2) / 2
+         ret[(uid2, uid1)] = ret[(uid1, uid2)]
+      return ret
+
+   def _assert_matrix_correct(self):
+      matrix = interactiongraph.InteractionMatrix.from_pairs(self.pairs)
+      entries = {(matrix.uids[i], matrix.uids[j]): value for (i, j, value) in matrix.entries()}
+      expected = dict(self.pairs)
+      expected.update({(uid2, uid1): x for ((uid1, uid2), x) in self.pairs.items()})
+      self.assertEqual(entries, expected)
+
+      portions = matrix.portion_averages()
+      entries = {(portions.uids[i], portions.uids[j]): value for (i, j, value) in portions.entries()}
+      expected = self._dense_portions()
+      self.assertEqual(set(entries), set(expected))
+      for (key, value) in expected.items():
+         self.assertAlmostEqual(entries[key], value, places=9)
+      return (matrix, portions)
+
+   def test_matrix_without_numpy(self):
+      with mock.patch.object(interactiongraph, "np", None):
+         self._assert_matrix_correct()
+      return
+
+   @unittest.skipIf(interactiongraph.np is None, "numpy isn't installed.")
+   def test_numpy_same_as_lists(self):
+      (matrix, portions) = self._assert_matrix_correct()
+      with mock.patch.object(interactiongraph, "np", None):
+         (list_matrix, list_portions) = self._assert_matrix_correct()
+      self.assertEqual(matrix.uids, list_matrix.uids)
+      self.assertEqual(list(matrix.indptr), list_matrix.indptr)
+      self.assertEqual(list(matrix.indices), list_matrix.indices)
+      self.assertEqual(list(matrix.data), list_matrix.data)
+      self.assertEqual(list(portions.data), list_portions.data)
+      self.assertEqual(portions.top_k(3), list_portions.top_k(3))
+      return
+
+   def test_empty(self):
+      for np in (interactiongraph.np, None):
+         with mock.patch.object(interactiongraph, "np", np):
+            matrix = interactiongraph.InteractionMatrix.from_pairs({})
+            self.assertEqual(list(matrix.portion_averages().entries()), [])
+            self.assertEqual(matrix.top_k(3), [])
+      return
+
+if __name__ == "__main__":
+   unittest.main()
@@ -0,0 +1,344 @@
+import os
+import shutil
+import tempfile
+import datetime
+import asyncio
+import unittest
+
+import discord
+
+from mentionbot import messagesegment, messagerollup
+from mentionbot.messagecache import MessageCache
+
+_BASE = datetime.datetime(2016, 1, 1)
+
+# Just enough of discord.py's objects for the message cache.
+
+class _Channel(discord.Channel):
+   def __init__(self, server, ch_id):
+      self.server = server
+      self.id = ch_id
+      self.name = "ch" + ch_id
+      self.type = discord.ChannelType.text
+      return
+
+class _Server:
+   def __init__(self, server_id, ch_ids):
+      self.id = server_id
+      self.channels = [_Channel(self, x) for x in ch_ids]
+      return
+
+class _Author:
+   def __init__(self, user_id):
+      self.id = user_id
+      return
+
+class _Message:
+   def __init__(self, channel, n, content=None):
+      self.channel = channel
+      self.server = channel.server
+      self.id = str(n)
+      self.timestamp = _BASE + datetime.timedelta(minutes=n)
+      self.author = _Author(str(n % 7 + 1))
+      self.content = "message " + str(n) if content is None else content
+      self.attachments = []
+      self.embeds = []
+      self.edited_timestamp = None
+      self.tts = False
+      self.mention_everyone = False
+      self.mentions = []
+      self.channel_mentions = []
+      return
+
+class _Client:
+   """
+   Serves message IDs 1 to history - 1 of every channel to the backfill.
+   """
+
+   def __init__(self, history):
+      self.servers = [_Server("10", ["20"])]
+      self.history = history
+      return
+
+   def get_channel(self):
+      return self.servers[0].channels[0]
+
+   async def set_temp_game_status(self, text):
+      return
+
+   async def remove_temp_game_status(self):
+      return
+
+   async def report_exception(self, e, **kwargs):
+      raise e
+
+   def logs_from(self, channel, limit, after):
+      first = int(after.id) + 1
+      return _LogsIterator([_Message(channel, n) for n in range(first, min(first + limit, self.history))])
+
+class _LogsIterator:
+   def __init__(self, messages):
+      self._messages = iter(messages)
+      return
+
+   def __aiter__(self):
+      return self
+
+   async def __anext__(self):
+      try:
+         return next(self._messages)
+      except StopIteration:
+         raise StopAsyncIteration
+
+class MessageCacheTestCase(unittest.TestCase):
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp() + "/"
+      self.loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(self.loop)
+      self.open_caches = []
+      return
+
+   def tearDown(self):
+      for mc in list(self.open_caches):
+         self.close_cache(mc)
+      self.loop.close()
+      asyncio.set_event_loop(None)
+      shutil.rmtree(self.directory)
+      return
+
+   def run_coro(self, coro):
+      return self.loop.run_until_complete(coro)
+
+   # Opens an instance and waits for its backfill. The background compactor
+   # is stopped so that tests decide when to compact.
+   def open_cache(self, client):
+      mc = self.run_coro(MessageCache.get_instance(client, self.directory))
+      self.open_caches.append(mc)
+      self.run_coro(mc._backfill_task)
+      mc._compact_task.cancel()
+      self.wait_for_tasks([mc._compact_task])
+      return mc
+
+   # Waits for tasks to finish, even if they were cancelled.
+   def wait_for_tasks(self, tasks):
+      tasks = list(tasks)
+      if len(tasks) > 0:
+         self.run_coro(asyncio.wait(tasks))
+      return
+
+   def close_cache(self, mc):
+      self.run_coro(mc.shutdown_flush())
+      self.wait_for_tasks([mc._flush_task, mc._compact_task, mc._rollup_task])
+      mc._writer.shutdown(wait=True)
+      self.open_caches.remove(mc)
+      return
+
+   # Drops an instance without flushing anything, as if the bot had crashed.
+   def crash_cache(self, mc):
+      tasks = [mc._flush_task, mc._compact_task, mc._rollup_task, mc._backfill_task]
+      for task in tasks:
+         task.cancel()
+      self.wait_for_tasks(tasks + list(mc._write_tasks))
+      mc._writer.shutdown(wait=True)
+      for f in list(mc._wal_files.values()) + list(mc._delta_files.values()):
+         f.close()
+      self.open_caches.remove(mc)
+      return
+
+   # Queues every buffered message to be flushed, and waits for them to be
+   # written. Each channel's buffer becomes one segment.
+   def flush(self, mc):
+      mc._flush_due(force=True)
+      self.wait_for_tasks(mc._write_tasks)
+      return
+
+   # RETURNS: List of (ID, content) of every message read from the channel.
+   def read_all(self, mc, **kwargs):
+      ch = mc._client.get_channel()
+      return [(x["i"], x["c"]) for x in mc.read_messages(ch.server.id, ch.id, **kwargs)]
+
+   def get_manifest(self, mc):
+      ch = mc._client.get_channel()
+      return mc._manifests[(ch.server.id, ch.id)]
+
+   def get_ch_dir(self, mc):
+      ch = mc._client.get_channel()
+      return mc._get_ch_dir(ch.server.id, ch.id)
+
+   # Checks the rollup against one recomputed from every message.
+   def assert_rollup_consistent(self, mc):
+      ch = mc._client.get_channel()
+      expected = messagerollup.ChannelRollup()
+      for msg in mc.read_messages(ch.server.id, ch.id):
+         expected.add(msg)
+      got = messagerollup.ChannelRollup()
+      got.totals = mc._read_rollup_totals(ch.server.id, ch.id)
+      self.assertEqual(
+         {k: v for (k, v) in got.totals.items() if any(v)},
+         {k: v for (k, v) in expected.totals.items() if any(v)},
+      )
+      return
+
+def _expected(ids, edits={}, deleted=set()):
+   return [(str(n), edits.get(n, "message " + str(n))) for n in ids if not n in deleted]
+
+class TestBackfill(MessageCacheTestCase):
+
+   def test_backfill_and_resume(self):
+      client = _Client(history=451)
+      mc = self.open_cache(client)
+      self.assertEqual(self.read_all(mc), _expected(range(1, 451)))
+      self.close_cache(mc)
+
+      client.history = 601
+      mc = self.open_cache(client)
+      self.assertEqual(self.read_all(mc), _expected(range(1, 601)))
+      self.close_cache(mc)
+      return
+
+   def test_filtered_reads(self):
+      mc = self.open_cache(_Client(history=451))
+      since = _BASE + datetime.timedelta(minutes=100)
+      until = _BASE + datetime.timedelta(minutes=300)
+      got = self.read_all(mc, since=since, until=until, authors=["1", "2"])
+      expected = [x for x in _expected(range(100, 300)) if int(x[0]) % 7 + 1 in (1, 2)]
+      self.assertEqual(got, expected)
+      self.close_cache(mc)
+      return
+
+class TestWriteAheadLog(MessageCacheTestCase):
+
+   def test_replay_after_crash(self):
+      client = _Client(history=101)
+      mc = self.open_cache(client)
+      ch = client.get_channel()
+      for n in range(101, 151):
+         self.run_coro(mc.record_message(_Message(ch, n)))
+      self.run_coro(mc.record_edit(_Message(ch, 120, content="edited")))
+      self.run_coro(mc.record_delete(_Message(ch, 121)))
+      self.crash_cache(mc)
+
+      mc = self.open_cache(client)
+      expected = _expected(range(1, 151), edits={120: "edited"}, deleted={121})
+      self.assertEqual(self.read_all(mc), expected)
+      self.close_cache(mc)
+      return
+
+class TestCompaction(MessageCacheTestCase):
+
+   def setUp(self):
+      super().setUp()
+      self.client = _Client(history=101)
+      self.mc = self.open_cache(self.client)
+      # Several small segments, one per flush.
+      ch = self.client.get_channel()
+      for first in range(101, 501, 50):
+         for n in range(first, first + 50):
+            self.run_coro(self.mc.record_message(_Message(ch, n)))
+         self.flush(self.mc)
+      for n in range(501, 521):
+         self.run_coro(self.mc.record_message(_Message(ch, n))) # Left buffered
+      self.mc._COMPACT_GRACE = 0
+      return
+
+   def test_compaction_keeps_messages(self):
+      before = self.read_all(self.mc)
+      self.assertEqual(before, _expected(range(1, 521)))
+      segments_before = len(self.get_manifest(self.mc)["segments"])
+      self.run_coro(self.mc.compact())
+
+      manifest = self.get_manifest(self.mc)
+      self.assertLess(len(manifest["segments"]), segments_before)
+      self.assertTrue(all(x.get("compressed", False) for x in manifest["segments"]))
+      self.assertEqual(self.read_all(self.mc), before)
+      self.assert_rollup_consistent(self.mc)
+
+      # Replaced segment files are deleted once nothing can be reading them.
+      self.run_coro(self.mc.compact())
+      ch_dir = self.get_ch_dir(self.mc)
+      on_disk = set(x for x in os.listdir(ch_dir) if x.endswith(messagesegment.SEGMENT_EXT))
+      in_manifest = set(str(x["n"]) + messagesegment.SEGMENT_EXT for x in self.get_manifest(self.mc)["segments"])
+      self.assertEqual(on_disk, in_manifest)
+
+      self.close_cache(self.mc)
+      mc = self.open_cache(self.client)
+      self.assertEqual(self.read_all(mc), before)
+      self.assert_rollup_consistent(mc)
+      self.close_cache(mc)
+      return
+
+   def test_readers_keep_replaced_segments(self):
+      ch = self.client.get_channel()
+      reader = self.mc.read_messages(ch.server.id, ch.id)
+      first = next(reader)["i"]
+      self.run_coro(self.mc.compact())
+      self.run_coro(self.mc.compact()) # Would delete them if nothing was reading.
+      rest = [x["i"] for x in reader]
+      self.assertEqual([first] + rest, [x[0] for x in _expected(range(1, 521))])
+      self.assertEqual(self.mc._active_readers, 0)
+      self.close_cache(self.mc)
+      return
+
+class TestDeltaLog(MessageCacheTestCase):
+
+   def setUp(self):
+      super().setUp()
+      self.client = _Client(history=401)
+      self.mc = self.open_cache(self.client)
+      self.edits = {10: "edited once", 250: "edited on disk"}
+      self.deleted = {11, 300}
+      ch = self.client.get_channel()
+      self.run_coro(self.mc.record_edit(_Message(ch, 10, content="edited")))
+      self.run_coro(self.mc.record_edit(_Message(ch, 10, content="edited once")))
+      self.run_coro(self.mc.record_edit(_Message(ch, 250, content="edited on disk")))
+      self.run_coro(self.mc.record_delete(_Message(ch, 11)))
+      self.run_coro(self.mc.record_delete(_Message(ch, 300)))
+      return
+
+   def test_deltas_are_applied(self):
+      expected = _expected(range(1, 401), edits=self.edits, deleted=self.deleted)
+      self.assertEqual(self.read_all(self.mc), expected)
+      self.assertTrue(os.path.isfile(self.get_ch_dir(self.mc) + MessageCache._DELTAS_FILENAME))
+      self.assert_rollup_consistent(self.mc)
+      return
+
+   def test_deltas_replayed_after_crash(self):
+      ch = self.client.get_channel()
+      watermark = self.mc.get_watermark(ch.server.id, ch.id)
+      self.assertEqual(watermark[1], 5)
+      self.crash_cache(self.mc)
+      mc = self.open_cache(self.client)
+      expected = _expected(range(1, 401), edits=self.edits, deleted=self.deleted)
+      self.assertEqual(self.read_all(mc), expected)
+      self.assert_rollup_consistent(mc)
+      self.close_cache(mc)
+      return
+
+   def test_edit_generation_persists(self):
+      ch = self.client.get_channel()
+      watermark = self.mc.get_watermark(ch.server.id, ch.id)
+      self.close_cache(self.mc)
+      mc = self.open_cache(self.client)
+      self.assertEqual(mc.get_watermark(ch.server.id, ch.id), watermark)
+      self.close_cache(mc)
+      return
+
+   def test_compaction_merges_deltas(self):
+      expected = _expected(range(1, 401), edits=self.edits, deleted=self.deleted)
+      self.mc._COMPACT_GRACE = 0
+      self.run_coro(self.mc.compact())
+      ch = self.client.get_channel()
+      self.assertEqual(self.mc._get_deltas(ch.server.id, ch.id), {})
+      self.assertFalse(os.path.isfile(self.get_ch_dir(self.mc) + MessageCache._DELTAS_FILENAME))
+      self.assertEqual(self.read_all(self.mc), expected)
+      self.assert_rollup_consistent(self.mc)
+      self.close_cache(self.mc)
+
+      mc = self.open_cache(self.client)
+      self.assertEqual(self.read_all(mc), expected)
+      self.close_cache(mc)
+      return
+
+if __name__ == "__main__":
+   unittest.main()
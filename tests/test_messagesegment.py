@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+from mentionbot import messagesegment
+
+_BASE = datetime.datetime(2016, 1, 1)
+
+def _msg_dict(i, content=None):
+   if content is None:
+      content = "message " + str(i) + " ünïcödé"
+   return {
+      "t": _BASE + datetime.timedelta(minutes=i, microseconds=i),
+      "i": str(10 ** 17 + i),
+      "a": str(10 ** 17 + (i % 5)),
+      "c": content,
+      "h": [] if i % 3 else [{"url": "http://example.com/" + str(i), "size": i}],
+      "e": [],
+      "f": "e0/0" if i % 2 else "1/0",
+   }
+
+class TestSegmentRoundTrip(unittest.TestCase):
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      self.msg_dicts = [_msg_dict(i) for i in range(300)]
+      self.msg_dicts.append(_msg_dict(300, content=""))
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def _write(self, msg_dicts, **kwargs):
+      filepath = os.path.join(self.directory, "1" + messagesegment.SEGMENT_EXT)
+      num_bytes = messagesegment.write_segment(filepath, msg_dicts, **kwargs)
+      self.assertEqual(num_bytes, os.path.getsize(filepath))
+      return filepath
+
+   def test_read_segment(self):
+      for compress in (False, True):
+         filepath = self._write(self.msg_dicts, compress=compress)
+         self.assertEqual(list(messagesegment.read_segment(filepath)), self.msg_dicts)
+      return
+
+   def test_read_selected_columns(self):
+      filepath = self._write(self.msg_dicts)
+      got = list(messagesegment.read_segment(filepath, columns=["i", "a"]))
+      self.assertEqual(got, [{"i": x["i"], "a": x["a"]} for x in self.msg_dicts])
+      return
+
+   def test_segment_view(self):
+      for compress in (False, True):
+         filepath = self._write(self.msg_dicts, compress=compress)
+         with messagesegment.SegmentView(filepath) as segment:
+            self.assertEqual(len(segment), len(self.msg_dicts))
+            self.assertEqual(segment.is_compressed(), compress)
+            for (i, expected) in enumerate(self.msg_dicts):
+               view = messagesegment.MessageView(segment, i)
+               self.assertEqual(view.to_dict(), expected)
+               self.assertEqual(view["c"], expected["c"])
+               self.assertEqual(view.author_int, int(expected["a"]))
+               self.assertEqual(view.id_int, int(expected["i"]))
+               self.assertEqual(view.epoch_us, messagesegment.datetime_to_epoch_us(expected["t"]))
+      return
+
+   def test_empty_segment(self):
+      filepath = self._write([])
+      self.assertEqual(list(messagesegment.read_segment(filepath)), [])
+      self.assertEqual(list(messagesegment.iter_segment_views(filepath)), [])
+      return
+
+   def test_not_a_segment(self):
+      filepath = os.path.join(self.directory, "2" + messagesegment.SEGMENT_EXT)
+      with open(filepath, "wb") as f:
+         f.write(b"definitely not a segment file")
+      with self.assertRaises(messagesegment.SegmentFormatError):
+         messagesegment.SegmentView(filepath)
+      return
+
+   def test_timestamps(self):
+      dt = datetime.datetime(2016, 5, 4, 3, 2, 1, 123456)
+      epoch_us = messagesegment.datetime_to_epoch_us(dt)
+      self.assertEqual(messagesegment.epoch_us_to_datetime(epoch_us), dt)
+      aware = datetime.datetime(2016, 5, 4, 5, 2, 1, 123456, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+      self.assertEqual(messagesegment.datetime_to_epoch_us(aware), epoch_us)
+      return
+
+class TestSegmentIndex(unittest.TestCase):
+
+   def setUp(self):
+      self.directory = tempfile.mkdtemp()
+      return
+
+   def tearDown(self):
+      shutil.rmtree(self.directory)
+      return
+
+   def test_index_matches_file(self):
+      msg_dicts = [_msg_dict(i) for i in range(50)]
+      filepath = os.path.join(self.directory, "7" + messagesegment.SEGMENT_EXT)
+      num_bytes = messagesegment.write_segment(filepath, msg_dicts)
+      from_messages = messagesegment.index_messages(7, num_bytes, msg_dicts)
+      from_file = messagesegment.index_segment(7, filepath)
+      self.assertEqual(from_messages, from_file)
+      self.assertEqual(from_file["count"], 50)
+      self.assertEqual(from_file["min id"], msg_dicts[0]["i"])
+      self.assertEqual(from_file["max id"], msg_dicts[-1]["i"])
+      self.assertEqual(len(from_file["authors"]), 5)
+      return
+
+   def test_index_may_match(self):
+      msg_dicts = [_msg_dict(i) for i in range(10, 20)]
+      entry = messagesegment.index_messages(1, 0, msg_dicts)
+      first_us = messagesegment.datetime_to_epoch_us(msg_dicts[0]["t"])
+      last_us = messagesegment.datetime_to_epoch_us(msg_dicts[-1]["t"])
+      self.assertTrue(messagesegment.index_may_match(entry, None, None, None))
+      self.assertTrue(messagesegment.index_may_match(entry, last_us, None, None))
+      self.assertFalse(messagesegment.index_may_match(entry, last_us + 1, None, None))
+      self.assertTrue(messagesegment.index_may_match(entry, None, first_us + 1, None))
+      self.assertFalse(messagesegment.index_may_match(entry, None, first_us, None))
+      self.assertTrue(messagesegment.index_may_match(entry, None, None, {msg_dicts[0]["a"]}))
+      self.assertFalse(messagesegment.index_may_match(entry, None, None, {"12345"}))
+      return
+
+if __name__ == "__main__":
+   unittest.main()
@@ -0,0 +1,200 @@
+import re
+import asyncio
+import unittest
+
+from mentionbot import utils
+from mentionbot.servermodulegroup import ServerModuleGroup
+from mentionbot.preprocessorrules import PreprocessorRule, CMD_PREFIX
+
+# Each fake module has its preprocessor written twice: once as rules, and once
+# as the msg_preprocessor() it would have implemented before rules existed.
+# Running every module's msg_preprocessor() in turn is the legacy behaviour
+# the compiled rules must reproduce.
+
+_MBTI_TYPES = {"INTJ", "ENFP", "ISTP"}
+
+class _FakeModule:
+   """
+   Just enough of ServerModuleWrapper for ServerModuleGroup.
+
+   If use_legacy is True, the module implements msg_preprocessor() rather than
+   registering rules.
+   """
+
+   def __init__(self, name, rules, legacy, use_legacy=False, active=True):
+      self.module_name = name
+      self.all_cmd_aliases = []
+      self.hooks_order_independent = False
+      self.hook_timeout = None
+      self._rules = rules
+      self._legacy = legacy
+      self._use_legacy = use_legacy
+      self._active = active
+      return
+
+   @property
+   def preprocessor_rules(self):
+      return [] if self._use_legacy else self._rules
+
+   def implements_hook(self, hook_name):
+      return self._use_legacy and (hook_name == "msg_preprocessor")
+
+   def is_active(self):
+      return self._active
+
+   async def call_registered_handler(self, handler, *args):
+      return await handler(*args)
+
+   # Same as the legacy hook itself, including ServerModuleWrapper's check.
+   async def msg_preprocessor(self, content, msg, default_cmd_prefix):
+      if not self.is_active():
+         return content
+      return await self._legacy(content, msg, default_cmd_prefix)
+
+def _channels_module(**kwargs):
+   async def preprocess_open(match, msg):
+      return match.cmd_prefix + "dc open " + match.rest
+   async def preprocess_search(match, msg):
+      return match.cmd_prefix + "dc search " + match.rest
+   rules = [
+      PreprocessorRule("+++", preprocess_open),
+      PreprocessorRule("++", preprocess_search),
+   ]
+   async def legacy(content, msg, default_cmd_prefix):
+      if content.startswith("+++"):
+         content = default_cmd_prefix + "dc open " + content[3:]
+      elif content.startswith("++"):
+         content = default_cmd_prefix + "dc search " + content[2:]
+      return content
+   return _FakeModule("channels", rules, legacy, **kwargs)
+
+def _flair_module(**kwargs):
+   async def preprocess_flair(match, msg):
+      return match.cmd_prefix + "jcf typeflair " + match.word
+   async def preprocess_issue(match, msg):
+      return match.cmd_prefix + "issue " + match.regex_match.group(1)
+   rules = [
+      PreprocessorRule(CMD_PREFIX, preprocess_flair, lookup=_MBTI_TYPES, lookup_key=str.upper),
+      PreprocessorRule("#", preprocess_issue, regex=re.compile(r"(\d+)$")),
+   ]
+   async def legacy(content, msg, default_cmd_prefix):
+      if content.startswith(default_cmd_prefix):
+         (left, right) = utils.separate_left_word(content[len(default_cmd_prefix):])
+         if left.upper() in _MBTI_TYPES:
+            return default_cmd_prefix + "jcf typeflair " + left
+      if content.startswith("#"):
+         match = re.match(r"(\d+)$", content[1:])
+         if match:
+            return default_cmd_prefix + "issue " + match.group(1)
+      return content
+   return _FakeModule("flair", rules, legacy, **kwargs)
+
+# Turns "!!x" into "++x", to be picked up by the channels module if it comes
+# later. "hey" is matched ignoring case.
+def _alias_module(**kwargs):
+   async def preprocess_nothing(match, msg):
+      return None
+   async def preprocess_double(match, msg):
+      return "++" + match.rest
+   async def preprocess_hey(match, msg):
+      return match.cmd_prefix + "say " + match.rest.strip()
+   rules = [
+      PreprocessorRule("!!", preprocess_nothing),
+      PreprocessorRule("!!", preprocess_double),
+      PreprocessorRule("hey", preprocess_hey, ignore_case=True),
+   ]
+   async def legacy(content, msg, default_cmd_prefix):
+      if content.startswith("!!"):
+         return "++" + content[2:]
+      if content[:3].lower() == "hey":
+         return default_cmd_prefix + "say " + content[3:].strip()
+      return content
+   return _FakeModule("alias", rules, legacy, **kwargs)
+
+_CONTENTS = [
+   "",
+   "hello",
+   "+",
+   "++",
+   "++music",
+   "+++ music",
+   "!intj",
+   "!INTJ extra words",
+   "!infj",
+   "$enfp",
+   "#123",
+   "#123a",
+   "#",
+   "!!music",
+   "!!+music",
+   "!!!intj",
+   "hey there",
+   "HEY you",
+   "Hex",
+   "Hey !!",
+]
+
+class TestCompiledPreprocessor(unittest.TestCase):
+
+   def setUp(self):
+      self.loop = asyncio.new_event_loop()
+      return
+
+   def tearDown(self):
+      self.loop.close()
+      return
+
+   def _assert_same_as_legacy(self, modules, cmd_prefixes=["!", "$"]):
+      group = ServerModuleGroup(list(modules))
+      for cmd_prefix in cmd_prefixes:
+         for content in _CONTENTS:
+            expected = content
+            for module in modules:
+               expected = self.loop.run_until_complete(module.msg_preprocessor(expected, None, cmd_prefix))
+            got = self.loop.run_until_complete(group.msg_preprocessor(content, None, cmd_prefix))
+            self.assertEqual(got, expected, "content {!r} with prefix {!r}".format(content, cmd_prefix))
+      return
+
+   def test_matches_legacy(self):
+      self._assert_same_as_legacy([_channels_module(), _flair_module(), _alias_module()])
+      return
+
+   def test_module_order(self):
+      # Earlier modules see the content before later ones rewrite it, and
+      # aren't run again afterwards.
+      self._assert_same_as_legacy([_alias_module(), _channels_module(), _flair_module()])
+      self._assert_same_as_legacy([_channels_module(), _alias_module(), _flair_module()])
+      self._assert_same_as_legacy([_flair_module(), _alias_module(), _channels_module()])
+      group = ServerModuleGroup([_alias_module(), _channels_module()])
+      self.assertEqual(self.loop.run_until_complete(group.msg_preprocessor("!!x", None, "!")), "!dc search x")
+      group = ServerModuleGroup([_channels_module(), _alias_module()])
+      self.assertEqual(self.loop.run_until_complete(group.msg_preprocessor("!!x", None, "!")), "++x")
+      return
+
+   def test_mixed_with_legacy_modules(self):
+      for use_legacy in [(True, False, False), (False, True, False), (True, False, True)]:
+         modules = [
+            _alias_module(use_legacy=use_legacy[0]),
+            _channels_module(use_legacy=use_legacy[1]),
+            _flair_module(use_legacy=use_legacy[2]),
+         ]
+         self._assert_same_as_legacy(modules)
+      return
+
+   def test_inactive_modules(self):
+      self._assert_same_as_legacy([_alias_module(active=False), _channels_module(), _flair_module()])
+      self._assert_same_as_legacy([_alias_module(), _channels_module(active=False, use_legacy=True), _flair_module()])
+      return
+
+   def test_rules_changed(self):
+      module = _channels_module()
+      group = ServerModuleGroup([module])
+      self.assertEqual(self.loop.run_until_complete(group.msg_preprocessor("++x", None, "!")), "!dc search x")
+      module._rules = []
+      self.assertEqual(self.loop.run_until_complete(group.msg_preprocessor("++x", None, "!")), "!dc search x")
+      group.preprocessor_rules_changed()
+      self.assertEqual(self.loop.run_until_complete(group.msg_preprocessor("++x", None, "!")), "++x")
+      return
+
+if __name__ == "__main__":
+   unittest.main()
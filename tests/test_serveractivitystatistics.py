@@ -0,0 +1,139 @@
+import datetime
+import unittest
+from unittest import mock
+
+from mentionbot import messagerollup
+from mentionbot.servermodules import serveractivitystatistics
+from mentionbot.servermodules.serveractivitystatistics import ServerActivityStatistics
+
+_CH_IDS = ["20", "21"]
+
+def _messages(ch_id, now):
+   # Two and a half weeks of messages, every 7 minutes, with contents of a
+   # few lengths (including empty ones).
+   base = now - datetime.timedelta(days=18)
+   ret = []
+   for n in range(3500):
+      ret.append({
+         "t": base + datetime.timedelta(minutes=7 * n, seconds=n % 60),
+         "i": str(1000 + n),
+         "a": str((n * (int(ch_id) - 17)) % 9 + 1),
+         "c": "ab cd  efg " * (n % 4),
+      })
+   return ret
+
+class _Channel:
+   def __init__(self, ch_id):
+      self.id = ch_id
+      self.name = "ch" + ch_id
+      return
+
+class _Server:
+   def __init__(self):
+      self.id = "10"
+      self.channels = [_Channel(x) for x in _CH_IDS]
+      return
+
+   def get_member(self, user_id):
+      return None
+
+class _Resources:
+   """
+   Serves each channel's messages and rollup, as the message cache would.
+   """
+
+   def __init__(self, now):
+      self.server = _Server()
+      self.messages = {x: _messages(x, now) for x in _CH_IDS}
+      self.totals = {}
+      for (ch_id, msg_dicts) in self.messages.items():
+         rollup = messagerollup.ChannelRollup()
+         rollup.add_all(msg_dicts)
+         self.totals[ch_id] = rollup.totals
+      return
+
+   def message_cache_read(self, server_id, ch_id, since=None, authors=None):
+      for msg_dict in self.messages[ch_id]:
+         if (not since is None) and (msg_dict["t"] < since):
+            continue
+         if (not authors is None) and (not msg_dict["a"] in authors):
+            continue
+         yield msg_dict
+      return
+
+   def message_cache_read_rollup(self, server_id, ch_id):
+      return list(messagerollup.iter_rows(self.totals[ch_id]))
+
+   def message_cache_read_rollup_columns(self, server_id, ch_id):
+      return messagerollup.totals_to_columns(self.totals[ch_id])
+
+   def watermarks(self):
+      return {k: (v[-1]["i"], 0, v[-1]["t"]) for (k, v) in self.messages.items()}
+
+class _Job:
+   def set_progress(self, done, total):
+      return
+
+   def add_scanned(self, num):
+      return
+
+class _Msg:
+   def __init__(self, channel):
+      self.channel = channel
+      return
+
+_FILTERS = [
+   "wholeserver",
+   "thischannel",
+   "since:10d",
+   "user:3",
+   "user:3 user:5 since:1w",
+   "channel:ch21 user:4",
+]
+
+@unittest.skipIf(serveractivitystatistics.np is None, "numpy isn't installed.")
+class TestVectorizedGraphing(unittest.TestCase):
+   """
+   The numpy engine must give the same graphs as reading rollups row by row,
+   which must give the same graphs as reading every message.
+   """
+
+   def setUp(self):
+      now = datetime.datetime.utcnow()
+      self.res = _Resources(now)
+      self.stats = object.__new__(ServerActivityStatistics)
+      self.stats._res = self.res
+      self.msg = _Msg(self.res.server.channels[0])
+      return
+
+   def _generate(self, measured_name, bins_name, filter_text, seed=True):
+      measured = ServerActivityStatistics._sg_argument1[measured_name](self.stats)
+      bins = ServerActivityStatistics._sg_argument2[bins_name](self.stats)
+      sfilter = self.stats._sg_filter(filter_text, self.msg)
+      watermarks = {k: v for (k, v) in self.res.watermarks().items() if ("channels" not in sfilter) or (k in sfilter["channels"])}
+      if seed:
+         (data, x_vals, checkpoint) = self.stats._sg4_generate_graph_data(_Job(), {}, watermarks, measured, bins, sfilter)
+         return data
+      # Every message is read, and the rollup isn't used at all.
+      checkpoint = {}
+      for (ch_id, watermark) in watermarks.items():
+         checkpoint[ch_id] = {"edit generation": watermark[1], "last id": 0, "since": None, "accs": {}}
+      (data, x_vals, checkpoint) = self.stats._sg4_generate_graph_data(_Job(), checkpoint, watermarks, measured, bins, sfilter)
+      return data
+
+   def test_same_as_row_by_row(self):
+      for measured_name in ServerActivityStatistics._sg_argument1:
+         for bins_name in ServerActivityStatistics._sg_argument2:
+            for filter_text in _FILTERS:
+               query = (measured_name, bins_name, filter_text)
+               vectorized = self._generate(*query)
+               with mock.patch.object(serveractivitystatistics, "np", None):
+                  row_by_row = self._generate(*query)
+                  from_messages = self._generate(*query, seed=False)
+               self.assertTrue(any(vectorized), query)
+               self.assertEqual(vectorized, row_by_row, query)
+               self.assertEqual(vectorized, from_messages, query)
+      return
+
+if __name__ == "__main__":
+   unittest.main()
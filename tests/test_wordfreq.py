@@ -0,0 +1,78 @@
+import random
+import bisect
+import itertools
+import collections
+import unittest
+
+from mentionbot import wordfreq
+
+def _zipf_words(seed, num_words, vocabulary):
+   rng = random.Random(seed)
+   cumulative = list(itertools.accumulate(1 / (x + 1) for x in range(vocabulary)))
+   ret = []
+   for i in range(num_words):
+      rank = bisect.bisect(cumulative, rng.random() * cumulative[-1])
+      ret.append("w" + str(min(rank, vocabulary - 1)))
+   return ret
+
+class TestCountMinSketch(unittest.TestCase):
+
+   def test_estimates_never_below_count(self):
+      words = _zipf_words(1, 20000, 3000)
+      sketch = wordfreq.CountMinSketch(512, 4)
+      for word in words:
+         sketch.add(word)
+      for (word, count) in collections.Counter(words).items():
+         self.assertGreaterEqual(sketch.estimate(word), count)
+      return
+
+   def test_merge(self):
+      words = _zipf_words(2, 10000, 1000)
+      whole = wordfreq.CountMinSketch(256, 3)
+      halves = [wordfreq.CountMinSketch(256, 3), wordfreq.CountMinSketch(256, 3)]
+      for (i, word) in enumerate(words):
+         whole.add(word)
+         halves[i % 2].add(word)
+      halves[0].merge(halves[1])
+      for word in set(words):
+         self.assertEqual(halves[0].estimate(word), whole.estimate(word))
+      return
+
+class TestApproxWordCounter(unittest.TestCase):
+
+   def test_top_words_match_counter(self):
+      words = _zipf_words(3, 50000, 5000)
+      exact = collections.Counter(words)
+      approx = wordfreq.ApproxWordCounter(k=50)
+      for i in range(0, len(words), 100):
+         approx.update(words[i:i + 100])
+      self.assertEqual(approx.total, len(words))
+      self.assertEqual(wordfreq.total_count(approx), wordfreq.total_count(exact))
+      top = approx.most_common()
+      self.assertEqual(len(top), 50)
+      for (word, estimate) in top:
+         self.assertGreaterEqual(estimate, exact[word])
+      expected_top = [x[0] for x in exact.most_common(10)]
+      self.assertEqual(set(x[0] for x in top[:10]), set(expected_top))
+      return
+
+   def test_count_words_and_merge(self):
+      table = wordfreq.make_translation_table(".,")
+      messages = [
+         {"a": "1", "c": "Hello, world."},
+         {"a": "2", "c": "hello hello"},
+         {"a": "3", "c": "World"},
+      ]
+      for new_counter in (collections.Counter, wordfreq.ApproxWordCounter):
+         kwargs = {"author_keys": {"1": "x", "2": "x"}, "default_key": "y", "new_counter": new_counter}
+         counts = wordfreq.merge_counts({}, wordfreq.count_words(messages[:2], table, **kwargs))
+         counts = wordfreq.merge_counts(counts, wordfreq.count_words(messages[2:], table, **kwargs))
+         by_role = wordfreq.sum_by_role(counts, {"x": ["a", "b"]}, "c", new_counter=new_counter)
+         self.assertEqual(dict(by_role["a"].items()), {"hello": 3, "world": 1})
+         self.assertEqual(dict(by_role["b"].items()), {"hello": 3, "world": 1})
+         self.assertEqual(dict(by_role["c"].items()), {"world": 1})
+         self.assertEqual(wordfreq.total_count(by_role["a"]), 4)
+      return
+
+if __name__ == "__main__":
+   unittest.main()